@@ -0,0 +1,282 @@
+import json
+import numpy as np
+
+ANN_FORMAT_VERSION = 1
+
+
+def closest_rows(data, centers, batch_size=65536):
+    """
+    Function that returns the closest center of each row of data, in batches to bound the memory.
+    """
+    centers = np.asarray(centers, dtype=np.float32)
+    centers_norms = np.einsum("ij,ij->i", centers, centers)
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), batch_size):
+        batch = np.asarray(data[start:start + batch_size], dtype=np.float32)
+        labels[start:start + batch_size] = (centers_norms - 2 * batch @ centers.T).argmin(axis=1)
+    return labels
+
+
+def train_codebook(data, n_codes=256, n_iter=20, rng=None):
+    """
+    Function that fits the codes of one subspace with Lloyd's K-means. Empty codes are moved to random rows.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    data = np.asarray(data, dtype=np.float32)
+    n_codes = min(n_codes, len(data))
+    codebook = data[rng.choice(len(data), size=n_codes, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = closest_rows(data, codebook)
+        counts = np.bincount(labels, minlength=n_codes)
+        sums = np.zeros_like(codebook)
+        np.add.at(sums, labels, data)
+        empty = counts == 0
+        codebook[~empty] = sums[~empty] / counts[~empty, None]
+        codebook[empty] = data[rng.choice(len(data), size=empty.sum())]
+
+    return codebook
+
+
+def grow(array, size, capacity):
+    """
+    Function that returns a buffer with room for capacity rows, with the first size rows of array.
+    """
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:size] = array[:size]
+    return grown
+
+
+class IVFPQIndex:
+    """
+    Approximate nearest neighbours index of the scaled features, in pure NumPy.
+    - IVF: the songs are stored in one inverted list per centroid of the K-means model (the coarse
+      quantizer), and a query only scans the lists of its nprobe closest centroids.
+    - PQ: each song is stored as its residual to the centroid, split in subspaces and encoded with
+      one byte per subspace. The distances are computed with a lookup table per query and list.
+    The PQ distances can be refined by reranking the best candidates with the stored float32
+    vectors (store_vectors=True).
+    The arrays of each list are buffers that double their capacity when they are full, and only
+    their first list_sizes rows are used, so inserting songs one by one stays cheap.
+    """
+
+    def __init__(self, centroids, codebooks, list_ids, list_codes, song_ids, list_vectors=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.codebooks = [np.asarray(codebook, dtype=np.float32) for codebook in codebooks]
+        self.subspaces = np.cumsum([0] + [codebook.shape[1] for codebook in self.codebooks])
+        self.list_ids = list_ids
+        self.list_codes = list_codes
+        self.list_vectors = list_vectors
+        self.list_sizes = np.array([len(ids) for ids in list_ids], dtype=np.int64)
+        self.song_ids = list(song_ids)
+        self.song_position = {song_id: position for position, song_id in enumerate(self.song_ids)}
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def __contains__(self, song_id):
+        return song_id in self.song_position
+
+    @classmethod
+    def train(cls, centroids, scaled, song_ids, n_subspaces=4, n_codes=256, sample_size=100000, n_iter=20,
+              store_vectors=True, random_state=0):
+        """
+        Method that creates the index: the codebooks are trained on a sample of the residuals and
+        then all the songs are added.
+        Input: the centroids of the K-means model, the scaled features and the ids of the songs.
+        """
+        rng = np.random.default_rng(random_state)
+        centroids = np.asarray(centroids, dtype=np.float32)
+        sample = rng.choice(len(scaled), size=min(sample_size, len(scaled)), replace=False)
+        sample_scaled = np.asarray(scaled[np.sort(sample)], dtype=np.float32)
+        residuals = sample_scaled - centroids[closest_rows(sample_scaled, centroids)]
+
+        codebooks = [train_codebook(part, n_codes=n_codes, n_iter=n_iter, rng=rng)
+                     for part in np.array_split(residuals, n_subspaces, axis=1)]
+
+        n_lists = len(centroids)
+        ann = cls(centroids, codebooks, [np.empty(0, dtype=np.int64) for _ in range(n_lists)],
+                  [np.empty((0, n_subspaces), dtype=np.uint8) for _ in range(n_lists)], [],
+                  [np.empty((0, centroids.shape[1]), dtype=np.float32) for _ in range(n_lists)]
+                  if store_vectors else None)
+        ann.add(scaled, song_ids)
+
+        return ann
+
+    def encode(self, residuals):
+        codes = np.empty((len(residuals), len(self.codebooks)), dtype=np.uint8)
+        for subspace, codebook in enumerate(self.codebooks):
+            start, end = self.subspaces[subspace], self.subspaces[subspace + 1]
+            codes[:, subspace] = closest_rows(residuals[:, start:end], codebook)
+        return codes
+
+    def add(self, scaled, song_ids):
+        """
+        Method that inserts songs (for example the new songs of a crawl). The codebooks are not trained
+        again; songs already in the index are skipped.
+        """
+        song_ids = list(song_ids)
+        new_rows = [row for row, song_id in enumerate(song_ids) if song_id not in self.song_position]
+        new_rows = list({song_ids[row]: row for row in new_rows}.values())
+        if new_rows == []:
+            return 0
+
+        vectors = np.asarray(scaled, dtype=np.float32)[new_rows]
+        positions = np.arange(len(self.song_ids), len(self.song_ids) + len(new_rows))
+        for row in new_rows:
+            self.song_position[song_ids[row]] = len(self.song_ids)
+            self.song_ids.append(song_ids[row])
+
+        lists = closest_rows(vectors, self.centroids)
+        codes = self.encode(vectors - self.centroids[lists])
+
+        order = np.argsort(lists, kind="stable")
+        bounds = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+        for list_number in range(len(self.centroids)):
+            selected = order[bounds[list_number]:bounds[list_number + 1]]
+            if len(selected) == 0:
+                continue
+            size = self.list_sizes[list_number]
+            new_size = size + len(selected)
+            buffers = [self.list_ids, self.list_codes] + ([self.list_vectors] if self.list_vectors is not None else [])
+            if new_size > len(self.list_ids[list_number]):
+                capacity = max(2 * len(self.list_ids[list_number]), new_size)
+                for buffer in buffers:
+                    buffer[list_number] = grow(buffer[list_number], size, capacity)
+            for buffer, values in zip(buffers, [positions, codes, vectors]):
+                buffer[list_number][size:new_size] = values[selected]
+            self.list_sizes[list_number] = new_size
+
+        return len(new_rows)
+
+    def inverted_list(self, list_number):
+        """
+        Method that returns the used part of the arrays of a list: ids, codes and vectors (None if not stored).
+        """
+        size = self.list_sizes[list_number]
+        vectors = self.list_vectors[list_number][:size] if self.list_vectors is not None else None
+        return self.list_ids[list_number][:size], self.list_codes[list_number][:size], vectors
+
+    def search(self, features, k=10, nprobe=4, rerank=0, exclude=()):
+        """
+        Method that returns the approximate k nearest songs of a vector of scaled features.
+        nprobe is the number of inverted lists scanned (more lists: better recall, slower). With
+        rerank > 0, the best rerank candidates of the PQ distances are sorted again with the exact
+        distances (needs the stored vectors).
+        Output: a list of tuples (song_id, squared distance), closest first.
+        """
+        features = np.asarray(features, dtype=np.float32).ravel()
+        centroid_distances = ((self.centroids - features) ** 2).sum(axis=1)
+        probes = np.argsort(centroid_distances, kind="stable")[:nprobe]
+
+        all_positions = []
+        all_distances = []
+        all_vectors = []
+        for list_number in probes:
+            ids, codes, vectors = self.inverted_list(list_number)
+            if len(codes) == 0:
+                continue
+            residual = features - self.centroids[list_number]
+            distances = np.zeros(len(codes), dtype=np.float32)
+            for subspace, codebook in enumerate(self.codebooks):
+                start, end = self.subspaces[subspace], self.subspaces[subspace + 1]
+                table = ((codebook - residual[start:end]) ** 2).sum(axis=1)
+                distances += table[codes[:, subspace]]
+            all_positions.append(ids)
+            all_distances.append(distances)
+            if vectors is not None:
+                all_vectors.append(vectors)
+
+        if all_positions == []:
+            return []
+
+        positions = np.concatenate(all_positions)
+        distances = np.concatenate(all_distances)
+        wanted = min(max(k + len(exclude), rerank), len(distances))
+        best = np.argpartition(distances, wanted - 1)[:wanted] if wanted < len(distances) else np.arange(len(distances))
+
+        if rerank > 0 and self.list_vectors is not None:
+            difference = np.concatenate(all_vectors)[best] - features
+            distances = np.einsum("ij,ij->i", difference, difference)
+        else:
+            distances = distances[best]
+        positions = positions[best]
+
+        results = []
+        for position in np.lexsort((positions, distances)):
+            song_id = self.song_ids[positions[position]]
+            if song_id in exclude:
+                continue
+            results.append((song_id, float(distances[position])))
+            if len(results) == k:
+                break
+
+        return results
+
+    def save(self, path="music_ann.npz"):
+        lists = [self.inverted_list(list_number) for list_number in range(len(self.centroids))]
+        arrays = {"centroids": self.centroids, "list_sizes": self.list_sizes,
+                  "list_ids": np.concatenate([ids for ids, codes, vectors in lists]),
+                  "list_codes": np.concatenate([codes for ids, codes, vectors in lists]),
+                  "song_ids": np.asarray(self.song_ids, dtype=str)}
+        for subspace, codebook in enumerate(self.codebooks):
+            arrays[f"codebook_{subspace}"] = codebook
+        if self.list_vectors is not None:
+            arrays["list_vectors"] = np.concatenate([vectors for ids, codes, vectors in lists])
+
+        meta = {"version": ANN_FORMAT_VERSION, "n_subspaces": len(self.codebooks), "n_songs": len(self.song_ids)}
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+        return path
+
+
+def load_ann_index(path="music_ann.npz"):
+    """
+    Function that loads an index saved with IVFPQIndex.save.
+    Output: the IVFPQIndex, or None if the file doesn't exist.
+    """
+    try:
+        data = np.load(path)
+    except FileNotFoundError:
+        return None
+
+    with data:
+        meta = json.loads(str(data["meta"]))
+        if meta["version"] != ANN_FORMAT_VERSION:
+            raise ValueError(f"ANN index format version {meta['version']} not supported (expected {ANN_FORMAT_VERSION}).")
+
+        bounds = np.cumsum(np.concatenate([[0], data["list_sizes"]]))
+
+        def split(array):
+            return [array[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        list_vectors = split(data["list_vectors"]) if "list_vectors" in data else None
+        codebooks = [data[f"codebook_{subspace}"] for subspace in range(meta["n_subspaces"])]
+
+        return IVFPQIndex(data["centroids"], codebooks, split(data["list_ids"]), split(data["list_codes"]),
+                          data["song_ids"].tolist(), list_vectors)
+
+
+def build_ann_index(model, index, path="music_ann.npz", **train_kwargs):
+    """
+    Function that creates the ANN index of the songs of a recommendation index (see
+    clustering_music.create_index), with the centroids of the model as coarse quantizer, and saves it.
+    """
+    ann = IVFPQIndex.train(model[-1].cluster_centers_, index["features"], index["song_ids"], **train_kwargs)
+    ann.save(path)
+    print(f"ANN index with {len(ann)} songs saved in {path}")
+
+    return ann
+
+
+def exact_neighbours(features, scaled, k=10):
+    """
+    Function that returns the rows of the exact k nearest neighbours of each query (brute force),
+    to measure the recall of the approximate search.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    scaled = np.asarray(scaled, dtype=np.float32)
+    distances = np.einsum("ij,ij->i", scaled, scaled)[None, :] - 2 * features @ scaled.T
+    best = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, best, axis=1).argsort(axis=1)
+    return np.take_along_axis(best, order, axis=1)
@@ -0,0 +1,168 @@
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import catalog
+
+TABLE_VERSION = 1
+
+#Songs whose neighbours are computed in each task (the distances matrix is QUERY_BLOCK x cluster size)
+QUERY_BLOCK = 256
+
+#Scaled features of the catalog in each worker process, memory mapped by load_worker_catalog
+_worker_features = None
+
+
+def load_worker_catalog(catalog_path):
+    global _worker_features
+    _worker_features = catalog.load_catalog(path=catalog_path)["scaled"]
+
+
+def cluster_tasks(clusters, block=QUERY_BLOCK):
+    """
+    Function that splits the catalog (sorted by cluster) in tasks: blocks of songs of a cluster,
+    with the (start, end) rows of the whole cluster, which are the candidates of their neighbours.
+    """
+    clusters = np.asarray(clusters)
+    tasks = []
+    for cluster in np.unique(clusters):
+        start, end = (int(row) for row in np.searchsorted(clusters, [cluster, cluster + 1]))
+        for query_start in range(start, end, block):
+            tasks.append((query_start, min(query_start + block, end), start, end))
+    return tasks
+
+
+def block_neighbours(task, k):
+    """
+    Function that finds the k closest songs of a block of songs inside their cluster (without the
+    song itself). Ties are broken by the row, like recommender.nearest_songs.
+    Output: the first row of the block, the neighbour rows (-1 if the cluster has less than k + 1
+    songs) and their squared distances (inf for the missing ones).
+    """
+    query_start, query_end, start, end = task
+    candidates = np.asarray(_worker_features[start:end], dtype=np.float32)
+    queries = candidates[query_start - start:query_end - start]
+
+    norms = np.einsum("ij,ij->i", candidates, candidates)
+    distances = norms[query_start - start:query_end - start, None] + norms[None, :] - 2 * queries @ candidates.T
+    np.maximum(distances, 0, out=distances)
+    distances[np.arange(len(queries)), np.arange(query_start - start, query_end - start)] = np.inf
+
+    n_neighbours = min(k, end - start - 1)
+    neighbours = np.full((len(queries), k), -1, dtype=np.int32)
+    scores = np.full((len(queries), k), np.inf, dtype=np.float32)
+    if n_neighbours > 0:
+        #We only sort the closest songs, plus a margin so the ties at the kth distance are kept
+        kept = min(n_neighbours + 8, end - start)
+        columns = np.argpartition(distances, kept - 1, axis=1)[:, :kept] if kept < end - start \
+            else np.tile(np.arange(end - start), (len(queries), 1))
+        kept_distances = np.take_along_axis(distances, columns, axis=1)
+        order = np.lexsort((columns, kept_distances), axis=1)[:, :n_neighbours]
+        neighbours[:, :n_neighbours] = np.take_along_axis(columns, order, axis=1) + start
+        scores[:, :n_neighbours] = np.take_along_axis(kept_distances, order, axis=1)
+
+    return query_start, neighbours, scores
+
+
+def _block_neighbours(args):
+    return block_neighbours(*args)
+
+
+def build_table(catalog_path="catalog", path="recommendations", k=10, workers=None, block=QUERY_BLOCK):
+    """
+    Function that precomputes the k most similar songs of every song of a clustered catalog (see
+    catalog.build_catalog), searching in the cluster of each song like recommend_spotify_songs with
+    mode="nearest". The clusters are split in blocks of songs that a process pool computes; the
+    workers share the memory mapped scaled features of the catalog, and the results are written
+    to the memory mapped table as they arrive, so the whole table is never in memory.
+    The table is a directory with:
+    - song_ids.npy: the ids of the songs, in the order of the catalog,
+    - neighbours.npy: int32 matrix with the rows of the k neighbours of each song (-1 if missing),
+    - scores.npy: float32 matrix with their squared distances in the scaled space (closest first),
+    - meta.json with the version, k and the number of songs.
+    Output: the directory.
+    """
+    songs_catalog = catalog.load_catalog(path=catalog_path)
+    if not songs_catalog["meta"]["clustered"]:
+        raise ValueError("The catalog has no clusters. Build it with the model.")
+
+    n_songs = songs_catalog["meta"]["n_songs"]
+    tasks = cluster_tasks(songs_catalog["clusters"], block=block)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "song_ids.npy"), np.asarray(songs_catalog["song_ids"]))
+    neighbours = np.lib.format.open_memmap(os.path.join(path, "neighbours.npy"), mode="w+", dtype=np.int32,
+                                           shape=(n_songs, k))
+    scores = np.lib.format.open_memmap(os.path.join(path, "scores.npy"), mode="w+", dtype=np.float32,
+                                       shape=(n_songs, k))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_worker_catalog,
+                             initargs=(catalog_path,)) as executor:
+        for query_start, block_rows, block_scores in executor.map(_block_neighbours, [(task, k) for task in tasks],
+                                                                  chunksize=4):
+            neighbours[query_start:query_start + len(block_rows)] = block_rows
+            scores[query_start:query_start + len(block_rows)] = block_scores
+
+    neighbours.flush()
+    scores.flush()
+    del neighbours, scores
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"version": TABLE_VERSION, "k": k, "n_songs": n_songs}, f)
+
+    print(f"Recommendations table with the {k} closest songs of {n_songs} songs saved in {path}")
+
+    return path
+
+
+class RecommendationTable:
+    """
+    Precomputed recommendations created by build_table, memory mapped so loading is almost free.
+    """
+
+    def __init__(self, path="recommendations", mmap_mode="r"):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != TABLE_VERSION:
+            raise ValueError(f"Table version {self.meta['version']} not supported (expected {TABLE_VERSION}).")
+
+        self.k = self.meta["k"]
+        self.song_ids = np.load(os.path.join(path, "song_ids.npy"), mmap_mode=mmap_mode)
+        self.neighbours = np.load(os.path.join(path, "neighbours.npy"), mmap_mode=mmap_mode)
+        self.scores = np.load(os.path.join(path, "scores.npy"), mmap_mode=mmap_mode)
+        self.rows = {song_id: row for row, song_id in enumerate(self.song_ids.tolist())}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, song_id):
+        return song_id in self.rows
+
+    def matches(self, index):
+        """
+        Method that checks if the table was built with the same songs as a recommendation index.
+        """
+        return len(self.rows) == len(index["song_row"]) and self.rows.keys() == index["song_row"].keys()
+
+    def lookup(self, song_id, n=None):
+        """
+        Method that returns the precomputed neighbours of a song.
+        Output: a list of tuples (song_id, squared distance), closest first (empty if the song is not in the table).
+        """
+        row = self.rows.get(song_id)
+        if row is None:
+            return []
+
+        n = self.k if n is None else min(n, self.k)
+        return [(str(self.song_ids[neighbour]), float(score))
+                for neighbour, score in zip(self.neighbours[row, :n], self.scores[row, :n]) if neighbour >= 0]
+
+
+def main():
+    build_table(catalog_path="catalog", path="recommendations", k=10)
+
+    return 0
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,417 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+import platform
+import random
+import tempfile
+import tracemalloc
+import subprocess
+import sys
+from contextlib import redirect_stdout
+from io import StringIO
+from difflib import get_close_matches
+from time import perf_counter
+import recommender
+import clustering_music
+from title_index import TitleIndex
+import light_model
+import ann_index
+import catalog
+import spotify_helper_functions
+import spotify_scraper
+from fake_spotify import FakeSpotify
+
+#Words used to create the names of the synthetic songs and artists
+WORDS = ["love", "night", "baby", "heart", "fire", "dance", "dream", "sky", "road", "money", "girl", "boy",
+         "time", "light", "rain", "summer", "blue", "wild", "gold", "star", "city", "river", "ghost", "sugar",
+         "midnight", "paradise", "stranger", "electric", "forever", "tonight", "home", "lonely", "crazy",
+         "young", "free", "world", "moon", "ocean", "angel", "thunder"]
+
+
+def latency_summary(latencies):
+    """
+    Function that summarises a list of latencies (in seconds).
+    Output: a dictionary with the number of calls and the mean, p50 and p99 latencies in milliseconds.
+    """
+    if len(latencies) == 0:
+        return {"calls": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p99_ms": 0.0}
+    latencies_ms = np.array(latencies) * 1000
+    return {"calls": len(latencies_ms), "mean_ms": float(latencies_ms.mean()),
+            "p50_ms": float(np.percentile(latencies_ms, 50)), "p99_ms": float(np.percentile(latencies_ms, 99))}
+
+
+def bench_recommender(n_queries=1000, n=5, seed=0, **recommender_kwargs):
+    """
+    Function that compares the cost of starting the recommender (loading the datasets, the model
+    and the index, which song_recommender used to pay on every call) with the latency of
+    match + recommend queries answered by an already loaded Recommender.
+    Input: the number of queries, the number of recommendations per query and the arguments
+    for the Recommender (paths, spotify connection).
+    Output: a dictionary with the cold start time and the warm latencies.
+    """
+    t0 = perf_counter()
+    reco = recommender.Recommender(**recommender_kwargs)
+    cold_start = perf_counter() - t0
+
+    #The queries are names from the catalog, so they are answered without calling Spotify
+    rng = random.Random(seed)
+    queries = rng.choices(reco.spotify_index.names, k=n_queries)
+
+    match_latencies = []
+    recommend_latencies = []
+    for query in queries:
+        t0 = perf_counter()
+        song_ids = reco.match(query)["spotify_songs"]
+        match_latencies.append(perf_counter() - t0)
+
+        if song_ids:
+            t0 = perf_counter()
+            reco.recommend(song_ids[0], n=n)
+            recommend_latencies.append(perf_counter() - t0)
+
+    results = {"cold_start_ms": cold_start * 1000,
+               "match": latency_summary(match_latencies),
+               "recommend": latency_summary(recommend_latencies)}
+
+    print(f"Cold start: {results['cold_start_ms']:.1f} ms")
+    for name in ["match", "recommend"]:
+        summary = results[name]
+        print(f"Warm {name}: {summary['calls']} calls, mean = {summary['mean_ms']:.3f} ms, "
+              f"p50 = {summary['p50_ms']:.3f} ms, p99 = {summary['p99_ms']:.3f} ms")
+
+    return results
+
+
+def typo_queries(names, n_queries=500, seed=0):
+    """
+    Function that creates queries from a list of names, changing, deleting or inserting
+    a few characters so some of them are close matches and some are not.
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz "
+    queries = []
+
+    for name in rng.choices(list(names), k=n_queries):
+        query = list(name)
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(query))
+            operation = rng.choice(["change", "delete", "insert"])
+            if operation == "insert" or position == len(query):
+                query.insert(position, rng.choice(letters))
+            elif operation == "delete":
+                del query[position]
+            else:
+                query[position] = rng.choice(letters)
+        queries.append("".join(query))
+
+    return queries
+
+
+def check_title_index_recall(names, queries=None, n=3, cutoff=0.90):
+    """
+    Function that checks that the TitleIndex returns the same matches as the linear
+    difflib.get_close_matches scan over the distinct names, and compares their latencies.
+    Input: the list of names, the queries (typo_queries(names) if not given), n and the cutoff.
+    Output: a dictionary with the recall, the queries with different results and the latencies.
+    """
+    distinct_names = list(dict.fromkeys(names))
+    if queries is None:
+        queries = typo_queries(distinct_names)
+
+    t0 = perf_counter()
+    index = TitleIndex(distinct_names)
+    build_time = perf_counter() - t0
+
+    expected_total = 0
+    found_total = 0
+    mismatches = []
+    linear_latencies = []
+    index_latencies = []
+
+    for query in queries:
+        t0 = perf_counter()
+        expected = get_close_matches(query, distinct_names, n=n, cutoff=cutoff)
+        linear_latencies.append(perf_counter() - t0)
+
+        t0 = perf_counter()
+        found = index.search(query, n=n, cutoff=cutoff)
+        index_latencies.append(perf_counter() - t0)
+
+        expected_total += len(expected)
+        found_total += len(set(expected) & set(found))
+        if found != expected:
+            mismatches.append((query, expected, found))
+
+    results = {"recall": found_total / expected_total if expected_total else 1.0,
+               "mismatches": mismatches, "build_ms": build_time * 1000,
+               "linear": latency_summary(linear_latencies), "index": latency_summary(index_latencies)}
+
+    print(f"Title index recall = {results['recall']:.4f} ({len(mismatches)} queries with different results)")
+    for name in ["linear", "index"]:
+        summary = results[name]
+        print(f"{name.capitalize()} matching: mean = {summary['mean_ms']:.3f} ms, p99 = {summary['p99_ms']:.3f} ms")
+
+    return results
+
+
+def bench_incremental_training(path="spotify_songs.csv", n_clusters=20, chunksize=10000):
+    """
+    Function that compares the full batch model (create_model, with the whole csv in memory) with the
+    incremental one (create_model_incremental, reading chunks): fit time, peak python memory and inertia
+    over the same dataset.
+    Output: a dictionary with the results of each mode.
+    """
+    results = {}
+
+    tracemalloc.start()
+    df = clustering_music.import_df(path=path)
+    modeling_df = df.drop(columns=["song_name", "song_id", "artist_name", "artist_id"])
+    model, inertia, fit_time = clustering_music.create_model(modeling_df, n_clusters=n_clusters)
+    results["full_batch"] = {"inertia": inertia, "fit_time": fit_time, "peak_mb": tracemalloc.get_traced_memory()[1] / 2**20}
+    tracemalloc.stop()
+    del df, modeling_df
+
+    tracemalloc.start()
+    model, inertia, fit_time = clustering_music.create_model_incremental(path=path, n_clusters=n_clusters,
+                                                                       chunksize=chunksize)
+    results["incremental"] = {"inertia": inertia, "fit_time": fit_time, "peak_mb": tracemalloc.get_traced_memory()[1] / 2**20}
+    tracemalloc.stop()
+
+    for name, result in results.items():
+        print(f"{name}: inertia = {result['inertia']:.2f}, fit_time = {result['fit_time']:.3f} s, "
+              f"peak memory = {result['peak_mb']:.1f} MB")
+    print(f"Inertia ratio (incremental / full batch) = {results['incremental']['inertia'] / results['full_batch']['inertia']:.3f}")
+
+    return results
+
+
+def check_light_model_parity(model, modeling_df, light=None):
+    """
+    Function that checks that the pure NumPy model gives the same clusters as the sklearn pipeline,
+    for the whole dataset at once and for single rows.
+    Input: the sklearn pipeline, the modeling dataframe and the LightModel (exported from the pipeline if not given).
+    Output: the number of songs with a different cluster (0 if they match exactly).
+    """
+    if light is None:
+        light = light_model.LightModel(model[0].mean_, model[0].scale_, model[-1].cluster_centers_)
+
+    expected = model.predict(modeling_df)
+    mismatches = int((light.predict(modeling_df) != expected).sum())
+
+    for position in range(min(100, len(modeling_df))):
+        if light.predict(modeling_df.iloc[position].to_numpy())[0] != expected[position]:
+            mismatches += 1
+
+    print(f"Light model parity: {mismatches} different clusters out of {len(modeling_df)} songs")
+
+    return mismatches
+
+
+def bench_startup(model_path="music_model.pkl", light_model_path="music_model.npz", repeat=3):
+    """
+    Function that measures, in fresh processes, the time to import what is needed and load each model:
+    the sklearn pickle (through clustering_music, which also imports matplotlib) and the exported .npz.
+    Output: a dictionary with the best time of each one, in milliseconds.
+    """
+    scripts = {"pickle": f"import clustering_music; clustering_music.load_model(path={model_path!r})",
+               "npz": f"import light_model; light_model.load_model(path={light_model_path!r})"}
+    results = {}
+
+    for name, script in scripts.items():
+        timed = f"from time import perf_counter; t0 = perf_counter(); {script}; print(perf_counter() - t0)"
+        times = [float(subprocess.run([sys.executable, "-c", timed], capture_output=True, text=True,
+                                      check=True).stdout.split()[-1]) for _ in range(repeat)]
+        results[name] = min(times) * 1000
+        print(f"Startup with the {name} model: {results[name]:.1f} ms")
+
+    return results
+
+
+def synthetic_catalog(n_songs, n_artists=None, seed=0):
+    """
+    Function that creates a random songs dataframe with the same columns as spotify_songs.csv.
+    Names are made of 1 to 4 words (and a number for part of the songs), and the features follow
+    the ranges that Spotify uses.
+    """
+    rng = np.random.default_rng(seed)
+    n_artists = n_artists if n_artists is not None else max(1, n_songs // 10)
+    words = np.array(WORDS)
+
+    n_words = rng.integers(1, 5, n_songs)
+    word_choices = rng.integers(0, len(words), (n_songs, 4))
+    numbers = rng.integers(0, 1000, n_songs)
+    song_names = [" ".join(words[word_choices[row, :n_words[row]]]) + (f" {numbers[row]}" if numbers[row] < 300 else "")
+                  for row in range(n_songs)]
+    artists = rng.integers(0, n_artists, n_songs)
+
+    return pd.DataFrame(data={"song_name": song_names,
+                              "song_id": [f"synth{row:016d}" for row in range(n_songs)],
+                              "artist_name": [f"artist {artist}" for artist in artists],
+                              "artist_id": [f"synthartist{artist:011d}" for artist in artists],
+                              "danceability": rng.random(n_songs), "energy": rng.random(n_songs),
+                              "key": rng.integers(0, 12, n_songs), "loudness": rng.normal(-8, 3, n_songs),
+                              "mode": rng.integers(0, 2, n_songs), "speechiness": rng.random(n_songs) * 0.3,
+                              "acousticness": rng.random(n_songs), "instrumentalness": rng.random(n_songs) * 0.5,
+                              "liveness": rng.random(n_songs) * 0.5, "valence": rng.random(n_songs),
+                              "tempo": rng.normal(120, 25, n_songs)})
+
+
+def timed(function, *args, **kwargs):
+    """
+    Function that calls a function without printing its output.
+    Output: a tuple with the result and the time in seconds.
+    """
+    with redirect_stdout(StringIO()):
+        t0 = perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = perf_counter() - t0
+    return result, elapsed
+
+
+def bench_catalog_size(n_songs, directory, n_queries=200, n_legacy_queries=5, n_clusters=20, seed=0):
+    """
+    Function that times the hot paths for a synthetic catalog of n_songs songs: csv and .npy catalog
+    loads, create_model, the linear is_similar/is_spotify_song and the TitleIndex matches, and the
+    legacy recommend_spotify_song (which predicts the whole catalog) against the warm Recommender.
+    Output: a dictionary with the results.
+    """
+    rng = random.Random(seed)
+    results = {"n_songs": n_songs}
+
+    csv_path = os.path.join(directory, "spotify_songs.csv")
+    synthetic_catalog(n_songs, seed=seed).to_csv(csv_path)
+
+    spotify_df, results["import_spotify_df_s"] = timed(recommender.import_spotify_df, path=csv_path)
+    modeling_df = spotify_df.drop(columns=["song_name", "song_id", "artist_name", "artist_id"])
+    (model, inertia, fit_time), results["create_model_s"] = timed(clustering_music.create_model, modeling_df,
+                                                                  n_clusters=n_clusters)
+
+    catalog_path = os.path.join(directory, "catalog")
+    _, results["build_catalog_s"] = timed(catalog.build_catalog, spotify_df, model=model, path=catalog_path)
+    songs_catalog, results["load_catalog_s"] = timed(catalog.load_catalog, path=catalog_path)
+    _, results["catalog_index_s"] = timed(catalog.catalog_index, songs_catalog)
+
+    queries = rng.choices(spotify_df["song_name"].tolist(), k=n_queries)
+    legacy_queries = queries[:n_legacy_queries]
+
+    latencies = [timed(recommender.is_spotify_song, query, spotify_df)[1] for query in legacy_queries]
+    results["is_spotify_song"] = latency_summary(latencies)
+
+    title_index, results["title_index_build_s"] = timed(TitleIndex, spotify_df["song_name"], spotify_df["song_id"])
+    latencies = [timed(title_index.lookup, query)[1] for query in queries]
+    results["title_index_lookup"] = latency_summary(latencies)
+
+    song_ids = rng.choices(spotify_df["song_id"].tolist(), k=n_queries)
+    latencies = [timed(recommender.recommend_spotify_song, song_id, spotify_df, model, None)[1]
+                 for song_id in song_ids[:n_legacy_queries]]
+    results["recommend_spotify_song"] = latency_summary(latencies)
+
+    index, results["create_index_s"] = timed(clustering_music.create_index, model, spotify_df)
+    for mode in ["random", "nearest"]:
+        latencies = [timed(recommender.recommend_spotify_songs, song_id, spotify_df, model, None, index,
+                           n=5, verbose=False, mode=mode)[1] for song_id in song_ids]
+        results[f"recommend_{mode}"] = latency_summary(latencies)
+
+    results["ann"] = bench_ann(model, index, n_queries=min(n_queries, 100))
+
+    return results
+
+
+def bench_ann(model, index, n_queries=200, k=10, nprobes=(1, 2, 4, 8), reranks=(0, 100), seed=0, **train_kwargs):
+    """
+    Function that measures the recall@k and the latency of the ANN index for several probe counts
+    and rerank sizes, against a brute force search over the whole catalog.
+    Output: a dictionary with the build time, the brute force latency and the results of each setting.
+    """
+    rng = np.random.default_rng(seed)
+    features = index["features"]
+    queries = rng.choice(len(features), size=min(n_queries, len(features)), replace=False)
+    song_ids = np.asarray(index["song_ids"], dtype=object)
+
+    ann, build_time = timed(ann_index.IVFPQIndex.train, model[-1].cluster_centers_, features, index["song_ids"],
+                            **train_kwargs)
+
+    #The exact neighbours, without the song itself
+    t0 = perf_counter()
+    exact_rows = ann_index.exact_neighbours(features[queries], features, k=k + 1)
+    brute_force_ms = (perf_counter() - t0) / len(queries) * 1000
+    exact = [set(song_ids[rows[rows != query]][:k]) for query, rows in zip(queries, exact_rows)]
+
+    results = {"build_s": build_time, "brute_force_ms": brute_force_ms, "settings": []}
+    for nprobe in nprobes:
+        for rerank in reranks:
+            latencies = []
+            hits = 0
+            for query, exact_ids in zip(queries, exact):
+                t0 = perf_counter()
+                approximate = ann.search(features[query], k=k, nprobe=nprobe, rerank=rerank,
+                                         exclude={song_ids[query]})
+                latencies.append(perf_counter() - t0)
+                hits += len(exact_ids.intersection(song_id for song_id, distance in approximate))
+            results["settings"].append(dict({"nprobe": nprobe, "rerank": rerank, f"recall@{k}": hits / (k * len(queries))},
+                                            **latency_summary(latencies)))
+
+    return results
+
+
+def bench_crawl(directory, max_artists=500, workers=8, spotify_latency=0.01):
+    """
+    Function that times the extend_df crawl loop against FakeSpotify (answering after spotify_latency
+    seconds), and counts the requests of each endpoint.
+    """
+    fake = FakeSpotify(latency=spotify_latency)
+    seed_df = pd.DataFrame(data=[dict({"song_name": "seed", "song_id": "seed", "artist_name": "Artist 0",
+                                       "artist_id": fake.artist_id(0)},
+                                      **{column: 0.0 for column in spotify_helper_functions.SELECTED_FEATURES})])
+
+    df, elapsed = timed(spotify_scraper.extend_df, seed_df, save_path=os.path.join(directory, "final_df.csv"),
+                        max_depth=3, max_artists=max_artists, workers=workers, requests_per_second=10000,
+                        sp=fake, checkpoint_path=os.path.join(directory, "crawl_checkpoint.db"),
+                        registry_path=os.path.join(directory, "spotify_registry.db"))
+
+    return {"max_artists": max_artists, "songs": len(df), "extend_df_s": elapsed, "requests": dict(fake.calls)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes=(10000, 100000, 1000000), output_path="bench_results.json", **kwargs):
+    """
+    Function that runs the benchmarks for synthetic catalogs of each size and the crawl benchmark,
+    and writes the results as json (with the commit and the python version) so they can be compared
+    between commits.
+    Output: the results dictionary.
+    """
+    results = {"commit": git_commit(), "python": platform.python_version(), "catalogs": [], "crawl": None}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n_songs in sizes:
+            print(f"Benchmarking a catalog of {n_songs} songs...")
+            results["catalogs"].append(bench_catalog_size(n_songs, directory, **kwargs))
+        print("Benchmarking the crawl...")
+        #The crawl uses the helpers cache, so it starts empty
+        spotify_helper_functions.spotify_cache.configure()
+        results["crawl"] = bench_crawl(directory)
+
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved in {output_path}")
+
+    return results
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000]
+    run_suite(sizes=sizes)
+
+    return 0
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,150 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import metrics
+
+CATALOG_VERSION = 1
+
+ID_COLUMNS = ["song_name", "song_id", "artist_name", "artist_id"]
+
+
+def build_catalog(df, model=None, path="catalog"):
+    """
+    Function that converts the songs dataframe into a directory of .npy files that can be
+    loaded without parsing the csv:
+    - features.npy: float32 matrix with the audio features,
+    - song_ids.npy and song_names.npy (lowercase) as fixed width strings,
+    - artist_codes.npy: int32 code of the artist of each song, and artist_ids.npy / artist_names.npy
+      (lowercase) with the artists of each code,
+    - if the model is given, clusters.npy (int32 cluster of each song) and scaled.npy (float32
+      scaled features). The songs are then sorted by cluster, like the recommendation index.
+    - meta.json with the version, the number of songs and the feature names.
+    Input: the songs dataframe, optionally the fitted model, and the directory.
+    Output: the directory.
+    """
+    df = df.drop_duplicates(subset="song_id").reset_index(drop=True)
+    feature_columns = [column for column in df.columns if column not in ID_COLUMNS]
+    features = df[feature_columns].to_numpy(dtype=np.float32)
+
+    order = np.arange(len(df))
+    if model is not None:
+        clusters = model.predict(df[feature_columns]).astype(np.int32)
+        #Stable sort, so the songs keep the dataset order inside each cluster
+        order = np.argsort(clusters, kind="stable")
+        clusters = clusters[order]
+        scaled = model[:-1].transform(df[feature_columns]).astype(np.float32)[order]
+
+    df = df.iloc[order].reset_index(drop=True)
+    features = np.ascontiguousarray(features[order])
+    artist_codes, artist_ids = pd.factorize(df["artist_id"])
+    artist_names = df.groupby(artist_codes)["artist_name"].first().str.lower()
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "features.npy"), features)
+    np.save(os.path.join(path, "song_ids.npy"), df["song_id"].to_numpy(dtype=str))
+    np.save(os.path.join(path, "song_names.npy"), df["song_name"].str.lower().to_numpy(dtype=str))
+    np.save(os.path.join(path, "artist_codes.npy"), artist_codes.astype(np.int32))
+    np.save(os.path.join(path, "artist_ids.npy"), np.asarray(artist_ids, dtype=str))
+    np.save(os.path.join(path, "artist_names.npy"), artist_names.to_numpy(dtype=str))
+    if model is not None:
+        np.save(os.path.join(path, "clusters.npy"), clusters)
+        np.save(os.path.join(path, "scaled.npy"), np.ascontiguousarray(scaled))
+
+    meta = {"version": CATALOG_VERSION, "n_songs": len(df), "feature_columns": feature_columns,
+            "clustered": model is not None}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    print(f"Catalog with {len(df)} songs saved in {path}")
+
+    return path
+
+
+@metrics.timed("load_catalog")
+def load_catalog(path="catalog", mmap_mode="r"):
+    """
+    Function that loads a catalog created by build_catalog. With mmap_mode="r" the arrays are memory
+    mapped, so loading is almost free and several processes share the same pages.
+    Output: a dictionary with the meta information and the arrays (without the .npy extension).
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    if meta["version"] != CATALOG_VERSION:
+        raise ValueError(f"Catalog version {meta['version']} not supported (expected {CATALOG_VERSION}).")
+
+    names = ["features", "song_ids", "song_names", "artist_codes", "artist_ids", "artist_names"]
+    if meta["clustered"]:
+        names += ["clusters", "scaled"]
+
+    catalog = {"meta": meta}
+    for name in names:
+        catalog[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+    return catalog
+
+
+def catalog_features_df(catalog):
+    """
+    Function that returns the features of a catalog as a dataframe, with the same columns that
+    the model was trained with.
+    """
+    return pd.DataFrame(data=catalog["features"], columns=catalog["meta"]["feature_columns"])
+
+
+def catalog_df(catalog):
+    """
+    Function that rebuilds the songs dataframe (with lowercase names, like recommender.import_spotify_df).
+    """
+    artist_codes = np.asarray(catalog["artist_codes"])
+    df = pd.DataFrame(data={"song_name": catalog["song_names"], "song_id": catalog["song_ids"],
+                            "artist_name": catalog["artist_names"][artist_codes],
+                            "artist_id": catalog["artist_ids"][artist_codes]})
+
+    return pd.concat([df, catalog_features_df(catalog)], axis=1)
+
+
+@metrics.timed("catalog_index")
+def catalog_index(catalog):
+    """
+    Function that creates the recommendation index (see clustering_music.create_index) from a
+    clustered catalog, using its memory mapped scaled features instead of calling the model.
+    """
+    if not catalog["meta"]["clustered"]:
+        raise ValueError("The catalog has no clusters. Build it with the model.")
+
+    clusters = np.asarray(catalog["clusters"])
+    song_ids = catalog["song_ids"].tolist()
+    song_names = catalog["song_names"].tolist()
+    artist_names = catalog["artist_names"][np.asarray(catalog["artist_codes"])].tolist()
+    cluster_list = clusters.tolist()
+
+    song_cluster = dict(zip(song_ids, cluster_list))
+    song_row = {song_id: row for row, song_id in enumerate(song_ids)}
+    song_info = dict(zip(song_ids, zip(song_names, artist_names)))
+
+    cluster_songs = {}
+    cluster_slices = {}
+    for cluster in np.unique(clusters):
+        start, end = np.searchsorted(clusters, [cluster, cluster + 1])
+        cluster_slices[int(cluster)] = (int(start), int(end))
+        cluster_songs[int(cluster)] = song_ids[start:end]
+
+    return {"song_cluster": song_cluster, "cluster_songs": cluster_songs, "song_info": song_info,
+            "features": catalog["scaled"], "song_ids": song_ids, "song_row": song_row,
+            "cluster_slices": cluster_slices, "cluster_extra": {}}
+
+
+def main():
+    import clustering_music
+
+    df = clustering_music.import_df(path="spotify_songs.csv")
+    model = clustering_music.load_model(path="music_model.pkl")
+    build_catalog(df, model=model, path="catalog")
+
+    return 0
+
+
+if __name__=="__main__":
+    main()
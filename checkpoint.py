@@ -0,0 +1,99 @@
+import json
+import sqlite3
+import pandas as pd
+
+
+class CheckpointStore:
+    """
+    SQLite store for the crawls of spotify_scraper.extend_df.
+    It keeps the artists found by the crawl (and whether their songs were already added) and the
+    songs scraped so far. Each batch of songs is appended together with the artists it belongs to
+    in a single transaction, so a crawl that stops can be resumed from the last saved batch
+    without rewriting the whole dataset.
+    The parameters of the crawl (seeds, depth...) are stored too, and a crawl is only resumed if it
+    didn't finish and was started with the same parameters.
+    """
+
+    def __init__(self, path="crawl_checkpoint.db", columns=None):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.columns = list(columns) if columns is not None else None
+
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS artists "
+                                    "(artist_id TEXT PRIMARY KEY, artist_name TEXT, crawled INTEGER DEFAULT 0)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS crawl (parameters TEXT, finished INTEGER DEFAULT 0)")
+
+    def close(self):
+        self.connection.close()
+
+    def has_artists(self):
+        return self.connection.execute("SELECT COUNT(*) FROM artists").fetchone()[0] > 0
+
+    def resume(self, parameters):
+        """
+        Method that checks if the store has an unfinished crawl started with the same parameters
+        (a json serializable dictionary). Otherwise the stored crawl is deleted and the new parameters are stored.
+        Output: True if the crawl can be resumed from the stored artists.
+        """
+        parameters = json.dumps(parameters, sort_keys=True)
+        stored = self.connection.execute("SELECT parameters, finished FROM crawl").fetchone()
+        if stored == (parameters, 0):
+            return self.has_artists()
+
+        with self.connection:
+            self.connection.execute("DELETE FROM artists")
+            self.connection.execute("DROP TABLE IF EXISTS songs")
+            self.connection.execute("DELETE FROM crawl")
+            self.connection.execute("INSERT INTO crawl (parameters) VALUES (?)", (parameters,))
+        return False
+
+    def finish(self):
+        """
+        Method that deletes the artists and songs of the crawl (they are in the final dataset by then)
+        and marks it as finished, so the next crawl starts again instead of resuming it.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM artists")
+            self.connection.execute("DROP TABLE IF EXISTS songs")
+            self.connection.execute("UPDATE crawl SET finished = 1")
+
+    def add_artists(self, artists):
+        """
+        Method that stores the artists found by the crawl (dictionary artist_id -> artist_name).
+        Artists already stored are kept as they are.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO artists (artist_id, artist_name) VALUES (?, ?)",
+                                        artists.items())
+
+    def pending_artists(self):
+        """
+        Method that returns the artists whose songs are not stored yet, as a dictionary artist_id -> artist_name.
+        """
+        rows = self.connection.execute("SELECT artist_id, artist_name FROM artists WHERE crawled = 0 ORDER BY rowid")
+        return dict(rows.fetchall())
+
+    def crawled_artists(self):
+        rows = self.connection.execute("SELECT artist_id FROM artists WHERE crawled = 1")
+        return {artist_id for (artist_id,) in rows.fetchall()}
+
+    def save_batch(self, songs_df, artist_ids):
+        """
+        Method that appends a dataframe of songs and marks their artists as crawled, in the same transaction.
+        """
+        with self.connection:
+            if len(songs_df) > 0:
+                songs_df.to_sql("songs", self.connection, if_exists="append", index=False)
+            self.connection.executemany("UPDATE artists SET crawled = 1 WHERE artist_id = ?",
+                                        [(artist_id,) for artist_id in artist_ids])
+
+    def load_songs(self):
+        """
+        Method that returns all the stored songs in a dataframe (with repeated songs, if any).
+        """
+        exists = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'songs'")
+        if exists.fetchone() is None:
+            return pd.DataFrame(columns=self.columns)
+
+        return pd.read_sql("SELECT * FROM songs ORDER BY rowid", self.connection, columns=self.columns)
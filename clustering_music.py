@@ -1,21 +1,40 @@
 import pandas as pd
 import numpy as np
 from time import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import pickle
+import os
+import copy
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.decomposition import PCA
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import make_pipeline
 from sklearn.metrics import silhouette_score, homogeneity_score, completeness_score, \
 v_measure_score, adjusted_rand_score, adjusted_mutual_info_score
 import matplotlib.pyplot as plt
+import light_model
+import song_index
+import ann_index
+import metrics
 
 
+@metrics.timed("import_df")
 def import_df(path="final_df.csv"):
         return pd.read_csv(path, index_col=0)
 
+@metrics.timed("import_catalog")
+def import_catalog(path="catalog"):
+        """
+        Function that loads the features of the songs from the catalog created by catalog.build_catalog,
+        which is much faster than reading the csv.
+        Output: a dataframe with the features (the modeling dataframe, without names or ids).
+        """
+        import catalog
+
+        return catalog.catalog_features_df(catalog.load_catalog(path=path))
+
 def create_model(df, init_algo="k-means++", n_clusters=10, n_init=4):
         scaler = StandardScaler()
         kmeans = KMeans(init=init_algo, n_clusters=n_clusters, n_init=n_init, random_state=0)
@@ -27,10 +46,126 @@ def create_model(df, init_algo="k-means++", n_clusters=10, n_init=4):
         results = (model, model[-1].inertia_, fit_time)
         return results
 
+def import_chunks(path="spotify_songs.csv", chunksize=10000):
+        """
+        Generator that reads the songs csv in chunks and yields their modeling dataframes
+        (without names or ids), so the whole dataset is never in memory.
+        """
+        for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize):
+                yield chunk.drop(columns=["song_name", "song_id", "artist_name", "artist_id"])
+
+def create_model_incremental(path="spotify_songs.csv", n_clusters=20, chunksize=10000, batch_size=1024,
+                             random_state=0):
+        """
+        Function that trains the model reading the csv in chunks: a first pass fits the scaler with
+        partial_fit, and a second pass fits a MiniBatchKMeans with partial_fit on the scaled chunks.
+        The memory needed depends on the chunk size, not on the size of the dataset.
+        Output: the same tuple as create_model (model, inertia, fit_time). The inertia is computed
+        with a third pass over the chunks.
+        """
+        scaler = StandardScaler()
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state)
+        t0 = time()
+        print("Initiating incremental fit...")
+
+        for chunk in import_chunks(path, chunksize=chunksize):
+                scaler.partial_fit(chunk)
+        for chunk in import_chunks(path, chunksize=chunksize):
+                kmeans.partial_fit(scaler.transform(chunk))
+
+        model = make_pipeline(scaler, kmeans)
+        fit_time = time() - t0
+        print(f"Fit ended in {fit_time:.3f} seconds.")
+
+        inertia = streaming_inertia(model, path, chunksize=chunksize)
+        results = (model, inertia, fit_time)
+        return results
+
+def streaming_inertia(model, path="spotify_songs.csv", chunksize=10000):
+        """
+        Function that computes the inertia of a model over the songs csv, reading it in chunks.
+        """
+        return sum(-model.score(chunk) for chunk in import_chunks(path, chunksize=chunksize))
+
+def update_model(model, new_df, cluster_sizes=None):
+        """
+        Function that updates a trained model with newly scraped songs only. The scaler is kept as it is,
+        so the scaled features already stored in the index stay valid, and the centroids are moved with
+        a MiniBatchKMeans partial_fit on the new songs. A full batch KMeans is converted to a
+        MiniBatchKMeans that starts from its centroids, weighted by the number of songs of each cluster,
+        so a few new songs only move the centroids in proportion to the songs they already have.
+        Input: the model (pipeline), the dataframe with the new songs (with names and ids) and optionally
+        the number of songs of each cluster (by default the training labels of the KMeans, or for example
+        the counts of the song_cluster lookup of the index).
+        The model given is not changed: the updated one is a new pipeline (sharing the scaler).
+        Output: the updated model.
+        """
+        scaler, kmeans = model[0], model[-1]
+
+        if isinstance(kmeans, MiniBatchKMeans):
+                kmeans = copy.deepcopy(kmeans)
+        else:
+                centroids = kmeans.cluster_centers_
+                if cluster_sizes is None:
+                        cluster_sizes = np.bincount(kmeans.labels_, minlength=len(centroids))
+                kmeans = MiniBatchKMeans(n_clusters=len(centroids), init=centroids, n_init=1,
+                                         reassignment_ratio=0, random_state=0)
+                #We start the MiniBatchKMeans with the centroids of the full batch model, each one
+                #with the weight of its songs (empty clusters count as one song)
+                kmeans.partial_fit(centroids, sample_weight=np.maximum(cluster_sizes, 1).astype(float))
+
+        modeling_df = new_df.drop(columns=["song_name", "song_id", "artist_name", "artist_id"])
+        kmeans.partial_fit(scaler.transform(modeling_df))
+
+        return make_pipeline(scaler, kmeans)
+
 def evaluate_model():
         return 0
 
-def save_model(model, path="music_model.pkl"):
+@metrics.timed("create_index")
+def create_index(model, df):
+        """
+        Function that assigns a cluster to every song of the catalog, so the recommender doesn't
+        need to predict the whole dataset each time it is asked for a song.
+        It also stores the scaled features of the songs as a contiguous float32 matrix sorted by
+        cluster, so the songs of each cluster are a slice of the matrix.
+        Input: the fitted model and the songs dataframe (with names, ids and features).
+        Output: a dictionary with the song_id -> cluster lookup, the cluster -> [song_ids] lookup,
+        the song_id -> (song_name, artist_name) information, the features matrix, the ids in the
+        order of the matrix, the song_id -> row lookup and the cluster -> (start, end) slices.
+        """
+        #Repeated songs in the dataset are only indexed once
+        df = df.drop_duplicates(subset="song_id")
+
+        modeling_df = df.drop(columns=["song_name", "artist_name", "artist_id", "song_id"])
+        clusters = model.predict(modeling_df)
+        scaled = model[:-1].transform(modeling_df)
+
+        return song_index.assemble_index(df["song_id"], df["song_name"], df["artist_name"], clusters, scaled)
+
+def update_index(index, model, new_df):
+        """
+        Function that adds new songs to a recommendation index (see song_index.update_index).
+        """
+        return song_index.update_index(index, model, new_df)
+
+def save_index(index, path="music_index.pkl"):
+        return song_index.save_index(index, path=path)
+
+def load_index(path="music_index.pkl"):
+        return song_index.load_index(path=path)
+
+def save_model(model, path="music_model.pkl", df=None, index_path="music_index.pkl", export_path=None,
+               ann_path=None):
+        """
+        Function that stores the model in a pickle and writes an entry in model_log.txt.
+        If the songs dataframe is given, the recommendation index (the cluster of each song)
+        is computed once and stored next to the model.
+        If export_path is given, the model is also exported to the .npz format of light_model,
+        which can be served without scikit-learn.
+        If ann_path is given (with the dataframe), the approximate nearest neighbours index of
+        ann_index is built with the songs of the recommendation index.
+        """
         kmeans_model = model[-1]
         save_text = f"Model saved - {kmeans_model}\nInertia = {kmeans_model.inertia_:.2f}\n"
         time_text = str(datetime.now())[:-10] + "h" + "\n"
@@ -41,9 +176,19 @@ def save_model(model, path="music_model.pkl"):
 
         with open("model_log.txt", "a") as f:
                 f.write("--------------\n" + save_text + time_text + file_text)
+
+        if df is not None:
+                index = create_index(model, df)
+                save_index(index, path=index_path)
+                if ann_path is not None:
+                        ann_index.build_ann_index(model, index, path=ann_path)
+
+        if export_path is not None:
+                light_model.export_model(model, path=export_path)
         
         return 0
 
+@metrics.timed("load_model")
 def load_model(path="music_model.pkl"):
 
         try:
@@ -51,115 +196,221 @@ def load_model(path="music_model.pkl"):
                         model = pickle.load(f)
         except FileNotFoundError: 
                 print("Model pickle not found!") 
+                model = None
         
         return model
 
 def cluster_song():
         return 0
 
-def visualise_model(df, init_algo="k-means++", n_clusters=10, n_init=4):
+def closest_centroids(scaled, centers, batch_size=100000):
+        """
+        Function that returns the closest centroid of each scaled row, in batches to bound the memory.
+        """
+        centers_norms = (centers ** 2).sum(axis=1)
+        labels = np.empty(len(scaled), dtype=np.int32)
+        for start in range(0, len(scaled), batch_size):
+                batch = np.asarray(scaled[start:start + batch_size], dtype=np.float64)
+                labels[start:start + batch_size] = (centers_norms - 2 * batch @ centers.T).argmin(axis=1)
+        return labels
+
+def cluster_statistics(scaled, labels, centers):
+        """
+        Function that returns the size and spread of each cluster: number and share of songs, and
+        the mean, standard deviation and maximum distance of its songs to the centroid (in scaled units).
+        """
+        distances = np.sqrt(((scaled - centers[labels]) ** 2).sum(axis=1))
+        stats = pd.DataFrame({"cluster": labels, "distance": distances}).groupby("cluster")["distance"] \
+                .agg(size="size", mean_distance="mean", std_distance="std", max_distance="max")
+        stats = stats.reindex(range(len(centers)), fill_value=0)
+        stats.insert(1, "share", stats["size"] / len(labels))
+
+        return stats.reset_index()
+
+def cluster_diagnostics(model, df, sample_size=20000, resolution=300, path="figures/clusters_pca.png",
+                        stats_path="figures/cluster_stats.csv", sizes_path="figures/cluster_sizes.png",
+                        show=False, random_state=0):
+        """
+        Function that checks the served model: the statistics of each cluster are computed with all the
+        songs, and a 2D view is drawn with one PCA fitted on (a sample of) the scaled songs.
+        The background shows the decision regions of the real centroids on the PCA plane: a grid of
+        resolution x resolution points is mapped back to the scaled space and assigned to the closest
+        centroid. The figures and the statistics are saved without showing anything (unless show is True),
+        so it can run in the training job.
+        Input: the fitted model (pipeline or light_model.LightModel) and the modeling dataframe.
+        Output: the dataframe with the statistics of each cluster.
+        """
+        centers = np.asarray(model[-1].cluster_centers_, dtype=np.float64)
+        scaled = model[:-1].transform(df)
+        labels = closest_centroids(scaled, centers)
+
+        stats = cluster_statistics(scaled, labels, centers)
+        for file_path in [path, stats_path, sizes_path]:
+                if os.path.dirname(file_path):
+                        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        stats.to_csv(stats_path, index=False)
+
+        #Large catalogs are subsampled for the PCA and the scatter plot
+        rng = np.random.default_rng(random_state)
+        sample = rng.choice(len(scaled), size=sample_size, replace=False) if len(scaled) > sample_size \
+                else np.arange(len(scaled))
+        pca = PCA(n_components=2, random_state=random_state).fit(scaled[sample])
+        reduced_data = pca.transform(scaled[sample])
+        reduced_centers = pca.transform(centers)
 
-        reduced_data = PCA(n_components=2).fit_transform(df)
-        kmeans = KMeans(init=init_algo, n_clusters=n_clusters, n_init=n_init, random_state=0)
-        kmeans.fit(reduced_data)
-
-        # Step size of the mesh. Decrease to increase the quality of the VQ.
-        h = .02     # point in the mesh [x_min, x_max]x[y_min, y_max].
-
-        # Plot the decision boundary. For that, we will assign a color to each
         x_min, x_max = reduced_data[:, 0].min() - 1, reduced_data[:, 0].max() + 1
         y_min, y_max = reduced_data[:, 1].min() - 1, reduced_data[:, 1].max() + 1
-        xx, yy = np.meshgrid(np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
-
-        # Obtain labels for each point in mesh. Use last trained model.
-        Z = kmeans.predict(np.c_[xx.ravel(), yy.ravel()])
-
-        # Put the result into a color plot
-        Z = Z.reshape(xx.shape) 
-        plt.figure(1)
-        plt.clf()
-        plt.imshow(Z, interpolation="nearest",
-                   extent=(xx.min(), xx.max(), yy.min(), yy.max()),
-                   cmap=plt.cm.Paired, aspect="auto", origin="lower")
-
-        plt.plot(reduced_data[:, 0], reduced_data[:, 1], 'k.', markersize=2)
-        # Plot the centroids as a white X
-        centroids = kmeans.cluster_centers_
-        plt.scatter(centroids[:, 0], centroids[:, 1], marker="x", s=169, linewidths=3,
-                    color="w", zorder=10)
-        plt.title("K-means clustering on the songs dataset (PCA-reduced data)\n"
-                  "Centroids are marked with white cross\n"
-                  f"Number of clusters used = {n_clusters}\n"
-                  f"Inertia = {kmeans.inertia_:.2f}")
+        xx, yy = np.meshgrid(np.linspace(x_min, x_max, resolution), np.linspace(y_min, y_max, resolution))
+        grid = pca.inverse_transform(np.c_[xx.ravel(), yy.ravel()])
+        Z = closest_centroids(grid, centers).reshape(xx.shape)
+
+        plt.figure(figsize=(12, 10))
+        plt.imshow(Z, interpolation="nearest", extent=(x_min, x_max, y_min, y_max),
+                   cmap=plt.cm.tab20, vmin=0, vmax=len(centers) - 1, aspect="auto", origin="lower", alpha=0.5)
+        plt.scatter(reduced_data[:, 0], reduced_data[:, 1], c=labels[sample], cmap=plt.cm.tab20,
+                    vmin=0, vmax=len(centers) - 1, s=2)
+        # Plot the centroids as a black X
+        plt.scatter(reduced_centers[:, 0], reduced_centers[:, 1], marker="x", s=169, linewidths=3,
+                    color="k", zorder=10)
+        plt.title("Served K-means model on the songs dataset (PCA-reduced data)\n"
+                  f"Number of clusters = {len(centers)}; {len(sample)} of {len(scaled)} songs shown\n"
+                  f"Explained variance = {pca.explained_variance_ratio_.sum():.1%}")
         plt.xlim(x_min, x_max)
         plt.ylim(y_min, y_max)
         plt.xticks(())
         plt.yticks(())
-        plt.show()
-
-def elbow_graph(df):
-        K = range(2, 21, 2)
-        inertia = []
-
-        for k in K:
-                time0 = time()
-                kmeans = KMeans(n_clusters=k,
-                            random_state=1234)
-                scaler = StandardScaler()
-                pipe = make_pipeline(scaler, kmeans)
-                pipe.fit(df)
-                time_trained = time()-time0
-                inertia.append(pipe[-1].inertia_)
-                print(f"Trained a K-Means model with {k} neighbours! Time needed = {time_trained:.3f} seconds.")
+        plt.savefig(path)
+        if show:
+                plt.show()
+        plt.close()
+
+        fig, (ax_size, ax_spread) = plt.subplots(2, 1, figsize=(16, 10), sharex=True)
+        ax_size.bar(stats["cluster"], stats["size"])
+        ax_size.set_ylabel("songs")
+        ax_spread.bar(stats["cluster"], stats["mean_distance"], yerr=stats["std_distance"].fillna(0))
+        ax_spread.set_ylabel("distance to the centroid")
+        ax_spread.set_xlabel("cluster")
+        ax_spread.set_xticks(stats["cluster"])
+        ax_size.set_title("Size and spread of each cluster")
+        fig.savefig(sizes_path)
+        if show:
+                plt.show()
+        plt.close(fig)
+
+        return stats
+
+def fit_k(args):
+        """
+        Function that fits a K-Means model with k clusters on already scaled data, and computes its
+        silhouette on the same scaled data (on a sample of sample_size songs if it is not None).
+        It receives a single tuple (scaled, k, sample_size, random_state) so it can be sent to a process pool.
+        Output: a tuple with the results dictionary (k, inertia, silhouette, fit_time) and the fitted model.
+        """
+        scaled, k, sample_size, random_state = args
+
+        time0 = time()
+        kmeans = KMeans(n_clusters=k, random_state=random_state).fit(scaled)
+        fit_time = time() - time0
+
+        if sample_size is not None and sample_size >= len(scaled):
+                sample_size = None
+        silhouette = silhouette_score(scaled, kmeans.labels_, sample_size=sample_size, random_state=random_state)
+
+        return {"k": k, "inertia": kmeans.inertia_, "silhouette": silhouette, "fit_time": fit_time}, kmeans
+
+def sweep_k(df, K=range(2, 21, 2), n_jobs=None, sample_size=10000, results_path="figures/k_sweep.csv",
+            random_state=1234):
+        """
+        Function that trains K-Means models for every k in K at the same time, in a process pool.
+        The data is scaled only once, and the silhouette is computed on the scaled data, sampled if the
+        dataset has more than sample_size songs.
+        Input: the modeling dataframe, the values of k, the number of processes (None uses all the cpus),
+        the silhouette sample size, the csv where the results table is written and the random state.
+        Output: a tuple with the results dataframe (k, inertia, silhouette, fit_time) and a dictionary
+        k -> fitted pipeline (scaler + K-Means), ready for save_model.
+        """
+        scaler = StandardScaler().fit(df)
+        scaled = scaler.transform(df)
+
+        time0 = time()
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                fits = list(executor.map(fit_k, [(scaled, k, sample_size, random_state) for k in K]))
+        print(f"Trained {len(fits)} K-Means models! Time needed = {time() - time0:.3f} seconds.")
+
+        results = pd.DataFrame(data=[result for result, kmeans in fits])
+        models = {result["k"]: make_pipeline(scaler, kmeans) for result, kmeans in fits}
+
+        if results_path is not None:
+                results.to_csv(results_path, index=False)
+
+        return results, models
+
+def best_k(results, criterion="silhouette"):
+        """
+        Function that picks the k with the highest silhouette from the results of sweep_k.
+        """
+        return int(results.loc[results[criterion].idxmax(), "k"])
+
+def plot_sweep(results, column, title, ylabel, path=None, show=False):
+        """
+        Function that plots a column of the sweep_k results against k. The figure is saved in path
+        (if given) and only shown if show is True, so it can run without a display.
+        """
+        K = results["k"]
 
         plt.figure(figsize=(16,8))
-        plt.plot(K, inertia, 'bx-')
+        plt.plot(K, results[column], 'bx-')
         plt.xlabel('k')
-        plt.ylabel('inertia')
+        plt.ylabel(ylabel)
         plt.xticks(np.arange(min(K), max(K)+1, 1.0))
-        plt.title('Elbow Method showing the optimal k')
-        plt.show()
+        plt.title(title)
+        if path is not None:
+                plt.savefig(path)
+        if show:
+                plt.show()
+        plt.close()
+
+def elbow_graph(df, path="figures/elbow.png", show=False, results=None, **sweep_kwargs):
+        """
+        Function that plots the inertia of each k. The results of a previous sweep_k can be given,
+        so the models are not trained again.
+        """
+        if results is None:
+                results, models = sweep_k(df, **sweep_kwargs)
+        plot_sweep(results, "inertia", 'Elbow Method showing the optimal k', 'inertia', path=path, show=show)
 
         return 0
 
-def silhouette_graph(df):
-        K = range(2, 21, 2)
-        silhouette = []
-
-        for k in K:
-
-                time0 = time()
-                kmeans = KMeans(n_clusters=k,
-                            random_state=1234)
-                scaler = StandardScaler()
-                pipe = make_pipeline(scaler, kmeans)
-                pipe.fit(df)
-                silhouette.append(silhouette_score(df, pipe.predict(df)))
-                time_trained = time()- time0
-
-                print(f"Calculated silhouette with {k} neighbours! Time needed = {time_trained:.3f} seconds.")
-
+def silhouette_graph(df, path="figures/silhouette.png", show=False, results=None, **sweep_kwargs):
+        """
+        Function that plots the silhouette of each k. The results of a previous sweep_k can be given,
+        so the models are not trained again.
+        """
+        if results is None:
+                results, models = sweep_k(df, **sweep_kwargs)
+        plot_sweep(results, "silhouette", 'Silhouette Method showing the optimal k', 'silhouette score',
+                   path=path, show=show)
 
-
-        plt.figure(figsize=(16,8))
-        plt.plot(K, silhouette, 'bx-')
-        plt.xlabel('k')
-        plt.ylabel('silhouette score')
-        plt.xticks(np.arange(min(K), max(K)+1, 1.0))
-        plt.title('Silhouette Method showing the optimal k')
-        plt.show()
+        return 0
 
 def main():
         df = import_df(path="spotify_songs.csv")
         modeling_df = df.drop(columns=["song_name", "song_id", "artist_name", "artist_id"])
         
-        #elbow_graph(modeling_df)
-        #silhouette_graph(modeling_df)
-        #visualise_model(modeling_df, n_clusters=15)
+        #One sweep gives both graphs:
+        #results, models = sweep_k(modeling_df)
+        #elbow_graph(modeling_df, results=results)
+        #silhouette_graph(modeling_df, results=results)
+
+        #To choose k with the sweep and save that model instead:
+        #model = models[best_k(results)]
 
         model, inertia, fit_time = create_model(modeling_df, n_clusters=20)
 
-        save_model(model, path="music_model.pkl")
+        save_model(model, path="music_model.pkl", df=df, index_path="music_index.pkl",
+                   export_path="music_model.npz", ann_path="music_ann.npz")
+        #The PCA view and the statistics of the clusters of the saved model (show=True to see the figure)
+        cluster_diagnostics(model, modeling_df)
 
         kmeans_model = model[-1]
 
@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from spotipy.exceptions import SpotifyException
+import spotify_helper_functions
+import metrics
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all the threads of a crawl. Each request takes a token; tokens are
+    refilled at `rate` per second up to `capacity`, so the throughput is set by the API quota.
+    pause() empties the bucket for some seconds, for example when Spotify answers with a 429.
+    """
+
+    def __init__(self, rate=10, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated = max(self.updated, self.paused_until)
+
+
+def retry_after(exception, default=1):
+    """
+    Function that returns the seconds Spotify asks us to wait in the Retry-After header of an error.
+    """
+    headers = getattr(exception, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", headers.get("retry-after", default)))
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimitedClient:
+    """
+    Wrapper of a Spotify client that takes a token from the bucket before each call, and retries
+    the calls that fail with a 429 (waiting what the Retry-After header says, for all the threads)
+    or with a 5xx error (with exponential backoff). The 5xx errors are not retried again for clients
+    whose session already retries them (see spotify_helper_functions.spotify_connection). The client
+    should come from spotify_helper_functions.get_client(rate_limited=True), whose session leaves the
+    429 answers to this wrapper.
+    It has the same methods as the client, so it can be given to the spotify_helper_functions.
+    """
+
+    def __init__(self, sp, limiter, max_retries=5, backoff=1):
+        self.sp = sp
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_server_errors = not getattr(sp, "retries_server_errors", False)
+
+    def __getattr__(self, name):
+        method = getattr(self.sp, name)
+        if not callable(method):
+            return method
+
+        def limited_call(*args, **kwargs):
+            for attempt in range(self.max_retries + 1):
+                self.limiter.acquire()
+                try:
+                    return method(*args, **kwargs)
+                except SpotifyException as e:
+                    if attempt == self.max_retries:
+                        raise
+                    if e.http_status == 429:
+                        self.limiter.pause(retry_after(e))
+                    elif e.http_status is not None and e.http_status >= 500 and self.retry_server_errors:
+                        time.sleep(self.backoff * 2 ** attempt)
+                    else:
+                        raise
+                    metrics.registry.increment(f"spotify_retries_{e.http_status}")
+
+        return limited_call
+
+
+def crawl_related_artists(seed_artists, sp, max_depth=1, max_artists=None, workers=8, seen=None):
+    """
+    Function that does a breadth first search over the related artists graph, asking for the
+    related artists of a whole level concurrently.
+    Input: a dictionary artist_id -> artist_name with the initial artists, the spotify connection
+    (usually a RateLimitedClient), the number of levels, the maximum number of new artists (the
+    seeds don't count), the number of threads and optionally a set with artist ids that must not
+    be visited again.
+    Output: a dictionary artist_id -> artist_name with all the seed artists and the new ones.
+    """
+    seen = set(seen) if seen is not None else set()
+    artists = dict(seed_artists)
+    seen.update(artists)
+    frontier = list(artists)
+    n_new = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for depth in range(max_depth):
+            if frontier == [] or (max_artists is not None and n_new >= max_artists):
+                break
+
+            next_frontier = []
+            for related in executor.map(lambda artist_id: spotify_helper_functions.get_related_artists(artist_id, sp),
+                                        frontier):
+                if not related:
+                    continue
+                for artist_id, artist_name in related.items():
+                    if artist_id in seen:
+                        continue
+                    if max_artists is not None and n_new >= max_artists:
+                        break
+                    seen.add(artist_id)
+                    artists[artist_id] = artist_name
+                    next_frontier.append(artist_id)
+                    n_new += 1
+
+            frontier = next_frontier
+
+    return artists
+
+
+def crawl_top_songs(artists, sp, workers=8):
+    """
+    Function that gets the top songs of several artists concurrently.
+    Input: a dictionary artist_id -> artist_name, the spotify connection and the number of threads.
+    Output: a list of dictionaries with song_name, song_id, artist_name and artist_id. A song in the
+    top songs of several artists is only returned once, with the first of them.
+    """
+    def artist_songs(item):
+        artist_id, artist_name = item
+        songs_dict = spotify_helper_functions.get_top_tracks(artist_id, sp)
+        if not songs_dict:
+            return []
+        return [{"song_name": song_name, "song_id": song_id, "artist_name": artist_name, "artist_id": artist_id}
+                for song_id, song_name in songs_dict.items()]
+
+    songs = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for artist_songs_list in executor.map(artist_songs, artists.items()):
+            for song in artist_songs_list:
+                songs.setdefault(song["song_id"], song)
+
+    return list(songs.values())
@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+from collections import Counter
+from spotipy.exceptions import SpotifyException
+
+
+class FakeSpotify:
+    """
+    Local stand-in for the spotipy client, for tests and benchmarks without network.
+    It generates a deterministic catalog of n_artists artists with songs_per_artist top songs,
+    n_related related artists each and random audio features.
+    Optionally each call sleeps `latency` seconds, and if `rate_limit` is given it answers
+    with a 429 (Retry-After: retry_after) when more than rate_limit calls arrive in one second.
+    The number of calls to each method is stored in `calls`.
+    """
+
+    def __init__(self, n_artists=1000, songs_per_artist=10, n_related=20, latency=0,
+                 rate_limit=None, retry_after=1, seed=0):
+        self.n_artists = n_artists
+        self.songs_per_artist = songs_per_artist
+        self.n_related = n_related
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.seed = seed
+        #Fakes with the same catalog give the same answers, so they share the cached ones
+        self.cache_scope = f"fake-{n_artists}-{songs_per_artist}-{n_related}-{seed}"
+        self.calls = Counter()
+        self._window = []
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._window = [moment for moment in self._window if now - moment < 1]
+                if len(self._window) >= self.rate_limit:
+                    self.calls["429"] += 1
+                    raise SpotifyException(429, -1, "API rate limit exceeded",
+                                           headers={"Retry-After": str(self.retry_after)})
+                self._window.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def artist_id(number):
+        return f"fakeartist{number:07d}"
+
+    @staticmethod
+    def song_id(artist_number, song_number):
+        return f"fakesong{artist_number:07d}{song_number:03d}"
+
+    def _artist(self, number):
+        return {"id": self.artist_id(number), "name": f"Artist {number}"}
+
+    def _artist_number(self, artist_id):
+        return int(artist_id[len("fakeartist"):])
+
+    def _track(self, artist_number, song_number):
+        return {"id": self.song_id(artist_number, song_number), "name": f"Song {song_number} by artist {artist_number}",
+                "album": {"artists": [self._artist(artist_number)]}, "artists": [self._artist(artist_number)]}
+
+    def search(self, q, type="artist", limit=10):
+        self._call("search")
+        text = q.split(":", 1)[-1].strip().lower()
+        rng = random.Random(f"{self.seed}-{text}")
+        numbers = rng.sample(range(self.n_artists), min(limit, self.n_artists))
+
+        if type == "artist":
+            return {"artists": {"items": [self._artist(number) for number in numbers]}}
+        return {"tracks": {"items": [self._track(number, rng.randrange(self.songs_per_artist)) for number in numbers]}}
+
+    def artist_top_tracks(self, artist_id, country="US"):
+        self._call("artist_top_tracks")
+        number = self._artist_number(artist_id)
+        return {"tracks": [self._track(number, song_number) for song_number in range(self.songs_per_artist)]}
+
+    def artist_related_artists(self, artist_id):
+        self._call("artist_related_artists")
+        number = self._artist_number(artist_id)
+        rng = random.Random(f"{self.seed}-{number}")
+        related = rng.sample(range(self.n_artists), min(self.n_related, self.n_artists))
+        return {"artists": [self._artist(other) for other in related if other != number]}
+
+    def audio_features(self, tracks=[]):
+        self._call("audio_features")
+        if isinstance(tracks, str):
+            tracks = [tracks]
+
+        features = []
+        for song_id in tracks:
+            rng = random.Random(f"{self.seed}-{song_id}")
+            features.append({"danceability": rng.random(), "energy": rng.random(), "key": rng.randrange(12),
+                             "loudness": rng.gauss(-8, 3), "mode": rng.randrange(2),
+                             "speechiness": rng.random() * 0.3, "acousticness": rng.random(),
+                             "instrumentalness": rng.random() * 0.5, "liveness": rng.random() * 0.5,
+                             "valence": rng.random(), "tempo": rng.gauss(120, 25),
+                             "id": song_id, "type": "audio_features"})
+        return features
+
+    def track(self, track_id):
+        self._call("track")
+        number = int(track_id[len("fakesong"):-3])
+        return self._track(number, int(track_id[-3:]))
+
+    def tracks(self, tracks):
+        self._call("tracks")
+        return {"tracks": [self._track(int(track_id[len("fakesong"):-3]), int(track_id[-3:]))
+                           if track_id.startswith("fakesong") else None for track_id in tracks]}
@@ -0,0 +1,113 @@
+import json
+import numpy as np
+import metrics
+
+MODEL_FORMAT_VERSION = 1
+
+
+class Scaler:
+    """
+    Standardization step of a LightModel: (x - mean) / scale, like a fitted StandardScaler.
+    """
+
+    def __init__(self, mean, scale, feature_names=None):
+        self.mean_ = mean
+        self.scale_ = scale
+        self.feature_names = feature_names
+
+    def _matrix(self, X):
+        #Dataframes are reordered to the training columns, and single rows become a 1 row matrix
+        if self.feature_names is not None and hasattr(X, "columns"):
+            X = X[self.feature_names]
+        return np.atleast_2d(np.asarray(X, dtype=np.float64))
+
+    def transform(self, X):
+        return (self._matrix(X) - self.mean_) / self.scale_
+
+
+class Centroids:
+    """
+    Clustering step of a LightModel: assigns each scaled row to the closest centroid.
+    """
+
+    def __init__(self, cluster_centers):
+        self.cluster_centers_ = cluster_centers
+        self.n_clusters = len(cluster_centers)
+        self._centers_norms = (cluster_centers ** 2).sum(axis=1)
+
+    def predict(self, scaled):
+        scaled = np.atleast_2d(np.asarray(scaled, dtype=np.float64))
+        #Squared distances without the |x|^2 term, which doesn't change the closest centroid
+        distances = self._centers_norms - 2 * scaled @ self.cluster_centers_.T
+        return distances.argmin(axis=1).astype(np.int32)
+
+
+class LightModel:
+    """
+    Pure NumPy version of the scaler + K-Means pipeline, for serving without importing scikit-learn.
+    model[0] / model[:-1] is the scaler and model[-1] the centroids, like the sklearn pipeline.
+    """
+
+    def __init__(self, mean, scale, cluster_centers, feature_names=None, meta=None):
+        self.scaler = Scaler(np.asarray(mean, dtype=np.float64), np.asarray(scale, dtype=np.float64), feature_names)
+        self.kmeans = Centroids(np.asarray(cluster_centers, dtype=np.float64))
+        self.meta = meta if meta is not None else {}
+
+    def __getitem__(self, item):
+        steps = [self.scaler, self.kmeans]
+        if isinstance(item, slice):
+            selected = steps[item]
+            if selected == [self.scaler]:
+                return self.scaler
+            if selected == steps:
+                return self
+            raise IndexError("Only model[:-1] (the scaler) can be sliced.")
+        return steps[item]
+
+    def __len__(self):
+        return 2
+
+    def transform(self, X):
+        return self.scaler.transform(X)
+
+    def predict(self, X):
+        """
+        Method that returns the cluster of each row (a single row or a batch, as arrays or dataframes).
+        """
+        return self.kmeans.predict(self.scaler.transform(X))
+
+
+def export_model(model, path="music_model.npz", feature_names=None):
+    """
+    Function that saves the parameters of a fitted sklearn pipeline (StandardScaler + KMeans) in a
+    small .npz file: the scaler mean and scale, the centroids and the versioned metadata.
+    """
+    scaler, kmeans = model[0], model[-1]
+    if feature_names is None and hasattr(scaler, "feature_names_in_"):
+        feature_names = list(scaler.feature_names_in_)
+
+    meta = {"version": MODEL_FORMAT_VERSION, "model": str(kmeans), "n_clusters": int(kmeans.n_clusters),
+            "n_features": int(len(scaler.mean_)), "feature_names": feature_names}
+
+    np.savez(path, mean=scaler.mean_, scale=scaler.scale_, cluster_centers=kmeans.cluster_centers_,
+             meta=np.array(json.dumps(meta)))
+
+    return path
+
+
+@metrics.timed("load_light_model")
+def load_model(path="music_model.npz"):
+    """
+    Function that loads a model exported with export_model.
+    Output: the LightModel, or None if the file doesn't exist.
+    """
+    try:
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] != MODEL_FORMAT_VERSION:
+                raise ValueError(f"Model format version {meta['version']} not supported (expected {MODEL_FORMAT_VERSION}).")
+            return LightModel(data["mean"], data["scale"], data["cluster_centers"],
+                              feature_names=meta["feature_names"], meta=meta)
+    except FileNotFoundError:
+        print("Exported model not found!")
+        return None
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from urllib.parse import quote
+import numpy as np
+import recommender
+import service
+from fake_spotify import FakeSpotify
+
+
+async def http_request(reader, writer, method, path, body=None):
+    """
+    Function that sends a request through an open keep-alive connection and reads the answer.
+    Output: a tuple with the status code and the decoded json.
+    """
+    payload = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+                 + payload)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+
+    return status, json.loads(await reader.readexactly(length))
+
+
+def make_requests(reco, n_requests, external_share=0.05, seed=0):
+    """
+    Function that creates a mix of requests: fuzzy matches of catalog names, recommendations and
+    playlists. A share of the recommendations use songs outside the catalog, which go to the (fake)
+    Spotify client in the service thread pool.
+    """
+    rng = random.Random(seed)
+    song_ids = reco.index["song_ids"]
+    names = reco.spotify_index.names
+    requests = []
+
+    for _ in range(n_requests):
+        kind = rng.random()
+        if kind < 0.4:
+            requests.append(("GET", "/match?q=" + quote(rng.choice(names)), None))
+        elif kind < 0.8:
+            if rng.random() < external_share:
+                song_id = FakeSpotify.song_id(rng.randrange(1000), rng.randrange(10))
+            else:
+                song_id = rng.choice(song_ids)
+            mode = rng.choice(["random", "nearest"])
+            requests.append(("GET", f"/recommend?song_id={song_id}&n=5&mode={mode}", None))
+        else:
+            requests.append(("POST", "/playlist", {"song_ids": rng.sample(song_ids, 5), "n": 10}))
+
+    return requests
+
+
+async def run_load(host, port, requests, concurrency):
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+    errors = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        while not queue.empty():
+            method, path, body = queue.get_nowait()
+            t0 = time.perf_counter()
+            status, answer = await http_request(reader, writer, method, path, body)
+            latencies.append(time.perf_counter() - t0)
+            if status != 200:
+                errors.append((path, status, answer))
+        writer.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - t0
+
+
+def load_test(n_requests=5000, concurrency=50, host="127.0.0.1", port=8765, spotify_latency=0.05,
+              **recommender_kwargs):
+    """
+    Function that starts the recommender service in a background thread, with the Spotify client
+    replaced by FakeSpotify (answering after spotify_latency seconds), and sends n_requests from
+    `concurrency` keep-alive connections.
+    Output: a dictionary with the requests per second, the p50/p99 latencies and the errors.
+    """
+    reco = recommender.Recommender(sp=FakeSpotify(latency=spotify_latency), **recommender_kwargs)
+    recommender_service = service.RecommenderService(reco=reco)
+
+    thread = threading.Thread(target=asyncio.run, args=(recommender_service.serve(host=host, port=port),),
+                              daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    requests = make_requests(reco, n_requests)
+    latencies, errors, total_time = asyncio.run(run_load(host, port, requests, concurrency))
+
+    latencies_ms = np.array(latencies) * 1000
+    results = {"requests": len(latencies), "errors": len(errors), "requests_per_second": len(latencies) / total_time,
+               "p50_ms": float(np.percentile(latencies_ms, 50)), "p99_ms": float(np.percentile(latencies_ms, 99))}
+
+    print(f"{results['requests']} requests with {concurrency} connections: {results['requests_per_second']:.0f} req/s, "
+          f"p50 = {results['p50_ms']:.2f} ms, p99 = {results['p99_ms']:.2f} ms, {results['errors']} errors")
+
+    return results
+
+
+def main():
+    load_test()
+
+    return 0
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,228 @@
+import bisect
+import contextvars
+import functools
+import os
+import threading
+from collections import Counter
+from time import perf_counter
+
+#Upper limits (in seconds) of the latency histogram buckets
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+#Spans of the current request, when a trace is running
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, like the Prometheus ones (each bucket counts the
+    observations lower or equal than its limit, the last one has no limit).
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        #Upper limit of the bucket that contains the quantile
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for limit, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= rank:
+                return limit
+        return float("inf")
+
+
+class Metrics:
+    """
+    Registry of the timers and counters of the program. Each endpoint (function or Spotify API call)
+    has a latency histogram and an error count. When it is disabled, the timed functions are called
+    directly, so the cost is a single attribute check.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.errors = Counter()
+        self.counters = Counter()
+
+    def observe(self, endpoint, seconds, error=False):
+        with self.lock:
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                self.errors[endpoint] += 1
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.errors.clear()
+            self.counters.clear()
+
+    def summary(self):
+        """
+        Method that returns the calls, errors, total time and approximate p50/p99 (in ms) of each endpoint.
+        """
+        with self.lock:
+            return {endpoint: {"calls": histogram.count, "errors": self.errors[endpoint],
+                               "total_ms": histogram.sum * 1000, "p50_ms": histogram.quantile(0.5) * 1000,
+                               "p99_ms": histogram.quantile(0.99) * 1000}
+                    for endpoint, histogram in sorted(self.histograms.items())}
+
+    def report(self):
+        for endpoint, stats in self.summary().items():
+            print(f"{endpoint}: {stats['calls']} calls, {stats['errors']} errors, {stats['total_ms']:.1f} ms in total, "
+                  f"p50 <= {stats['p50_ms']:.1f} ms, p99 <= {stats['p99_ms']:.1f} ms")
+        for name, value in sorted(self.counters.items()):
+            print(f"{name}: {value}")
+
+    def prometheus(self, prefix="spoti_reco"):
+        """
+        Method that returns the metrics in the Prometheus text format.
+        """
+        lines = [f"# HELP {prefix}_call_duration_seconds Latency of the instrumented calls.",
+                 f"# TYPE {prefix}_call_duration_seconds histogram"]
+        with self.lock:
+            for endpoint, histogram in sorted(self.histograms.items()):
+                total = 0
+                for limit, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    total += count
+                    lines.append(f'{prefix}_call_duration_seconds_bucket{{endpoint="{endpoint}",le="{limit}"}} {total}')
+                lines.append(f'{prefix}_call_duration_seconds_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                lines.append(f'{prefix}_call_duration_seconds_count{{endpoint="{endpoint}"}} {histogram.count}')
+
+            lines += [f"# HELP {prefix}_call_errors_total Instrumented calls that raised an exception.",
+                      f"# TYPE {prefix}_call_errors_total counter"]
+            for endpoint in sorted(self.histograms):
+                lines.append(f'{prefix}_call_errors_total{{endpoint="{endpoint}"}} {self.errors[endpoint]}')
+
+            lines += [f"# HELP {prefix}_events_total Counted events.", f"# TYPE {prefix}_events_total counter"]
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+#Registry used by the instrumented modules. Set SPOTI_RECO_METRICS=1 to enable it from the start
+registry = Metrics(enabled=os.environ.get("SPOTI_RECO_METRICS") == "1")
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+def _record(endpoint, start, error):
+    seconds = perf_counter() - start
+    registry.observe(endpoint, seconds, error)
+    spans = _current_trace.get()
+    if spans is not None:
+        spans.append({"endpoint": endpoint, "start_ms": (start - spans.start) * 1000, "ms": seconds * 1000,
+                      "error": error})
+
+
+def timed(endpoint):
+    """
+    Decorator that measures the latency of a function and counts its errors under the endpoint name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                _record(endpoint, start, error)
+        return wrapper
+    return decorator
+
+
+class timer:
+    """
+    Context manager version of timed, for blocks like a single Spotify request inside a loop.
+    """
+
+    __slots__ = ("endpoint", "start")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = None
+
+    def __enter__(self):
+        if registry.enabled:
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            _record(self.endpoint, self.start, exc_type is not None)
+        return False
+
+
+class Trace(list):
+    """
+    List of the spans (endpoint, start and duration in ms, error) recorded during a request.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.start = perf_counter()
+
+    def total_ms(self):
+        return (perf_counter() - self.start) * 1000
+
+    def format(self):
+        lines = [f"{span['start_ms']:9.2f} ms  {span['ms']:9.2f} ms  {span['endpoint']}" + ("  (error)" if span["error"] else "")
+                 for span in sorted(self, key=lambda span: span["start_ms"])]
+        return "\n".join(["    start  duration  endpoint"] + lines)
+
+
+class trace:
+    """
+    Context manager that collects the spans of the instrumented calls made inside it (in this thread
+    or asyncio task). Spans are only recorded while the registry is enabled.
+    """
+
+    def __enter__(self):
+        self.spans = Trace()
+        self.token = _current_trace.set(self.spans)
+        return self.spans
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_trace.reset(self.token)
+        return False
+
+
+def run_in_context(function, *args, **kwargs):
+    """
+    Function that returns a callable which runs function in a copy of the current context, so the
+    calls made in a thread pool are added to the trace of the request.
+    """
+    context = contextvars.copy_context()
+    return lambda: context.run(function, *args, **kwargs)
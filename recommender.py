@@ -6,23 +6,33 @@ import numpy as np
 import re
 import random
 import spotify_helper_functions
-import clustering_music
+import catalog
+import light_model
+import song_index
+import top_table
+import batch_recommend
+import ann_index
+import metrics
 from difflib import get_close_matches
+from title_index import TitleIndex
 
 
+@metrics.timed("import_top_songs")
 def import_top_songs(path="top_songs.csv"):
     top_df = pd.read_csv(path, index_col=0)
-    top_df = top_df.applymap(lambda x: x.lower())
+    top_df = top_df.apply(lambda column: column.str.lower())
     
     return top_df
 
+@metrics.timed("import_spotify_df")
 def import_spotify_df(path="spotify_songs.csv"):
     df = pd.read_csv(path, index_col=0)
-    df["song_name"] = df["song_name"].apply(lambda x: x.lower())
-    df["artist_name"] = df["artist_name"].apply(lambda x: x.lower())
+    df["song_name"] = df["song_name"].str.lower()
+    df["artist_name"] = df["artist_name"].str.lower()
     return df
 
 
+@metrics.timed("is_similar")
 def is_similar(user_input, name_series):
     """
     Finds if a name is similar to a pandas series that is given as input. It uses a built in algorithm that
@@ -91,14 +101,22 @@ def choice(options, df, sp, names_or_ids="ids"):
 
 
 
-def recommend_top_song(song_name, df):
-    while True:  # Loop so we don't recommend the same song the user inputs.
-        random_row = random.choice(range(len(df)))
-        random_song = df.iloc[random_row, 0]
-        random_artist = df.iloc[random_row, 1]
+def recommend_top_song(song_name, df, table=None):
+    """
+    Function that recommends a top song for a top song. With the precomputed table of
+    top_table.build_top_table, the most similar chart song is a single lookup; otherwise (or if the
+    song is not in the table) a random top song is chosen.
+    """
+    if table is not None and table["songs"].get(song_name, {}).get("top_songs"):
+        random_song, random_artist = table["songs"][song_name]["top_songs"][0]
+    else:
+        while True:  # Loop so we don't recommend the same song the user inputs.
+            random_row = random.choice(range(len(df)))
+            random_song = df.iloc[random_row, 0]
+            random_artist = df.iloc[random_row, 1]
 
-        if random_song != song_name:
-            break
+            if random_song != song_name:
+                break
 
     print(f"TOP recommendation! A similar song to {song_name.capitalize()} that you might \
 like is {random_song.capitalize()}, by {random_artist.capitalize()}.")
@@ -106,65 +124,543 @@ like is {random_song.capitalize()}, by {random_artist.capitalize()}.")
     return {"song_name":random_song, "artist_name":random_artist}
 
 
-def recommend_spotify_song(song_id, df, model, sp_connection):
+class SongNotFoundError(ValueError):
+    """
+    Error raised when a song is not in the catalog and Spotify has no audio features for it.
+    """
+
+
+def seed_song(song_id, df, model, sp_connection, index):
+    """
+    Function that returns the cluster and the scaled features of a song. Songs in the index are
+    read from it, and the rest are fetched from Spotify and go through the model.
+    Input: the song id, the spotify dataframe, the model, the spotify connection and the index.
+    Output: a tuple with the cluster and the scaled features (float32 vector).
+    """
+    if song_id in index["song_cluster"]:
+        return index["song_cluster"][song_id], index["features"][index["song_row"][song_id]]
+
+    found_ids, clusters, scaled = new_songs_features([song_id], model, sp_connection)
+    if found_ids == []:
+        raise SongNotFoundError(f"No audio features found in Spotify for the song {song_id}.")
+
+    return int(clusters[0]), scaled[0]
+
+
+@metrics.timed("new_songs_features")
+def new_songs_features(song_ids, model, sp_connection):
+    """
+    Function that takes songs that are not in the catalog, fetches their features from Spotify in
+    batches of 100 and predicts all their clusters with a single call to the model.
+    Input: the list of song ids, the model and the spotify connection.
+    Output: a tuple with the ids of the songs found, their clusters and their scaled features
+    (float32 matrix, with the columns in the order the model was trained with).
+    """
+    song_ids = list(dict.fromkeys(song_ids))
+    attributes = spotify_helper_functions.get_songs_attributes_batch(song_ids, sp_connection)
+    found_ids = [song_id for song_id in song_ids if song_id in attributes]
+
+    columns = spotify_helper_functions.SELECTED_FEATURES
+    matrix = np.array([[attributes[song_id][column] for column in columns] for song_id in found_ids],
+                      dtype=np.float64).reshape(-1, len(columns))
+    if found_ids == []:
+        return [], np.empty(0, dtype=np.int32), np.empty((0, len(columns)), dtype=np.float32)
+
+    scaled = model[:-1].transform(pd.DataFrame(data=matrix, columns=columns))
+    clusters = model[-1].predict(scaled)
+
+    return found_ids, clusters, scaled.astype(np.float32)
+
+
+def add_new_songs(index, song_ids, clusters, scaled, sp_connection):
+    """
+    Function that inserts songs predicted with new_songs_features into the index, so the next
+    queries find them locally. Their names are fetched from Spotify in batches of 50.
+    Output: the updated index.
+    """
+    song_info = spotify_helper_functions.get_songs_info_batch(song_ids, sp_connection)
+    keep = [position for position, song_id in enumerate(song_ids) if song_id in song_info]
+    song_ids = [song_ids[position] for position in keep]
+
+    return song_index.insert_songs(index, song_ids, [song_info[song_id][0] for song_id in song_ids],
+                                   [song_info[song_id][1] for song_id in song_ids],
+                                   np.asarray(clusters)[keep], np.asarray(scaled)[keep])
+
+
+def closest_clusters(features, cluster, model, n_clusters=1):
+    """
+    Function that returns the cluster of a song followed by the clusters with the closest
+    centroids to its scaled features, up to n_clusters clusters.
+    """
+    if n_clusters <= 1:
+        return [cluster]
+
+    centroids = model[-1].cluster_centers_
+    distances = ((centroids - features) ** 2).sum(axis=1)
+    others = [int(other) for other in np.argsort(distances, kind="stable") if other != cluster]
+
+    return ([cluster] + others)[:n_clusters]
+
+
+def build_cluster_trees(index, leaf_size=40):
+    """
+    Function that builds a KD-tree with the scaled features of each cluster of the index.
+    Output: a dictionary cluster -> KDTree (its rows are the positions in song_index.cluster_features).
+    """
+    from sklearn.neighbors import KDTree
+
+    trees = {}
+    for cluster in set(index["cluster_slices"]) | set(index.get("cluster_extra", {})):
+        rows, features = song_index.cluster_features(index, cluster)
+        trees[cluster] = KDTree(features, leaf_size=leaf_size)
+
+    return trees
+
+
+def nearest_songs(features, index, clusters, n=5, exclude=(), trees=None):
+    """
+    Function that ranks the songs of the given clusters by their distance to a vector of scaled
+    features. The distances are computed at once over the slices of the float32 features matrix
+    (or queried in the KD-trees of build_cluster_trees, if given). Ties are broken by the position
+    in the index, so the result is deterministic.
+    Input: the scaled features, the index, the list of clusters, the number of songs, the song ids
+    that can't be recommended and optionally the trees.
+    Output: a list of tuples (song_id, squared distance), closest first.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    k = n + len(exclude)
+    all_rows = []
+    all_distances = []
+
+    for cluster in clusters:
+        rows, cluster_features = song_index.cluster_features(index, cluster)
+        if len(rows) == 0:
+            continue
+
+        if trees is not None:
+            distances, positions = trees[cluster].query(features.reshape(1, -1), k=min(k, len(rows)))
+            rows = rows[positions[0]]
+            distances = distances[0] ** 2
+        else:
+            difference = cluster_features - features
+            distances = np.einsum("ij,ij->i", difference, difference)
+
+            #We only sort the k closest songs (and the ones tied with the last of them)
+            if len(distances) > k:
+                kth_distance = np.partition(distances, k - 1)[k - 1]
+                closest = distances <= kth_distance
+                rows = rows[closest]
+                distances = distances[closest]
+
+        all_rows.append(rows)
+        all_distances.append(distances)
+
+    if all_rows == []:
+        return []
+
+    rows = np.concatenate(all_rows)
+    distances = np.concatenate(all_distances)
+    order = np.lexsort((rows, distances))
+
+    results = []
+    for position in order:
+        song_id = index["song_ids"][rows[position]]
+        if song_id in exclude:
+            continue
+        results.append((song_id, float(distances[position])))
+        if len(results) == n:
+            break
+
+    return results
 
-    modeling_df = df.drop(columns=["song_name", "artist_name", "artist_id", "song_id"])
-    clusters = model.predict(modeling_df)
 
-    data = {"song_name": df["song_name"], "song_id": df["song_id"], "artist_name": df["artist_name"],
-     "artist_id": df["artist_id"], "cluster": clusters}
+@metrics.timed("recommend_spotify_songs")
+def recommend_spotify_songs(song_id, df, model, sp_connection, index, n=5, verbose=True,
+                            mode="random", n_clusters=1, trees=None):
+    """
+    Function that recommends n songs from the same cluster as the song given as input.
+    The clusters of the catalog songs are read from the precomputed index, so only songs
+    that are not in the catalog need a call to the model.
+    With mode="random" the songs are picked at random from the cluster. With mode="nearest" they
+    are the n closest songs to the input one, searched in its cluster and the n_clusters - 1
+    clusters with the closest centroids.
+    Input: the song id, the spotify dataframe, the model, the spotify connection, the index
+    created by clustering_music.create_index and the number of recommendations. With verbose=False
+    nothing is printed.
+    Output: a list of tuples (song_id, song_name, artist_name).
+    """
 
-    names_ids_df = pd.DataFrame(data=data)
+    recommendation_cluster, features = seed_song(song_id, df, model, sp_connection, index)
+    clusters = closest_clusters(features, recommendation_cluster, model, n_clusters=n_clusters)
 
-    if song_id in names_ids_df["song_id"]:
-        recommendation_cluster = names_ids_df.loc[names_ids_df["song_id"] == song_id, "cluster"].unique()[0]
+    #We don't recommend the same song that the user gave us
+    if mode == "nearest":
+        recommended_ids = [song_rec_id for song_rec_id, distance in
+                           nearest_songs(features, index, clusters, n=n, exclude={song_id}, trees=trees)]
     else:
-        attributes = spotify_helper_functions.get_songs_attributes(song_id, sp_connection)
-        row = pd.DataFrame(data=attributes, index=modeling_df.columns)
-        recommendation_cluster = model.predict(row)[0]
+        candidates = [candidate for cluster in clusters for candidate in index["cluster_songs"].get(cluster, [])
+                      if candidate != song_id]
+        recommended_ids = random.sample(candidates, min(n, len(candidates)))
 
-    mask = names_ids_df["cluster"] == recommendation_cluster
-    recommendation_df = names_ids_df.loc[mask, ["song_name", "artist_name", "artist_id", "song_id", "cluster"]]
+    recommendations = []
+    for song_rec_id in recommended_ids:
+        song_rec_name, song_rec_artist = index["song_info"][song_rec_id]
+        song_rec_name = song_rec_name.capitalize()
+        song_rec_artist = song_rec_artist.capitalize()
 
-    random_row = random.choice(range(len(recommendation_df)))
+        if verbose:
+            print(f"Spotify recommendation! A song you might like is {song_rec_name}, by {song_rec_artist}! ")
+        recommendations.append((song_rec_id, song_rec_name, song_rec_artist))
 
-    song_rec_name = names_ids_df.iloc[random_row, 0].capitalize()
-    song_rec_artist = names_ids_df.iloc[random_row, 2].capitalize()
-    song_rec_id = names_ids_df.iloc[random_row, 1]
+    return recommendations
 
-    print(f"Spotify recommendation! A song you might like is {song_rec_name}, by {song_rec_artist}! ")
-    
-    return song_rec_id, song_rec_name, song_rec_artist
 
-    
-def song_recommender(n = 5):
+def playlist_features(seed_ids, model, sp_connection, index):
+    """
+    Function that returns the scaled features of a list of songs. Songs in the index are read from it,
+    and the features of the rest are fetched from Spotify in a single batched request.
+    Output: a tuple with the float32 matrix (one row per song found) and the list of their ids.
+    """
+    seed_ids = list(dict.fromkeys(seed_ids))
+    known_ids = [song_id for song_id in seed_ids if song_id in index["song_row"]]
+    missing_ids = [song_id for song_id in seed_ids if song_id not in index["song_row"]]
 
-    #We create the Spotify connection
-    sp = spotify_helper_functions.spotify_connection()
+    rows = [index["song_row"][song_id] for song_id in known_ids]
+    matrices = [np.asarray(index["features"][rows], dtype=np.float32)]
+
+    if missing_ids:
+        missing_ids, clusters, scaled = new_songs_features(missing_ids, model, sp_connection)
+        matrices.append(scaled)
+
+    return np.concatenate(matrices).reshape(-1, index["features"].shape[1]), known_ids + missing_ids
+
+
+@metrics.timed("recommend_playlist")
+def recommend_playlist(seed_ids, model, sp_connection, index, n=10, profile="centroid", norms=None):
+    """
+    Function that recommends songs for a whole playlist in one vectorised pass over the features matrix.
+    The taste profile is the centroid of the scaled features of the seeds (profile="centroid"), or the
+    centroids of the seeds of each cluster (profile="mixture"), and then songs are ranked by their
+    distance to the closest profile centroid. The seeds are never recommended.
+    Input: the list of song ids, the model, the spotify connection, the index, the number of songs,
+    the profile type and optionally the squared norms of the rows of the features matrix.
+    Output: a list of tuples (song_id, squared distance), closest first.
+    """
+    seed_features, found_ids = playlist_features(seed_ids, model, sp_connection, index)
+    if len(seed_features) == 0:
+        return []
+
+    if profile == "mixture":
+        cluster_centers = model[-1].cluster_centers_
+        seed_clusters = ((seed_features[:, None, :] - cluster_centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        centroids = np.stack([seed_features[seed_clusters == cluster].mean(axis=0)
+                              for cluster in np.unique(seed_clusters)])
+    else:
+        centroids = seed_features.mean(axis=0, keepdims=True)
+
+    #Squared distances to each centroid: |x|^2 - 2 x.c + |c|^2
+    features = index["features"]
+    if norms is None:
+        norms = np.einsum("ij,ij->i", features, features)
+    distances = norms[:, None] - 2 * (features @ centroids.T.astype(np.float32)) + (centroids ** 2).sum(axis=1)
+    distances = np.maximum(distances.min(axis=1), 0)
+
+    #We take some extra songs in case the seeds are among the closest ones
+    exclude = set(seed_ids)
+    k = min(n + len(exclude), len(distances))
+    if k == 0:
+        return []
+    kth_distance = np.partition(distances, k - 1)[k - 1]
+    rows = np.flatnonzero(distances <= kth_distance)
+    rows = rows[np.lexsort((rows, distances[rows]))]
+
+    results = []
+    for row in rows:
+        song_id = index["song_ids"][row]
+        if song_id in exclude:
+            continue
+        results.append((song_id, float(distances[row])))
+        if len(results) == n:
+            break
+
+    return results
+
+
+@metrics.timed("recommend_spotify_song")
+def recommend_spotify_song(song_id, df, model, sp_connection, index=None):
+
+    #Without a precomputed index we need to predict the cluster of the whole dataframe
+    if index is None:
+        import clustering_music
+        index = clustering_music.create_index(model, df)
+
+    recommendations = recommend_spotify_songs(song_id, df, model, sp_connection, index, n=1)
 
-    #We load the two datasets: top songs and spotify songs
-    top_df = import_top_songs(path="top_songs.csv")
-    spotify_df = import_spotify_df(path="spotify_songs.csv")
+    if recommendations == []:
+        return None
+    return recommendations[0]
 
-    #We load the model that we will use
-    model = clustering_music.load_model(path="music_model.pkl")
+
+class Recommender:
+    """
+    Class that loads the datasets, the model and the recommendation index once and keeps them in
+    memory, so a single process can answer many queries without reading the files again.
+    The Spotify connection is only created the first time it is needed.
+    """
+
+    def __init__(self, top_path="top_songs.csv", spotify_path="spotify_songs.csv",
+                 model_path="music_model.pkl", index_path="music_index.pkl", sp=None, catalog_path=None,
+                 top_table_path="top_table.pkl", table_path=None, ann_path=None):
+        """
+        If catalog_path is given, the songs and the index are read from the memory mapped catalog
+        created by catalog.build_catalog instead of the csv and the index pickle.
+        A model_path ending in .npz loads the model exported by light_model.export_model. With a
+        catalog and an exported model, scikit-learn is never imported.
+        The table with the similar songs of each top song (see top_table) is loaded if it exists.
+        If table_path is given, the nearest songs of the catalog songs are read from the table
+        precomputed by batch_recommend.build_table, if it was built with the songs of the index.
+        If ann_path is given, the approximate nearest neighbours index of ann_index is loaded for mode="ann".
+        """
+
+        #We load the top songs and the model
+        self.top_df = import_top_songs(path=top_path)
+        self.top_table = top_table.load_top_table(path=top_table_path)
+        if model_path.endswith(".npz"):
+            self.model = light_model.load_model(path=model_path)
+        else:
+            import clustering_music
+            self.model = clustering_music.load_model(path=model_path)
+
+        #Then the spotify songs and the index with the cluster of each song
+        if catalog_path is not None:
+            self.catalog = catalog.load_catalog(path=catalog_path)
+            self._spotify_df = None
+            self.index = catalog.catalog_index(self.catalog)
+            song_names = self.catalog["song_names"].tolist()
+            song_ids = self.index["song_ids"]
+        else:
+            import clustering_music
+            self.catalog = None
+            self._spotify_df = import_spotify_df(path=spotify_path)
+            self.index = clustering_music.load_index(path=index_path)
+            if self.index is None:
+                self.index = clustering_music.create_index(self.model, self._spotify_df)
+            song_names = self._spotify_df["song_name"]
+            song_ids = self._spotify_df["song_id"]
+
+        #The names of the catalog songs are answered locally instead of asking Spotify
+        spotify_helper_functions.add_local_songs(self.index["song_info"])
+
+        #Fuzzy matching indexes, which also store the ids of the songs with each name
+        self.top_index = TitleIndex(self.top_df["songs"])
+        self.spotify_index = TitleIndex(song_names, song_ids)
+
+        self.table = batch_recommend.RecommendationTable(path=table_path) if table_path is not None else None
+        if self.table is not None and not self.table.matches(self.index):
+            print(f"The recommendations table in {table_path} was built with other songs. It won't be used.")
+            self.table = None
+        self.ann = ann_index.load_ann_index(path=ann_path) if ann_path is not None else None
+
+        self._sp = sp
+        self._trees = None
+        self._norms = None
+
+    @property
+    def spotify_df(self):
+        #With a catalog the dataframe is only built if something asks for it
+        if self._spotify_df is None:
+            self._spotify_df = catalog.catalog_df(self.catalog)
+        return self._spotify_df
+
+    @property
+    def sp(self):
+        if self._sp is None:
+            self._sp = spotify_helper_functions.get_client()
+        return self._sp
+
+    @metrics.timed("Recommender.match")
+    def match(self, query):
+        """
+        Method that looks for a song name in the top songs and in the spotify songs.
+        Input: the name of the song.
+        Output: a dictionary with the similar top songs names and the ids of the closest spotify song.
+        """
+        query = query.lower()
+
+        top_songs = self.top_index.search(query, n=3, cutoff=0.90)
+
+        spotify_songs = []
+        matches = self.spotify_index.lookup(query, n=3, cutoff=0.90)
+        if matches != []:
+            spotify_songs = matches[0][1]
+
+        return {"top_songs": top_songs, "spotify_songs": spotify_songs}
+
+    def recommend_top(self, song_name, n=5):
+        """
+        Method that returns the songs similar to a top song, from the precomputed top songs table.
+        Output: a dictionary with the similar top songs (song_name, artist_name) and the similar
+        catalog songs (song_id, song_name, artist_name), or None if the song is not in the table.
+        """
+        if self.top_table is None or song_name.lower() not in self.top_table["songs"]:
+            return None
+
+        similar = self.top_table["songs"][song_name.lower()]
+        recommendations = []
+        for song_id in similar["song_ids"][:n]:
+            if song_id in self.index["song_info"]:
+                song_rec_name, song_rec_artist = self.index["song_info"][song_id]
+                recommendations.append((song_id, song_rec_name.capitalize(), song_rec_artist.capitalize()))
+
+        return {"top_songs": similar["top_songs"][:n], "recommendations": recommendations}
+
+    @metrics.timed("Recommender.predict_new_songs")
+    def predict_new_songs(self, song_ids, insert=True):
+        """
+        Method that predicts the clusters of songs that are not in the catalog, fetching all their
+        features at once (see new_songs_features). With insert=True the songs are added to the index
+        and to the fuzzy matching index, so later queries answer them locally.
+        Output: a dictionary song_id -> cluster, for the songs found in Spotify.
+        """
+        new_ids = [song_id for song_id in dict.fromkeys(song_ids) if song_id not in self.index["song_cluster"]]
+        if new_ids == []:
+            return {song_id: self.index["song_cluster"][song_id] for song_id in song_ids}
+
+        found_ids, clusters, scaled = new_songs_features(new_ids, self.model, self.sp)
+
+        if insert and found_ids != []:
+            self.index = add_new_songs(self.index, found_ids, clusters, scaled, self.sp)
+            if self.ann is not None:
+                #Only the songs that reached the index (the ones with a name) can be recommended
+                added_ids = [song_id for song_id in found_ids if song_id in self.index["song_row"]]
+                self.ann.add(self.index["features"][[self.index["song_row"][song_id] for song_id in added_ids]],
+                             added_ids)
+            #The trees and the norms belong to the previous features matrix
+            self._trees = None
+            self._norms = None
+            for song_id in found_ids:
+                if song_id in self.index["song_info"]:
+                    song_name, artist_name = self.index["song_info"][song_id]
+                    self.spotify_index.add(song_name.lower(), song_id)
+            spotify_helper_functions.add_local_songs(self.index["song_info"])
+
+        clusters_dict = {song_id: self.index["song_cluster"][song_id] for song_id in song_ids
+                         if song_id in self.index["song_cluster"]}
+        clusters_dict.update({song_id: int(cluster) for song_id, cluster in zip(found_ids, clusters)})
+
+        return clusters_dict
+
+    @metrics.timed("Recommender.recommend")
+    def recommend(self, song_id, n=5, mode="random", n_clusters=1, use_trees=False, insert_new=False, nprobe=4,
+                  rerank=100):
+        """
+        Method that returns n recommendations for a song id, without printing anything.
+        mode="nearest" ranks the songs by similarity (see recommend_spotify_songs), optionally
+        using KD-trees for each cluster, which are built the first time they are needed. With a
+        precomputed table, the nearest songs of the catalog songs are read from it.
+        mode="ann" searches the whole catalog with the approximate nearest neighbours index, scanning
+        the lists of the nprobe closest centroids and reranking the best rerank candidates.
+        With insert_new=True a song that is not in the catalog is added to the index first.
+        Output: a list of tuples (song_id, song_name, artist_name).
+        """
+        if insert_new and song_id not in self.index["song_cluster"]:
+            self.predict_new_songs([song_id], insert=True)
+
+        #The nearest songs in the same cluster are precomputed for the songs of the table. Once songs
+        #are inserted in the index the table may miss closer songs, so it is not used anymore
+        if mode == "nearest" and n_clusters == 1 and self.table is not None and n <= self.table.k \
+                and song_id in self.table and len(self.index["song_row"]) == len(self.table):
+            recommendations = []
+            for song_rec_id, distance in self.table.lookup(song_id, n):
+                if song_rec_id not in self.index["song_info"]:
+                    continue
+                song_rec_name, song_rec_artist = self.index["song_info"][song_rec_id]
+                recommendations.append((song_rec_id, song_rec_name.capitalize(), song_rec_artist.capitalize()))
+            return recommendations
+
+        #The connection is only needed for songs outside of the index
+        sp = self._sp if song_id in self.index["song_cluster"] else self.sp
+
+        if mode == "ann":
+            if self.ann is None:
+                raise ValueError("mode=\"ann\" needs the index of ann_index (ann_path).")
+            cluster, features = seed_song(song_id, self._spotify_df, self.model, sp, self.index)
+            recommendations = []
+            for song_rec_id, distance in self.ann.search(features, k=n, nprobe=nprobe, rerank=rerank,
+                                                         exclude={song_id}):
+                if song_rec_id not in self.index["song_info"]:
+                    continue
+                song_rec_name, song_rec_artist = self.index["song_info"][song_rec_id]
+                recommendations.append((song_rec_id, song_rec_name.capitalize(), song_rec_artist.capitalize()))
+            return recommendations
+
+        trees = None
+        if mode == "nearest" and use_trees:
+            if self._trees is None:
+                self._trees = build_cluster_trees(self.index)
+            trees = self._trees
+
+        return recommend_spotify_songs(song_id, self._spotify_df, self.model, sp, self.index, n=n,
+                                       verbose=False, mode=mode, n_clusters=n_clusters, trees=trees)
+
+    @metrics.timed("Recommender.recommend_playlist")
+    def recommend_playlist(self, seed_ids, n=10, profile="centroid", insert_new=False):
+        """
+        Method that recommends n songs for a list of seed song ids (see recommend_playlist).
+        With insert_new=True the seeds that are not in the catalog are added to the index first.
+        Output: a list of tuples (song_id, song_name, artist_name).
+        """
+        if insert_new:
+            self.predict_new_songs(seed_ids, insert=True)
+
+        #The connection is only needed for songs outside of the index
+        sp = self._sp if all(song_id in self.index["song_row"] for song_id in seed_ids) else self.sp
+
+        if self._norms is None:
+            features = self.index["features"]
+            self._norms = np.einsum("ij,ij->i", features, features)
+
+        recommendations = []
+        for song_rec_id, distance in recommend_playlist(seed_ids, self.model, sp, self.index, n=n,
+                                                        profile=profile, norms=self._norms):
+            song_rec_name, song_rec_artist = self.index["song_info"][song_rec_id]
+            recommendations.append((song_rec_id, song_rec_name.capitalize(), song_rec_artist.capitalize()))
+
+        return recommendations
+
+
+def song_recommender(n = 5, recommender=None):
+
+    #We load the datasets, the model and the index, unless we already have them in memory
+    if recommender is None:
+        recommender = Recommender()
+
+    top_df = recommender.top_df
+    spotify_df = recommender.spotify_df
+    model = recommender.model
+    index = recommender.index
 
     user_input = input("Please insert the name of the song that you like: ").lower()
 
+    match = recommender.match(user_input)
+
     #1. First we check if it is in the top df, and we offer the choice to the user
-    top_song = is_top_song(user_input, top_df)  #This value will be [] if there are no similar songs
+    top_song = match["top_songs"]  #This value will be [] if there are no similar songs
 
     if top_song != []:
         if len(top_song) == 1:
-            top_recommended = recommend_top_song(top_song[0], top_df)
+            top_recommended = recommend_top_song(top_song[0], top_df, table=recommender.top_table)
             return 0
         else:
-            song_choice = choice(top_song, spotify_df, sp, names_or_ids="names")
-            top_recommended = recommend_top_song(song_choice, top_df)
+            song_choice = choice(top_song, spotify_df, None, names_or_ids="names")
+            top_recommended = recommend_top_song(song_choice, top_df, table=recommender.top_table)
             return 0
 
     #2. If the song is not in the top list, we search in the spotify_df
-    spoti_song = is_spotify_song(user_input, spotify_df)
+    spoti_song = match["spotify_songs"]
+
+    #We create the Spotify connection
+    sp = recommender.sp
 
     #If we didn't find it in the dataframe
     if spoti_song == []:
@@ -172,8 +668,7 @@ def song_recommender(n = 5):
         possible_tracks = spotify_helper_functions.find_possible_songs(user_input,sp)
         if possible_tracks:
             song_choice_id = choice(list(possible_tracks.values()), spotify_df, sp)
-            for _ in range(n):
-                spoti_recommended = recommend_spotify_song(song_choice_id, spotify_df, model, sp)
+            spoti_recommended = recommend_spotify_songs(song_choice_id, spotify_df, model, sp, index, n=n)
             return 0
         else:
             print("Sorry, we didn't find any matches in Spotify")
@@ -182,21 +677,25 @@ def song_recommender(n = 5):
         song_id = spoti_song[0]
         song_info = spotify_helper_functions.get_song_info(song_id, sp)
         print(f"One match found in our songs database! {song_info[0].capitalize()}, by {song_info[1].capitalize()}")
-        for _ in range(n):
-            spoti_recommended = recommend_spotify_song(spoti_song[0], spotify_df, model, sp)
+        spoti_recommended = recommend_spotify_songs(spoti_song[0], spotify_df, model, sp, index, n=n)
         return 0
     #If we found more than one match
     else:
         print("Several matches found in our songs database!")
         song_choice_id = choice(spoti_song, spotify_df, sp)
-        for _ in range(n):
-            spoti_recommended = recommend_spotify_song(song_choice_id, spotify_df, model, sp)
+        spoti_recommended = recommend_spotify_songs(song_choice_id, spotify_df, model, sp, index, n=n)
         return 0
 
 
 def main():
 
-    song_recommender()
+    #With SPOTI_RECO_METRICS=1 we print where the time of the run was spent
+    with metrics.trace() as spans:
+        song_recommender()
+
+    if metrics.registry.enabled:
+        print(f"\nTrace of the run ({spans.total_ms():.1f} ms):")
+        print(spans.format())
     
 
 
@@ -0,0 +1,155 @@
+import re
+import sqlite3
+import unicodedata
+import pandas as pd
+import spotify_helper_functions
+
+FEATURES = spotify_helper_functions.SELECTED_FEATURES
+
+#Status of the features of a track
+PENDING, FETCHED, UNAVAILABLE = 0, 1, -1
+
+
+def normalize(name):
+    """
+    Function that normalizes a name for lookups: lowercase, without accents and with single spaces.
+    """
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode()
+    return re.sub(r"\s+", " ", name).strip().lower()
+
+
+class Registry:
+    """
+    SQLite registry of the artists and tracks seen by the scrapers, keyed by their Spotify ids, so
+    two artists or songs with the same name are kept apart and each id is stored once.
+    The features of each track are stored with it, so the crawls only ask Spotify for the features
+    of ids that were never fetched before (also in later runs).
+    """
+
+    def __init__(self, path="spotify_registry.db"):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        feature_columns = ", ".join(f"{feature} REAL" for feature in FEATURES)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS artists "
+                                    "(artist_id TEXT PRIMARY KEY, artist_name TEXT, normalized_name TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (song_id TEXT PRIMARY KEY, song_name TEXT, "
+                                    "normalized_name TEXT, artist_id TEXT, artist_name TEXT, "
+                                    f"status INTEGER DEFAULT {PENDING}, {feature_columns})")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS artists_names ON artists (normalized_name)")
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def add_artists(self, artists):
+        """
+        Method that registers artists (dictionary artist_id -> artist_name).
+        Output: the dictionary with the artists that were not registered yet.
+        """
+        known = self._existing("artists", "artist_id", list(artists))
+        new_artists = {artist_id: artist_name for artist_id, artist_name in artists.items() if artist_id not in known}
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO artists VALUES (?, ?, ?)",
+                                        [(artist_id, artist_name, normalize(artist_name))
+                                         for artist_id, artist_name in new_artists.items()])
+        return new_artists
+
+    def find_artists(self, name):
+        """
+        Method that returns the registered artists with a name (ignoring case and accents), as a
+        dictionary artist_id -> artist_name.
+        """
+        rows = self.connection.execute("SELECT artist_id, artist_name FROM artists WHERE normalized_name = ?",
+                                       (normalize(name),))
+        return dict(rows.fetchall())
+
+    def add_tracks(self, songs):
+        """
+        Method that registers tracks (dictionaries with song_name, song_id, artist_name and artist_id)
+        and their artists. Repeated ids are only registered once.
+        Output: the list of songs that were not registered yet, without repetitions.
+        """
+        unique_songs = {}
+        for song in songs:
+            unique_songs.setdefault(song["song_id"], song)
+        known = self._existing("tracks", "song_id", list(unique_songs))
+        new_songs = [song for song_id, song in unique_songs.items() if song_id not in known]
+
+        self.add_artists({song["artist_id"]: song["artist_name"] for song in new_songs})
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO tracks (song_id, song_name, normalized_name, artist_id, "
+                                        "artist_name) VALUES (?, ?, ?, ?, ?)",
+                                        [(song["song_id"], song["song_name"], normalize(song["song_name"]),
+                                          song["artist_id"], song["artist_name"]) for song in new_songs])
+        return new_songs
+
+    def add_songs_df(self, df):
+        """
+        Method that registers the songs of a dataframe with their features (like spotify_songs.csv),
+        so they are never requested again.
+        """
+        df = df.drop_duplicates(subset="song_id")
+        self.add_tracks(df[["song_name", "song_id", "artist_name", "artist_id"]].to_dict("records"))
+        self.save_features(df.set_index("song_id")[FEATURES].to_dict("index"), df["song_id"].tolist())
+
+    def missing_features(self, song_ids):
+        """
+        Method that returns the ids (in order, without repetitions) whose features were never requested.
+        """
+        song_ids = list(dict.fromkeys(song_ids))
+        done = self._existing("tracks", "song_id", song_ids, f"status != {PENDING}")
+        return [song_id for song_id in song_ids if song_id not in done]
+
+    def save_features(self, attributes, requested_ids):
+        """
+        Method that stores the features of the requested tracks (dictionary song_id -> features). The
+        requested ids without features are marked as unavailable, so they aren't requested again.
+        """
+        assignments = ", ".join(f"{feature} = ?" for feature in FEATURES)
+        with self.connection:
+            self.connection.executemany(f"UPDATE tracks SET status = {FETCHED}, {assignments} WHERE song_id = ?",
+                                        [tuple(features.get(feature) for feature in FEATURES) + (song_id,)
+                                         for song_id, features in attributes.items()])
+            self.connection.executemany(f"UPDATE tracks SET status = {UNAVAILABLE} WHERE song_id = ?",
+                                        [(song_id,) for song_id in requested_ids if song_id not in attributes])
+
+    def songs_df(self, song_ids=None, columns=None):
+        """
+        Method that returns the tracks with features as a dataframe with the columns of the songs
+        datasets. With song_ids, only those tracks are read (in chunks, like _existing) and returned
+        in that order.
+        """
+        columns = columns if columns is not None else ["song_name", "song_id", "artist_name", "artist_id"] + FEATURES
+        select = f"SELECT {', '.join(columns)} FROM tracks WHERE status = {FETCHED}"
+        if song_ids is None:
+            df = pd.read_sql(select + " ORDER BY rowid", self.connection)
+        else:
+            song_ids = list(dict.fromkeys(song_ids))
+            chunks = [pd.read_sql(f"{select} AND song_id IN ({', '.join('?' * len(chunk))})", self.connection,
+                                  params=chunk)
+                      for chunk in (song_ids[start:start + 500] for start in range(0, len(song_ids), 500))]
+            df = pd.concat(chunks, ignore_index=True) if chunks else pd.read_sql(select + " AND 0", self.connection)
+            position = {song_id: position for position, song_id in enumerate(song_ids)}
+            df = df.iloc[df["song_id"].map(position).argsort()].reset_index(drop=True)
+
+        #The features are stored as REAL, but key and mode are integers in the datasets
+        for feature in ("key", "mode"):
+            if feature in df.columns:
+                df[feature] = df[feature].astype(int)
+        return df
+
+    def _existing(self, table, key, values, condition=None):
+        #SQLite limits the number of parameters of a query, so we ask in chunks
+        found = set()
+        where = f" AND {condition}" if condition else ""
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            rows = self.connection.execute(f"SELECT {key} FROM {table} WHERE {key} IN ({', '.join('?' * len(chunk))}){where}",
+                                           chunk)
+            found.update(value for (value,) in rows.fetchall())
+        return found
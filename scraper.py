@@ -4,9 +4,13 @@ import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from tqdm import tqdm
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import os
 import numpy as np
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 def import_top_songs():
     """
@@ -23,71 +27,172 @@ def import_top_songs():
         print("No dataframe with top songs found. Run create_songs_dataframe() to create it.")
         return 0
 
-def create_songs_dataframe():
+#Parsers of each chart source, registered with the chart_parser decorator
+CHART_SOURCES = {}
+
+#Seconds to wait for the connection and for the answer of each chart page
+TIMEOUT = (5, 30)
+
+def chart_parser(name, url):
     """
-    Function that secrapes songs and stores them in a csv. The sources for the songs are:
-    1) The hot 100 at billboard.com
-    2) The top 100 at popvortex.com
-    No input.
-    Returns the df
+    Decorator that registers a function as the parser of a chart source. The parser takes the html
+    of the page and returns a list of (song, artist) tuples.
     """
+    def decorator(function):
+        CHART_SOURCES[name] = {"url": url, "parser": function}
+        return function
+    return decorator
 
-    #Songs from hot 100 billboard
+@chart_parser("billboard", "https://www.billboard.com/charts/hot-100")
+def parse_billboard(html):
+    """
+    Parser of the hot 100 at billboard.com.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
 
-    #download the webpage
-    url = "https://www.billboard.com/charts/hot-100"
-    page = requests.get(url)
+    # Get a list with information about each of the 100 songs, and select the track and the artist
+    rows = []
+    for value in soup.find_all("span", {"class":"chart-element__information"}):
+        song = value.select_one("span.chart-element__information__song")
+        artist = value.select_one("span.chart-element__information__artist")
+        if song is not None and artist is not None:
+            rows.append((song.get_text(strip=True), artist.get_text(strip=True)))
 
-    if page.status_code != 200:
-        print(f"Error downloading the first page. Error {page.status_code}")
-        exit(0)
+    return rows
 
-    # parse the html
-    soup = BeautifulSoup(page.content, 'html.parser')
+@chart_parser("popvortex", "http://www.popvortex.com/music/charts/top-100-songs.php")
+def parse_popvortex(html):
+    """
+    Parser of the top 100 at popvortex.com.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
 
-    # Get a list with information about each of the 100 songs.
-    info = soup.find_all("span", {"class":"chart-element__information"})
+    rows = []
+    for elem in soup.find_all("p", {"class":"title-artist"}):
+        if elem.cite is not None and elem.em is not None:
+            rows.append((elem.cite.get_text(strip=True), elem.em.get_text(strip=True)))
 
-    #Select the relevant parts: track and artist
-    songs = []
-    artists = []
-    for value in info:
-        song = value.find_all("span", {"class": "chart-element__information__song text--truncate color--primary"})[0].get_text()
-        artist = value.find_all("span", {"class": "chart-element__information__artist text--truncate color--secondary"})[0].get_text()
-        songs.append(song)
-        artists.append(artist)
+    return rows
 
-    #Create the dataframe
-    df = pd.DataFrame(data={"songs":songs, "artists": artists})
+def make_session(pool_size=10, retries=2):
+    """
+    Function that returns a requests session with a pool of connections, which retries the
+    connection errors and the 5xx answers with backoff.
+    """
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "Mozilla/5.0 (spoti_reco chart scraper)"
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+def fetch_chart(name, session, cache_dir="chart_cache", timeout=TIMEOUT):
+    """
+    Function that downloads and parses a chart source. The ETag and Last-Modified headers of the
+    last download are sent back, so if the chart didn't change the server answers 304 and the rows
+    parsed the last time are used without downloading or parsing the page again.
+    Output: the list of (song, artist) tuples, or None if the source failed.
+    """
+    source = CHART_SOURCES[name]
+    cache_path = os.path.join(cache_dir, name + ".json")
 
-    #Download the second webpage
-    #download the webpage
-    url = "http://www.popvortex.com/music/charts/top-100-songs.php"
-    page = requests.get(url)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        page = session.get(source["url"], headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        print(f"Error downloading {name}: {e}")
+        return None
+
+    if page.status_code == 304 and cached is not None:
+        print(f"{name} didn't change since the last download")
+        return [tuple(row) for row in cached["rows"]]
 
     if page.status_code != 200:
-        print(f"Error downloading the second page. Error {page.status_code}")
-        exit(0)
+        print(f"Error downloading {name}. Error {page.status_code}")
+        return None
+
+    try:
+        rows = source["parser"](page.content)
+    except Exception as e:
+        print(f"Error parsing {name}: {e}")
+        return None
+
+    if rows == []:
+        print(f"No songs found in {name}. The page format may have changed.")
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump({"etag": page.headers.get("ETag"), "last_modified": page.headers.get("Last-Modified"),
+                   "rows": rows}, f)
+
+    return rows
+
+def fetch_charts(sources=None, session=None, workers=None, cache_dir="chart_cache", timeout=TIMEOUT):
+    """
+    Function that downloads several chart sources concurrently (all of them by default).
+    Output: a dictionary source -> list of (song, artist) tuples, without the sources that failed.
+    """
+    sources = list(sources) if sources is not None else list(CHART_SOURCES)
+    session = session if session is not None else make_session(pool_size=len(sources))
+
+    with ThreadPoolExecutor(max_workers=workers or len(sources)) as executor:
+        results = executor.map(lambda name: fetch_chart(name, session, cache_dir=cache_dir, timeout=timeout), sources)
+        charts = {name: rows for name, rows in zip(sources, results) if rows is not None}
 
-    # parse the html
-    soup = BeautifulSoup(page.content, 'html.parser')
+    return charts
+
+def parse_saved_page(name, path):
+    """
+    Function that parses a saved html page of a chart source (for example the fixtures in
+    fixtures/charts), to check the parsers without downloading anything.
+    """
+    with open(path, "rb") as f:
+        return CHART_SOURCES[name]["parser"](f.read())
+
+def create_songs_dataframe(sources=None, path="top_songs.csv", cache_dir="chart_cache"):
+    """
+    Function that secrapes songs and stores them in a csv. The sources for the songs are:
+    1) The hot 100 at billboard.com
+    2) The top 100 at popvortex.com
+    The sources are downloaded at the same time, and the ones that fail are skipped.
+    No input.
+    Returns the df (None if every source failed, in which case the csv is not overwritten)
+    """
+    sources = list(sources) if sources is not None else list(CHART_SOURCES)
+    charts = fetch_charts(sources, cache_dir=cache_dir)
 
-    #Get the information
-    title_artists = soup.find_all("p", {"class":"title-artist"})
+    if charts == {}:
+        print("Could not download any chart. The top songs were not updated.")
+        return None
 
-    #We include them in the dataframe
-    for elem in title_artists:
-        track = elem.cite.string
-        artist = elem.em.string
-        df = df.append({"songs":track, "artists": artist}, ignore_index=True)
+    #Create the dataframe, keeping the order of the sources
+    rows = [row for name in sources if name in charts for row in charts[name]]
+    df = pd.DataFrame(data=rows, columns=["songs", "artists"])
 
     #Dropping dupllicated songs and resetting the index.
     df = df.drop_duplicates(subset="songs").reset_index(drop=True)
 
     #Saving the datframe in a csv
-    df.to_csv("top_songs.csv")
+    df.to_csv(path)
 
-    print("Dataframe with top songs created: top_songs.csv")
+    print(f"Dataframe with top songs created from {', '.join(charts)}: {path}")
 
     return df
 
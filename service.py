@@ -0,0 +1,235 @@
+import asyncio
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from spotipy.exceptions import SpotifyException
+import recommender
+import crawler
+import metrics
+
+#Maximum size of a request body (the /playlist json)
+MAX_BODY = 1024 * 1024
+
+#Values accepted for the mode of /recommend ("ann" only with the index of ann_index) and the profile of /playlist
+MODES = ("random", "nearest", "ann")
+PROFILES = ("centroid", "mixture")
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+def positive_int(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError(f"{value} is not positive")
+    return value
+
+
+class RecommenderService:
+    """
+    Small asyncio HTTP service on top of a warm Recommender. Endpoints (json answers):
+    - GET /match?q=<song name>
+    - GET /recommend?song_id=<id>&n=<number>&mode=<random|nearest|ann>&n_clusters=<number>
+    - POST /playlist with a json body {"song_ids": [...], "n": 10, "profile": "centroid|mixture"}
+      (or GET /playlist?song_ids=<id>,<id>&n=10)
+    - GET /metrics: the latency histograms and error counts in the Prometheus text format.
+    With trace=1 in the query, the answer includes the spans of the instrumented calls of the
+    request (metrics must be enabled, see metrics.enable).
+    Queries answered from the catalog run on the event loop. The ones that need Spotify (songs
+    outside the catalog) run in a thread pool, so they don't block the other requests.
+    Wrong parameters are answered with 400, and songs that are neither in the catalog nor in
+    Spotify with 404.
+    """
+
+    def __init__(self, reco=None, workers=8, **recommender_kwargs):
+        self.recommender = reco if reco is not None else recommender.Recommender(**recommender_kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.routes = {"/match": self.match, "/recommend": self.recommend, "/playlist": self.playlist,
+                       "/metrics": self.metrics_text}
+
+    def modes(self):
+        return MODES if self.recommender.ann is not None else tuple(mode for mode in MODES if mode != "ann")
+
+    def in_catalog(self, song_ids):
+        return all(song_id in self.recommender.index["song_cluster"] for song_id in song_ids)
+
+    async def run(self, in_catalog, function, *args, **kwargs):
+        try:
+            if in_catalog:
+                return function(*args, **kwargs)
+            loop = asyncio.get_running_loop()
+            #The context is copied so the calls made in the thread are added to the trace of the request
+            return await loop.run_in_executor(self.executor, metrics.run_in_context(function, *args, **kwargs))
+        except recommender.SongNotFoundError as e:
+            raise HTTPError(404, str(e))
+        except SpotifyException as e:
+            #Spotify answers 400 to malformed ids and 404 to unknown ones
+            if e.http_status in (400, 404):
+                raise HTTPError(404, "Song not found in Spotify")
+            #When Spotify limits our rate, the client is asked to come back when it lets us in again
+            if e.http_status == 429:
+                raise HTTPError(503, "Spotify rate limit reached", {"Retry-After": str(math.ceil(crawler.retry_after(e)))})
+            raise
+
+    @staticmethod
+    def convert(name, value, cast=str, choices=None):
+        try:
+            value = cast(value)
+        except (ValueError, TypeError):
+            raise HTTPError(400, f"Wrong value for parameter: {name}")
+        if choices is not None and value not in choices:
+            raise HTTPError(400, f"Wrong value for parameter: {name} (expected one of {', '.join(choices)})")
+        return value
+
+    @classmethod
+    def parameter(cls, query, name, default=None, cast=str, choices=None):
+        if name not in query:
+            if default is None:
+                raise HTTPError(400, f"Missing parameter: {name}")
+            return default
+        return cls.convert(name, query[name][0], cast, choices)
+
+    @staticmethod
+    def songs_json(recommendations):
+        return [{"song_id": song_id, "song_name": song_name, "artist_name": artist_name}
+                for song_id, song_name, artist_name in recommendations]
+
+    async def match(self, method, query, body):
+        return self.recommender.match(self.parameter(query, "q"))
+
+    async def recommend(self, method, query, body):
+        song_id = self.parameter(query, "song_id")
+        n = self.parameter(query, "n", 5, positive_int)
+        mode = self.parameter(query, "mode", "random", choices=self.modes())
+        n_clusters = self.parameter(query, "n_clusters", 1, positive_int)
+
+        recommendations = await self.run(self.in_catalog([song_id]), self.recommender.recommend, song_id,
+                                         n=n, mode=mode, n_clusters=n_clusters)
+        return {"song_id": song_id, "recommendations": self.songs_json(recommendations)}
+
+    async def playlist(self, method, query, body):
+        if method == "POST":
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "The body must be json")
+            if not isinstance(request, dict):
+                raise HTTPError(400, "The body must be a json object")
+            song_ids = request.get("song_ids", [])
+            if not isinstance(song_ids, list) or not all(isinstance(song_id, str) for song_id in song_ids):
+                raise HTTPError(400, "Wrong value for parameter: song_ids")
+            n = self.convert("n", request.get("n", 10), positive_int)
+            profile = self.convert("profile", request.get("profile", "centroid"), choices=PROFILES)
+        else:
+            song_ids = [song_id for song_id in self.parameter(query, "song_ids").split(",") if song_id]
+            n = self.parameter(query, "n", 10, positive_int)
+            profile = self.parameter(query, "profile", "centroid", choices=PROFILES)
+
+        if not song_ids:
+            raise HTTPError(400, "Missing parameter: song_ids")
+
+        recommendations = await self.run(self.in_catalog(song_ids), self.recommender.recommend_playlist,
+                                         song_ids, n=n, profile=profile)
+        return {"song_ids": song_ids, "recommendations": self.songs_json(recommendations)}
+
+    async def metrics_text(self, method, query, body):
+        return metrics.registry.prometheus()
+
+    async def handle_request(self, method, target, body):
+        url = urlsplit(target)
+        route = self.routes.get(url.path)
+        if route is None:
+            raise HTTPError(404, f"Unknown path: {url.path}")
+        if method not in ("GET", "POST"):
+            raise HTTPError(405, f"Method not allowed: {method}")
+
+        query = parse_qs(url.query)
+        if query.get("trace") != ["1"]:
+            with metrics.timer("service" + url.path):
+                return await route(method, query, body)
+
+        with metrics.trace() as spans, metrics.timer("service" + url.path):
+            answer = await route(method, query, body)
+        if isinstance(answer, dict):
+            answer["trace"] = sorted(spans, key=lambda span: span["start_ms"])
+        return answer
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                extra_headers = {}
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length > MAX_BODY:
+                        raise HTTPError(413, "Request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    status, answer = 200, await self.handle_request(method, target, body)
+                except HTTPError as e:
+                    status, answer = e.status, {"error": e.message}
+                    extra_headers = e.headers
+                except Exception as e:
+                    status, answer = 500, {"error": str(e)}
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                #Text answers (the metrics) are sent as they are, the rest as json
+                if isinstance(answer, str):
+                    payload, content_type = answer.encode(), "text/plain; version=0.0.4"
+                else:
+                    payload, content_type = json.dumps(answer).encode(), "application/json"
+                header_lines = "".join(f"{name}: {value}\r\n" for name, value in extra_headers.items())
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n{header_lines}\r\n".encode() + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        print(f"Recommender service listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main(host="127.0.0.1", port=8000, **recommender_kwargs):
+    metrics.enable()
+    service = RecommenderService(**recommender_kwargs)
+    asyncio.run(service.serve(host=host, port=port))
+
+    return 0
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,167 @@
+import pickle
+import numpy as np
+import metrics
+
+#Functions to build, update and store the recommendation index (see clustering_music.create_index).
+#They only need NumPy, so the serving side and the refresh job can use them without scikit-learn.
+
+
+def assemble_index(song_ids, song_names, artist_names, clusters, scaled):
+    """
+    Function that builds the recommendation index from the songs information, their clusters
+    and their scaled features (see clustering_music.create_index).
+    """
+    clusters = np.asarray(clusters)
+
+    #Stable sort, so the songs keep the dataset order inside each cluster
+    order = np.argsort(clusters, kind="stable")
+    clusters = clusters[order]
+    features = np.ascontiguousarray(np.asarray(scaled)[order], dtype=np.float32)
+    song_ids = np.asarray(song_ids, dtype=object)[order].tolist()
+    song_names = np.asarray(song_names, dtype=object)[order]
+    artist_names = np.asarray(artist_names, dtype=object)[order]
+
+    song_cluster = {}
+    song_row = {}
+    song_info = {}
+    for row, (song_id, song_name, artist_name, cluster) in enumerate(zip(song_ids, song_names,
+                                                                        artist_names, clusters)):
+        song_cluster[song_id] = int(cluster)
+        song_row[song_id] = row
+        song_info[song_id] = (song_name, artist_name)
+
+    cluster_songs = {}
+    cluster_slices = {}
+    for cluster in np.unique(clusters):
+        start, end = np.searchsorted(clusters, [cluster, cluster + 1])
+        cluster_slices[int(cluster)] = (int(start), int(end))
+        cluster_songs[int(cluster)] = song_ids[start:end]
+
+    return {"song_cluster": song_cluster, "cluster_songs": cluster_songs, "song_info": song_info,
+            "features": features, "song_ids": song_ids, "song_row": song_row,
+            "cluster_slices": cluster_slices, "cluster_extra": {}}
+
+
+def index_clusters(index):
+    """
+    Function that returns the cluster of each row of the index features matrix.
+    """
+    clusters = np.empty(len(index["song_ids"]), dtype=np.int32)
+    for cluster, (start, end) in index["cluster_slices"].items():
+        clusters[start:end] = cluster
+    for cluster, rows in index.get("cluster_extra", {}).items():
+        clusters[rows] = cluster
+
+    return clusters
+
+
+def cluster_features(index, cluster):
+    """
+    Function that returns the rows of the songs of a cluster and their scaled features: the slice of
+    the block sorted by cluster, followed by the songs inserted later with insert_songs.
+    """
+    start, end = index["cluster_slices"].get(cluster, (0, 0))
+    extra = index.get("cluster_extra", {}).get(cluster, [])
+    if extra == []:
+        return np.arange(start, end), index["features"][start:end]
+
+    rows = np.concatenate([np.arange(start, end), extra])
+    return rows, index["features"][rows]
+
+
+def insert_songs(index, song_ids, song_names, artist_names, clusters, scaled):
+    """
+    Function that adds songs, whose clusters and scaled features are already computed, to an index.
+    Songs already in the index are skipped. The index is updated in place: the new songs are appended
+    after the block sorted by cluster, their features are copied to a buffer that doubles its capacity
+    when it is full, and their rows are kept by cluster in cluster_extra. So inserting songs one by one
+    costs the same as inserting them at once (see compact_index to sort them again).
+    The names are stored as they are given (the fuzzy matching indexes keep them in lowercase).
+    Output: the updated index.
+    """
+    new_rows = [position for position, song_id in enumerate(song_ids) if song_id not in index["song_cluster"]]
+    new_rows = list({song_ids[position]: position for position in new_rows}.values())
+    if new_rows == []:
+        return index
+
+    scaled = np.asarray(scaled, dtype=np.float32)[new_rows]
+    n_songs = len(index["song_ids"])
+    n_total = n_songs + len(new_rows)
+
+    buffer = index.get("features_buffer")
+    if buffer is None or len(buffer) < n_total:
+        buffer = np.empty((max(2 * n_songs, n_total), scaled.shape[1]), dtype=np.float32)
+        buffer[:n_songs] = index["features"]
+        index["features_buffer"] = buffer
+    buffer[n_songs:n_total] = scaled
+    index["features"] = buffer[:n_total]
+
+    #The rows are registered in cluster_extra last, once the song is complete
+    cluster_extra = index.setdefault("cluster_extra", {})
+    for row, position in enumerate(new_rows, start=n_songs):
+        song_id = song_ids[position]
+        cluster = int(clusters[position])
+        index["song_ids"].append(song_id)
+        index["song_cluster"][song_id] = cluster
+        index["song_row"][song_id] = row
+        index["song_info"][song_id] = (song_names[position], artist_names[position])
+        index["cluster_songs"].setdefault(cluster, []).append(song_id)
+        cluster_extra.setdefault(cluster, []).append(row)
+
+    return index
+
+
+def compact_index(index):
+    """
+    Function that sorts the songs inserted with insert_songs into the block sorted by cluster (each
+    one after the songs of its cluster), so the index is stored without the buffer.
+    Output: the compacted index (the same one if there were no inserted songs).
+    """
+    if not any(index.get("cluster_extra", {}).values()):
+        return index
+
+    names = [index["song_info"][song_id] for song_id in index["song_ids"]]
+    return assemble_index(index["song_ids"], [song_name for song_name, artist_name in names],
+                          [artist_name for song_name, artist_name in names], index_clusters(index),
+                          index["features"])
+
+
+def update_index(index, model, new_df):
+    """
+    Function that adds new songs to a recommendation index. Only the new songs go through the
+    model (the sklearn pipeline or the light_model.LightModel); the songs already in the index keep their cluster.
+    Input: the index, the model and a dataframe with the new songs (songs already indexed are skipped).
+    Output: the updated index.
+    """
+    new_df = new_df.drop_duplicates(subset="song_id")
+    new_df = new_df.loc[~new_df["song_id"].isin(index["song_cluster"])]
+    if len(new_df) == 0:
+        return index
+
+    modeling_df = new_df.drop(columns=["song_name", "artist_name", "artist_id", "song_id"])
+    new_clusters = model.predict(modeling_df)
+    new_scaled = model[:-1].transform(modeling_df)
+
+    return insert_songs(index, new_df["song_id"].tolist(), new_df["song_name"].tolist(),
+                        new_df["artist_name"].tolist(), new_clusters, new_scaled)
+
+
+def save_index(index, path="music_index.pkl"):
+    #The songs inserted since the index was built are sorted into their clusters
+    with open(path, "wb") as f:
+        pickle.dump(compact_index(index), f)
+
+    return 0
+
+
+@metrics.timed("load_index")
+def load_index(path="music_index.pkl"):
+
+    try:
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+    except FileNotFoundError:
+        print("Recommendation index not found! Run save_model() with the songs dataframe.")
+        index = None
+
+    return index
@@ -0,0 +1,194 @@
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from copy import deepcopy
+
+#Seconds that the answers of each endpoint are kept
+DAY = 24 * 60 * 60
+DEFAULT_TTLS = {"get_song_info": 30 * DAY,
+                "find_possible_songs": DAY,
+                "search_artists": 7 * DAY,
+                "get_top_tracks": 7 * DAY,
+                "get_related_artists": 7 * DAY}
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    In memory cache with a maximum number of entries. Each entry has an expiration time, and
+    when the cache is full the least recently used entry is removed.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires=None):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteCache:
+    """
+    On disk cache, shared between runs (and processes) of the program. Values are pickled.
+    """
+
+    def __init__(self, path="spotify_cache.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return MISSING, None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return MISSING, None
+        return pickle.loads(value), expires
+
+    def set(self, key, value, expires=None):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                                    (key, pickle.dumps(value), expires))
+
+    def close(self):
+        self.connection.close()
+
+
+class SpotifyCache:
+    """
+    Cache for the answers of the Spotify helper functions. Answers are looked up in this order:
+    1) local data registered with add_local (for example the songs of the catalog), which never expires,
+    2) the in memory LRU cache,
+    3) the optional SQLite cache (given with path), whose hits are copied to memory.
+    Each endpoint has its own time to live (ttls, in seconds; None means it doesn't expire).
+    The cached answers are kept per scope (the client that gave them, see
+    spotify_helper_functions.client_scope); the local data is shared by all the scopes.
+    The hits of each tier and the misses are counted per endpoint.
+    """
+
+    def __init__(self, maxsize=10000, path=None, ttls=None):
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.memory = LRUCache(maxsize=maxsize)
+        self.disk = SQLiteCache(path) if path is not None else None
+        self.local = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, endpoint, tier):
+        with self.lock:
+            self.counters[(endpoint, tier)] += 1
+
+    @staticmethod
+    def _key(endpoint, query, scope=None):
+        if scope is None:
+            return f"{endpoint}:{query}"
+        return f"{scope}/{endpoint}:{query}"
+
+    def add_local(self, endpoint, values):
+        """
+        Method that registers local answers for an endpoint, as a dictionary query -> answer.
+        """
+        self.local.setdefault(endpoint, {}).update(values)
+
+    def get(self, endpoint, query, scope=None):
+        """
+        Method that returns the cached answer of an endpoint to a query, or MISSING if there is none.
+        """
+        if query in self.local.get(endpoint, {}):
+            self._count(endpoint, "local")
+            return self.local[endpoint][query]
+
+        key = self._key(endpoint, query, scope)
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self._count(endpoint, "memory")
+            return deepcopy(value)
+
+        if self.disk is not None:
+            value, expires = self.disk.get(key)
+            if value is not MISSING:
+                self._count(endpoint, "disk")
+                self.memory.set(key, value, expires)
+                return deepcopy(value)
+
+        self._count(endpoint, "miss")
+        return MISSING
+
+    def set(self, endpoint, query, value, scope=None):
+        ttl = self.ttls.get(endpoint)
+        expires = time.time() + ttl if ttl is not None else None
+        key = self._key(endpoint, query, scope)
+        value = deepcopy(value)
+
+        self.memory.set(key, value, expires)
+        if self.disk is not None:
+            self.disk.set(key, value, expires)
+
+    def stats(self):
+        """
+        Method that returns the hits and misses of each endpoint, and the share of calls that didn't reach Spotify.
+        """
+        stats = {}
+        with self.lock:
+            counters = dict(self.counters)
+        for (endpoint, tier), count in counters.items():
+            stats.setdefault(endpoint, {"local": 0, "memory": 0, "disk": 0, "miss": 0})[tier] = count
+
+        for endpoint, counts in stats.items():
+            total = sum(counts.values())
+            counts["hit_rate"] = (total - counts["miss"]) / total if total else 0.0
+
+        return stats
+
+    def report(self):
+        for endpoint, counts in self.stats().items():
+            print(f"{endpoint}: {counts['local']} local, {counts['memory']} memory and {counts['disk']} disk hits, "
+                  f"{counts['miss']} misses (hit rate = {counts['hit_rate']:.1%})")
+
+
+#Cache used by spotify_helper_functions. It can be replaced with configure()
+default_cache = SpotifyCache()
+
+
+def configure(maxsize=10000, path=None, ttls=None):
+    """
+    Function that replaces the cache used by the Spotify helpers, for example to add the SQLite tier
+    with path="spotify_cache.db".
+    """
+    global default_cache
+    default_cache = SpotifyCache(maxsize=maxsize, path=path, ttls=ttls)
+
+    return default_cache
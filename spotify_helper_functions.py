@@ -1,46 +1,249 @@
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import CacheFileHandler
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import functools
+import os
+import sys
+import threading
+import spotify_cache
+import metrics
 
-def spotify_connection(path=r"C:\Users\carlo\OneDrive\Programming\spotify.txt"):
+#Features of the songs that we store in the datasets, in this order
+SELECTED_FEATURES = ['danceability', 'energy', 
+'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+ 'instrumentalness', 'liveness', 'valence', 'tempo']
+
+#Maximum number of tracks that Spotify accepts in a single audio features / tracks request
+AUDIO_FEATURES_BATCH = 100
+TRACKS_BATCH = 50
+
+#Settings of the HTTP session shared by the Spotify clients
+REQUESTS_TIMEOUT = 10
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+POOL_SIZE = 16
+RETRY_STATUS = (429, 500, 502, 503, 504)
+#The sessions of the clients wrapped by crawler.RateLimitedClient don't retry the 429 answers: it pauses
+#all the threads with its shared token bucket, which retrying in each thread would defeat
+SERVER_ERROR_STATUS = (500, 502, 503, 504)
+
+#File where the access token is cached, so other processes reuse it until it expires
+TOKEN_CACHE = ".cache"
+
+#Credentials files (client id and secret, one per line) tried when there are no environment variables
+CREDENTIALS_PATHS = [os.path.join(os.path.expanduser("~"), ".spoti_reco", "spotify.txt"),
+                     r"C:\Users\carlo\OneDrive\Programming\spotify.txt"]
+
+#Clients shared by the recommender and the scrapers, created by get_client (with _client_kwargs). They
+#are keyed by rate_limited, the crawler's client being the one that leaves the 429 answers to it
+_clients = {}
+_client_kwargs = {}
+_client_lock = threading.Lock()
+
+class ServerErrorRetry(Retry):
+        #Retry-After is only waited in the 503 answers. The 429 ones are left to crawler.RateLimitedClient
+        RETRY_AFTER_STATUS_CODES = frozenset({503})
+
+def spotify_session(pool_size=POOL_SIZE, retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, rate_limited=False):
         """
-        Function that returns the Spotify client object. 
+        Function that returns a requests session with a pool of connections for the Spotify API.
+        The connection errors, the 429 and the 5xx answers are retried with exponential backoff (waiting
+        the Retry-After header when Spotify sends it). With rate_limited, for the clients wrapped by
+        crawler.RateLimitedClient, the 429 answers are not retried.
+        When the retries run out the answer is returned, so spotipy raises its SpotifyException with the status.
         """
-        try:
-                with open(path) as file:
-                        client_id = file.readline().strip()
-                        client_secret = file.readline().strip()
-        except:
-                client_id = input("Enter your client_id for the Spotify client: ")
-                client_secret = input("Enter your client_secret for the Spotify client: ")
+        if rate_limited:
+                retry_class, status_forcelist = ServerErrorRetry, SERVER_ERROR_STATUS
+        else:
+                retry_class, status_forcelist = Retry, RETRY_STATUS
+        retry = retry_class(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+                      allowed_methods=("GET", "POST"), respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
 
-        #Connect to spotify
-        try:
-                auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-        except:
-                print("Could not connect to Spotify. Try another client id and secret.")
-                exit()
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
 
-        sp = spotipy.Spotify(client_credentials_manager=auth_manager)
+        return session
+
+def read_credentials(path=None):
+        """
+        Function that returns the client id and secret of the Spotify client. They are taken from the
+        SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables, or from a credentials file
+        (path, the SPOTI_RECO_CREDENTIALS environment variable or CREDENTIALS_PATHS). They are only
+        asked with input() if the program runs in a terminal.
+        Output: a tuple (client_id, client_secret).
+        """
+        client_id = os.environ.get("SPOTIPY_CLIENT_ID")
+        client_secret = os.environ.get("SPOTIPY_CLIENT_SECRET")
+        if client_id and client_secret:
+                return client_id, client_secret
+
+        paths = [path, os.environ.get("SPOTI_RECO_CREDENTIALS")] + CREDENTIALS_PATHS
+        for credentials_path in paths:
+                if credentials_path and os.path.exists(credentials_path):
+                        with open(credentials_path) as file:
+                                return file.readline().strip(), file.readline().strip()
+
+        if not sys.stdin.isatty():
+                raise RuntimeError("No Spotify credentials found. Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET "
+                                   "or write them in a credentials file (SPOTI_RECO_CREDENTIALS).")
+
+        client_id = input("Enter your client_id for the Spotify client: ")
+        client_secret = input("Enter your client_secret for the Spotify client: ")
+        return client_id, client_secret
+
+@metrics.timed("spotify_connection")
+def spotify_connection(path=None, timeout=REQUESTS_TIMEOUT, retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                       pool_size=POOL_SIZE, cache_path=TOKEN_CACHE, session=None, rate_limited=False):
+        """
+        Function that returns a new Spotify client object.
+        The client and its token requests share a pooled session that retries the 429 and 5xx answers
+        (see spotify_session), and every request times out after timeout seconds. With rate_limited
+        the 429 answers are raised, for crawler.RateLimitedClient to slow down all the threads.
+        The token is cached in cache_path and reused by other processes while it is valid.
+        A different transport can be given with session (any requests.Session, for example one
+        with an adapter that answers from a local fake API).
+        """
+        client_id, client_secret = read_credentials(path)
+        own_session = session is None
+        if own_session:
+                session = spotify_session(pool_size=pool_size, retries=retries, backoff_factor=backoff_factor,
+                                          rate_limited=rate_limited)
+
+        #Connect to spotify
+        auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret,
+                                                requests_session=session, requests_timeout=timeout,
+                                                cache_handler=CacheFileHandler(cache_path=cache_path))
+        sp = spotipy.Spotify(client_credentials_manager=auth_manager, requests_session=session,
+                             requests_timeout=timeout)
+        #The answers of the helpers are cached per client id (see client_scope)
+        sp.cache_scope = f"spotify-{client_id}"
+        #The session already retries the server errors, so crawler.RateLimitedClient doesn't retry them again
+        sp.retries_server_errors = own_session and retries > 0
 
         return sp
 
+def get_client(rate_limited=False, **kwargs):
+        """
+        Function that returns the Spotify client shared by the whole process, creating it with
+        spotify_connection(**kwargs) the first time. The crawlers ask for the one with rate_limited,
+        whose session leaves the 429 answers to crawler.RateLimitedClient; the other one retries them.
+        Later calls with other settings raise a ValueError (spotify_connection creates a separate client).
+        With the environment variable SPOTI_RECO_SPOTIFY=fake the client is a fake_spotify.FakeSpotify,
+        so the programs run without network.
+        Clients given with set_client are returned whatever the settings.
+        """
+        with _client_lock:
+                if rate_limited not in _clients:
+                        if os.environ.get("SPOTI_RECO_SPOTIFY") == "fake":
+                                import fake_spotify
+                                _clients[rate_limited] = _clients.get(not rate_limited) or fake_spotify.FakeSpotify()
+                        else:
+                                _clients[rate_limited] = spotify_connection(rate_limited=rate_limited, **kwargs)
+                        _client_kwargs[rate_limited] = kwargs
+                elif _client_kwargs.get(rate_limited) is not None and kwargs and kwargs != _client_kwargs[rate_limited]:
+                        raise ValueError(f"The shared Spotify client was created with {_client_kwargs[rate_limited]}, "
+                                         f"not {kwargs}. Use spotify_connection for a client with other settings.")
+                return _clients[rate_limited]
+
+def set_client(client):
+        """
+        Function that replaces the shared Spotify clients (for example by a FakeSpotify in tests
+        and benchmarks). With None, the next get_client creates new ones.
+        """
+        with _client_lock:
+                _clients.clear()
+                _client_kwargs.clear()
+                if client is not None:
+                        _clients.update({False: client, True: client})
+                        _client_kwargs.update({False: None, True: None})
+
+def client_scope(sp):
+        """
+        Function that returns the name under which the answers of a Spotify client are cached, so the
+        answers of one client (other credentials, or a FakeSpotify) are never given to another one.
+        Wrappers of a client (like crawler.RateLimitedClient, which keeps it in .sp) share its scope.
+        Clients without a cache_scope attribute get one of their own for the life of the object.
+        """
+        while hasattr(sp, "sp") and not hasattr(sp, "cache_scope"):
+                sp = sp.sp
+        scope = getattr(sp, "cache_scope", None)
+        if scope is None:
+                scope = f"{type(sp).__name__}-{id(sp)}"
+        return scope
+
+def cached(endpoint):
+        """
+        Decorator for the helpers that take a query and the Spotify connection. The answers are stored
+        in spotify_cache.default_cache, with the time to live of the endpoint, in the scope of the client.
+        """
+        def decorator(function):
+                @functools.wraps(function)
+                def wrapper(query, sp):
+                        cache = spotify_cache.default_cache
+                        scope = client_scope(sp)
+                        value = cache.get(endpoint, query, scope)
+                        if value is spotify_cache.MISSING:
+                                value = function(query, sp)
+                                cache.set(endpoint, query, value, scope)
+                        return value
+                return wrapper
+        return decorator
+
+def add_local_songs(song_info):
+        """
+        Function that registers the names of songs that we already have (dictionary
+        song_id -> (song_name, artist_name), like the song_info of the recommendation index),
+        so get_song_info doesn't ask Spotify for them.
+        """
+        spotify_cache.default_cache.add_local("get_song_info", song_info)
+
+@cached("search_artists")
+def search_artists(name, sp):
+        """
+        Function that returns ids and names of artists, through a Spotify query.
+        Input: the name of an artist (string) and the Spotify object.
+        Output: a dictionary artist_id -> artist_name with the artists that it finds (None if there are none).
+        Artists with the same name are kept, because the dictionary is keyed by id.
+        """
+        with metrics.timer("spotify.search"):
+                info = sp.search(q="artist: " + name, type="artist")
+
+        if info["artists"]["items"] == []:
+                return None
+
+        return {item["id"]: item["name"] for item in info["artists"]["items"]}
+
 def find_artists(name, sp):
         """
         Function that returns names and ids of artists, through a Spotify query.
         Input: the name of an artist (string) and the Spotify object.
         Output: a dictionary with the artist/s name/s and id/s that it finds. 
         """
-        info = sp.search(q="artist: " + name, type="artist")
-        dict_artists = {}
+        artists = search_artists(name, sp)
+        if artists is None:
+                return None
 
-        if info["artists"]["items"] == []:
+        return {artist_name: artist_id for artist_id, artist_name in artists.items()}
+
+@cached("get_top_tracks")
+def get_top_tracks(artist_id, sp):
+        """
+        Function that takes the id of an artist and a spotify connection, and returns
+        a dictionary song_id -> song_name with the top songs of the artist (None if there are none).
+        """
+        with metrics.timer("spotify.artist_top_tracks"):
+                info = sp.artist_top_tracks(artist_id)
+
+        if info["tracks"] == []:
                 return None
 
-        for item in info["artists"]["items"]:
-                dict_artists[item["name"]] = item["id"]
-        
-        return dict_artists
+        return {song["id"]: song["name"] for song in info["tracks"] if song["id"]}
 
 def get_top_songs(artist_id, sp):
         """
@@ -49,16 +252,11 @@ def get_top_songs(artist_id, sp):
         Input: the id of the artist and the spotify connection.
         Output: a dictionary with songs names and ids.
         """
-        info = sp.artist_top_tracks(artist_id)
-        songs_dict = {}
-
-        if info["tracks"] == []:
+        songs = get_top_tracks(artist_id, sp)
+        if songs is None:
                 return None
 
-        for song in info["tracks"]:
-                songs_dict[song["name"]] = song["id"]
-
-        return songs_dict
+        return {song_name: song_id for song_id, song_name in songs.items()}
 
 def get_songs_attributes(song_id, sp):
         """
@@ -67,7 +265,8 @@ def get_songs_attributes(song_id, sp):
         Input: the track if and the spotify connection´.
         Output: a dictionary that stores selected songs features.
         """
-        info = sp.audio_features(song_id)
+        with metrics.timer("spotify.audio_features"):
+                info = sp.audio_features(song_id)
 
         if len(info) == 0:
                 return None
@@ -77,34 +276,66 @@ def get_songs_attributes(song_id, sp):
         if features == {} or type(features) != dict:
                 return None
 
-        selected_features = ['danceability', 'energy', 
-        'key', 'loudness', 'mode', 'speechiness', 'acousticness',
-         'instrumentalness', 'liveness', 'valence', 'tempo']
-
         final_dict = {}
 
         for key, value in features.items():
-                if key in selected_features:
+                if key in SELECTED_FEATURES:
                         final_dict[key] = value
         
         return final_dict
 
-def find_related_artists(artist_id,sp):
+def get_songs_attributes_batch(song_ids, sp, batch_size=AUDIO_FEATURES_BATCH):
+        """
+        Function that takes a list of track ids and returns their features, asking Spotify
+        for up to 100 tracks in each request instead of one request per track.
+        Input: the list of track ids (None entries and repeated ids are skipped) and the spotify connection.
+        Output: a dictionary song_id -> dictionary with the selected features. Tracks without
+        features in Spotify are left out.
+        """
+        unique_ids = list(dict.fromkeys(song_id for song_id in song_ids if song_id))
+        final_dict = {}
+
+        for start in range(0, len(unique_ids), batch_size):
+                batch = unique_ids[start:start + batch_size]
+                with metrics.timer("spotify.audio_features"):
+                        info = sp.audio_features(batch)
+
+                if not info:
+                        continue
+
+                for song_id, features in zip(batch, info):
+                        if features == {} or type(features) != dict:
+                                continue
+                        final_dict[song_id] = {key: features[key] for key in SELECTED_FEATURES if key in features}
 
-        related = sp.artist_related_artists(artist_id)
+        return final_dict
+
+@cached("get_related_artists")
+def get_related_artists(artist_id, sp):
+        """
+        Function that returns the related artists of an artist, as a dictionary artist_id -> artist_name.
+        """
+        with metrics.timer("spotify.artist_related_artists"):
+                related = sp.artist_related_artists(artist_id)
 
         if len(related) == 0:
                 return None
-        dict_related = {}
 
-        for artist in related["artists"]:
-                dict_related[artist["name"]] = artist["id"]
+        return {artist["id"]: artist["name"] for artist in related["artists"]}
 
-        return dict_related
+def find_related_artists(artist_id,sp):
 
+        related = get_related_artists(artist_id, sp)
+        if related is None:
+                return None
+
+        return {artist_name: related_id for related_id, artist_name in related.items()}
+
+@cached("find_possible_songs")
 def find_possible_songs(song_name, sp):
 
-        possible_tracks = sp.search(q="track: " + song_name, type="track")["tracks"]["items"]
+        with metrics.timer("spotify.search"):
+                possible_tracks = sp.search(q="track: " + song_name, type="track")["tracks"]["items"]
 
         if len(possible_tracks) == 0:
                 return None
@@ -116,9 +347,30 @@ def find_possible_songs(song_name, sp):
 
         return dict_tracks
 
+@cached("get_song_info")
 def get_song_info(song_id, sp):
 
-        song_info = sp.track(song_id)
+        with metrics.timer("spotify.track"):
+                song_info = sp.track(song_id)
         song_name = song_info["name"]
         artist_name = song_info["album"]["artists"][0]["name"]
-        return song_name, artist_name
\ No newline at end of file
+        return song_name, artist_name
+
+def get_songs_info_batch(song_ids, sp, batch_size=TRACKS_BATCH):
+        """
+        Function that returns the names and artists of several songs, asking Spotify for up to 50
+        tracks in each request. Songs registered with add_local_songs are not requested.
+        Output: a dictionary song_id -> (song_name, artist_name).
+        """
+        local_songs = spotify_cache.default_cache.local.get("get_song_info", {})
+        final_dict = {song_id: local_songs[song_id] for song_id in song_ids if song_id in local_songs}
+        missing_ids = list(dict.fromkeys(song_id for song_id in song_ids if song_id and song_id not in final_dict))
+
+        for start in range(0, len(missing_ids), batch_size):
+                with metrics.timer("spotify.tracks"):
+                        info = sp.tracks(missing_ids[start:start + batch_size])
+                for track in info["tracks"]:
+                        if track:
+                                final_dict[track["id"]] = (track["name"], track["album"]["artists"][0]["name"])
+
+        return final_dict
@@ -6,11 +6,30 @@ from tqdm import tqdm
 import requests
 import json
 import numpy as np
+import os
 import re
+import sys
 import spotify_helper_functions
 import scraper
+import crawler
+import checkpoint
+import registry
+import light_model
+import song_index
+import top_table
+import ann_index
 import time
 
+#Columns of the songs datasets
+COLUMNS = ['song_name', 'song_id', 'artist_name', 
+'artist_id'] + spotify_helper_functions.SELECTED_FEATURES
+
+#Number of artists whose top songs we collect before asking Spotify for their features
+ARTISTS_PER_BATCH = 10
+
+#Requests per second allowed to the crawler. Spotify uses a 30 seconds rolling window
+REQUESTS_PER_SECOND = 10
+
 def import_full_df():
     """
     Function that loads the top_songs.csv in a pandas dataframe.
@@ -27,122 +46,299 @@ def import_full_df():
         return 0
 
 
-def spotify_df(df):
+def songs_features_df(songs, sp, songs_registry=None):
+    """
+    Function that takes a list of songs (dictionaries with song_name, song_id, artist_name
+    and artist_id) and gets their features from Spotify in requests of up to 100 songs.
+    Repeated song ids are only requested once. With a registry.Registry, only the songs whose
+    features were never requested are sent to Spotify, and the new features are stored in it.
+    Output: a dataframe with the songs and their features. Songs without features are left out.
+    """
+    unique_songs = {}
+    for song in songs:
+        unique_songs.setdefault(song["song_id"], song)
+
+    if songs_registry is not None:
+        songs_registry.add_tracks(list(unique_songs.values()))
+        missing_ids = songs_registry.missing_features(list(unique_songs))
+        attributes = spotify_helper_functions.get_songs_attributes_batch(missing_ids, sp)
+        songs_registry.save_features(attributes, missing_ids)
+        return songs_registry.songs_df(song_ids=list(unique_songs), columns=COLUMNS)
+
+    attributes = spotify_helper_functions.get_songs_attributes_batch(list(unique_songs), sp)
+
+    rows = []
+    for song_id, song in unique_songs.items():
+        if song_id in attributes:
+            row = dict(song)
+            row.update(attributes[song_id])
+            rows.append(row)
+
+    return pd.DataFrame(data=rows, columns=COLUMNS)
+
+
+def spotify_df(df, registry_path="spotify_registry.db"):
     """
     Function that takes the dataframe with scraped songs-artists. 
     Through spotify it adds the top songs by the artists to the dataframe.
     Then it stores the dataframe and returns it.
+    The artists and songs are registered by id in the registry at registry_path, so the features
+    of songs seen in previous runs are not requested again.
     """
     #Initial list of artists that we obtain from the scraped dataset
     artist_list = df["artists"].unique().tolist()
 
     #Connection to spotify
-    sp = spotify_helper_functions.spotify_connection()
+    sp = spotify_helper_functions.get_client()
 
-    #We create a dictionary with artists and their ids
-    full_artists_dict = {}
-    for artist in artists_list:
-        artists_dict = spotify_helper_functions.find_artists(artist, sp)
+    #We create a dictionary with the ids of the artists and their names
+    artists = {}
+    for artist in artist_list:
+        artists_dict = spotify_helper_functions.search_artists(artist, sp)
         if artists_dict:
-            full_artists_dict.update(artists_dict)
-
-    #For each artist, we append the songs and their attributes to a dataframe
-    columns = ['song_name', 'song_id', 'artist_name', 
-    'artist_id', 'danceability', 'energy', 'key', 'loudness', 
-    'mode', 'speechiness', 'acousticness', 'instrumentalness', 
-    'liveness', 'valence', 'tempo']
-
-    full_df = pd.DataFrame(columns=columns)
-
-    #There will be nested for loops: for each artist we find the top songs.
-    #And for each song we get the attributes.
-    for artist_name, artist_id in full_artists_dict.items():
-        songs_dict = spotify_helper_functions.get_top_songs(artist_id, sp)
-
-        if songs_dict:
-            for song_name, song_id in songs_dict.items():
-                if song_id:
-                    attributes = spotify_helper_functions.get_songs_attributes(song_id, sp)
-                    if attributes:
-                        #We expand the attributes dictionary for each song with the artist and song info
-                        attributes.update({"artist_name":artist_name, "artist_id":artist_id,
-                            "song_name": song_name, "song_id":song_id})
-                        #And then we store all the data in the dataframe
-                        full_df = full_df.append(attributes, ignore_index=True)
+            artists.update(artists_dict)
+
+    #First we collect the top songs of every artist, and then we get the attributes of
+    #the songs that are not in the registry, in requests of 100 songs
+    songs_registry = registry.Registry(registry_path)
+    songs_registry.add_artists(artists)
+    songs = crawler.crawl_top_songs(artists, sp)
+
+    full_df = songs_features_df(songs, sp, songs_registry)
+    songs_registry.close()
 
     full_df = full_df.drop_duplicates(subset="song_id")
     full_df.to_csv("spotify_df.csv")
     print(f"Created dataset with the songs and features from Spotify. Total of {len(full_df)} songs.")
     return full_df
 
-def extend_df(df, save_path="final_df.csv"):
+def extend_df(df, save_path="final_df.csv", max_depth=1, max_artists=None, workers=8,
+              requests_per_second=REQUESTS_PER_SECOND, sp=None, checkpoint_path="crawl_checkpoint.db",
+              registry_path="spotify_registry.db"):
     """
     Function that takes the stored dataframe with spotify songs and their features, and
-    extends it with more songs from recommended artists
-    """
-
-    sp = spotify_helper_functions.spotify_connection()
-
-    #We extract the ids of the artists in the initial dataframe
-    artist_id_list = df["artist_id"].unique()
-
-    #We preload them in the extended dictionary in order to avoid repeating them
-    extended_artist_dict = {df.loc[df["artist_id"]==artist_id, \
-    "artist_name"].unique()[0]:artist_id for artist_id in artist_id_list}
-
-    #We introduce a count variable to sleep for 15 seconds every 15 artists. This way we avoid running over the 
-    #30 seconds rolling limit of the Spotify API
-    count = 0
-
-    #Now we iterate through the id list and use the function to find related artists, adding them
-    #to the dictionary
-    for artist_id in artist_id_list:
-        more_artists = spotify_helper_functions.find_related_artists(artist_id, sp)
-        if more_artists != None:
-            extended_artist_dict.update(more_artists)
-
-    #With the extended artist dictionary, we find the most popular songs and include them in the df
-    for artist_name, artist_id in extended_artist_dict.items():
-        songs_dict = spotify_helper_functions.get_top_songs(artist_id, sp)
-
-        if songs_dict:
-            print(f"Appending {len(songs_dict)} songs by {artist_name}")
-
-            for song_name, song_id in songs_dict.items():
-                if song_id:
-                    attributes = spotify_helper_functions.get_songs_attributes(song_id, sp)
-                    if attributes:
-                        #We expand the attributes dictionary for each song with the artist and song info
-                        attributes.update({"artist_name":artist_name, "artist_id":artist_id,
-                            "song_name": song_name, "song_id":song_id})
-                        #And then we store all the data in the dataframe
-                        df = df.append(attributes, ignore_index=True)
-        #We store it after each new artist is added, in case there is a connection timeout
-        df.to_csv(save_path)
-        
-        #Sleeping
-        count += 1
-        if count % 15 == 0:
-            print("Sleeping 10 seconds.")
-            time.sleep(10)
+    extends it with more songs from recommended artists.
+    The related artists are crawled concurrently, level by level, up to max_depth levels and
+    max_artists new artists. All the requests share a token bucket of requests_per_second, and
+    the ones answered with a 429 wait what Spotify asks for before being retried.
+    The artists found and the new songs are appended to a checkpoint store after each batch. If
+    the store has an unfinished crawl with the same seeds, max_depth and max_artists, the crawl is
+    resumed from the artists whose songs are missing; otherwise the store is cleared and the crawl
+    starts again. At the end the crawl is cleared from the store and marked as finished.
+    The songs of the initial dataframe and the crawled ones are kept in the registry at registry_path
+    (keyed by id), so only the features of songs never seen before are requested, also in later crawls.
+    The final dataset is written to save_path once, at the end.
+    """
+
+    if sp is None:
+        sp = spotify_helper_functions.get_client(rate_limited=True)
+    sp = crawler.RateLimitedClient(sp, crawler.TokenBucket(rate=requests_per_second))
+
+    store = checkpoint.CheckpointStore(checkpoint_path, columns=COLUMNS)
+    songs_registry = registry.Registry(registry_path)
+    songs_registry.add_songs_df(df)
+
+    #We extract the ids of the artists in the initial dataframe, which are the seeds of the crawl
+    seed_artists = dict(zip(df["artist_id"], df["artist_name"]))
+
+    #An unfinished crawl of the same seeds and limits is resumed, any other one is started again
+    parameters = {"seeds": sorted(seed_artists), "max_depth": max_depth, "max_artists": max_artists}
+    if store.resume(parameters):
+        print(f"Resuming crawl from {checkpoint_path}")
+    else:
+        #Now we search the related artists graph, skipping the artists we already have
+        extended_artist_dict = crawler.crawl_related_artists(seed_artists, sp, max_depth=max_depth,
+                                                             max_artists=max_artists, workers=workers)
+        store.add_artists({artist_id: artist_name for artist_id, artist_name in extended_artist_dict.items()
+                           if artist_id not in seed_artists})
+
+    new_artists = list(store.pending_artists().items())
+
+    #With the extended artist dictionary, we find the most popular songs and include them in the store.
+    #The songs of several artists are collected before asking for their features in bulk
+    batch_size = ARTISTS_PER_BATCH * workers
+    for start in range(0, len(new_artists), batch_size):
+        artists = dict(new_artists[start:start + batch_size])
+        songs = crawler.crawl_top_songs(artists, sp, workers=workers)
+        print(f"Appending {len(songs)} songs by {len(artists)} artists")
+
+        #Only the new rows are written, in case there is a connection timeout
+        store.save_batch(songs_features_df(songs, sp, songs_registry), artists)
+
+    df = pd.concat([df, store.load_songs()], ignore_index=True)
+    songs_registry.close()
 
     df = df.drop_duplicates(subset="song_id")
     df.to_csv(save_path)
+    store.finish()
+    store.close()
     print(f"Created the final dataset with the songs and features from Spotify. Total of {len(df)} songs.")
     return df
 
 
-def main():
+def chart_diff(top_df, previous_df):
+    """
+    Function that compares the top songs with a previous snapshot (both with songs and artists
+    columns), ignoring case and accents.
+    Output: the rows of top_df that were not in the snapshot.
+    """
+    def keys(df):
+        return df["songs"].map(registry.normalize) + "\t" + df["artists"].map(registry.normalize)
+
+    return top_df.loc[~keys(top_df).isin(set(keys(previous_df)))].reset_index(drop=True)
+
+
+def refresh_top_songs(top_path="top_songs.csv", snapshot_path="top_songs_snapshot.csv",
+                      songs_path="spotify_songs.csv", model_path="music_model.npz", index_path="music_index.pkl",
+                      registry_path="spotify_registry.db", top_table_path="top_table.pkl", ann_path="music_ann.npz", workers=8,
+                      requests_per_second=REQUESTS_PER_SECOND, sp=None, train_path=None):
+    """
+    Function that updates the songs dataset with the chart entries that changed since the last refresh.
+    The top songs are compared with the snapshot saved by the previous refresh, and only the artists
+    of the new entries are searched in Spotify. Their top songs that are not in the dataset yet are
+    added (with their features, which are only requested for ids not in the registry), and only
+    those rows go through the model to get their cluster in the recommendation index. By default
+    it is the model exported by light_model (.npz), so the refresh doesn't import scikit-learn.
+    With train_path (the pickled pipeline, like music_model.pkl), the model is first updated with the
+    added songs only and saved again (see update_serving_model), and the new songs get their cluster
+    from the updated model.
+    Then the table with the similar songs of each top song (see top_table) is rebuilt.
+    Output: the dataframe with the added songs.
+    """
+    top_df = pd.read_csv(top_path, index_col=0)
+    try:
+        previous_df = pd.read_csv(snapshot_path, index_col=0)
+    except FileNotFoundError:
+        previous_df = pd.DataFrame(columns=["songs", "artists"])
+
+    new_entries = chart_diff(top_df, previous_df)
+    print(f"{len(new_entries)} new chart entries since the last refresh")
+
+    added_df = pd.DataFrame(columns=COLUMNS)
+    if len(new_entries) > 0:
+        if sp is None:
+            sp = spotify_helper_functions.get_client(rate_limited=True)
+        sp = crawler.RateLimitedClient(sp, crawler.TokenBucket(rate=requests_per_second))
+
+        songs_df = pd.read_csv(songs_path, index_col=0)
+        songs_registry = registry.Registry(registry_path)
+        songs_registry.add_songs_df(songs_df)
+
+        #We find the ids of the artists of the new entries, and their top songs
+        artists = {}
+        for artist in new_entries["artists"].unique():
+            artists_dict = spotify_helper_functions.search_artists(artist, sp)
+            if artists_dict:
+                artists.update(artists_dict)
+        songs_registry.add_artists(artists)
+
+        songs = crawler.crawl_top_songs(artists, sp, workers=workers)
+        known_ids = set(songs_df["song_id"])
+        songs = [song for song in songs if song["song_id"] not in known_ids]
+
+        added_df = songs_features_df(songs, sp, songs_registry)
+        songs_registry.close()
+
+        model = load_serving_model(model_path)
+        index = song_index.load_index(path=index_path)
+        if len(added_df) > 0:
+            pd.concat([songs_df, added_df], ignore_index=True).to_csv(songs_path)
+            if train_path is not None:
+                updated_model = update_serving_model(added_df, index, train_path=train_path, export_path=model_path)
+                if updated_model is not None:
+                    model = updated_model
+            index = update_songs_index(added_df, model, index, index_path=index_path, ann_path=ann_path)
+
+        print(f"Added {len(added_df)} songs by {len(artists)} artists to {songs_path}")
+
+        if index is not None:
+            table = top_table.refresh_top_table(top_df, model, index, sp, previous=top_table.load_top_table(top_table_path))
+            top_table.save_top_table(table, path=top_table_path)
+
+    top_df.to_csv(snapshot_path)
+
+    return added_df
+
+
+def load_serving_model(model_path="music_model.npz"):
+    #The model can be the pickled pipeline or the one exported by light_model (.npz), which
+    #doesn't need scikit-learn
+    if model_path.endswith(".npz"):
+        return light_model.load_model(path=model_path)
+    import clustering_music
+    return clustering_music.load_model(path=model_path)
+
+
+def update_serving_model(added_df, index, train_path="music_model.pkl", export_path="music_model.npz"):
+    """
+    Function that updates the pickled model in train_path with the added songs only (see
+    clustering_music.update_model, which needs scikit-learn) and saves it there again. The centroids
+    are weighted by the number of songs of each cluster in the index. If export_path is a .npz file,
+    the updated model is also exported there for light_model.
+    Output: the updated model (None if there was no pickled model).
+    """
+    import clustering_music
+    model = clustering_music.load_model(path=train_path)
+    if model is None:
+        return None
+
+    cluster_sizes = None
+    if index is not None:
+        cluster_sizes = np.bincount(np.fromiter(index["song_cluster"].values(), dtype=int),
+                                    minlength=model[-1].n_clusters)
+    model = clustering_music.update_model(model, added_df[COLUMNS], cluster_sizes=cluster_sizes)
+    clustering_music.save_model(model, path=train_path,
+                                export_path=export_path if str(export_path).endswith(".npz") else None)
+
+    return model
+
+
+def update_songs_index(added_df, model, index, index_path="music_index.pkl", ann_path="music_ann.npz"):
+    """
+    Function that assigns clusters to the added songs and inserts them in the recommendation index,
+    without predicting the rest of the dataset. The updated index is saved in index_path.
+    The songs are also inserted in the approximate nearest neighbours index, if there is one in ann_path.
+    Output: the updated index (None if there was no index).
+    """
+    if index is None:
+        print("The recommendation index will be created with the new dataset by the recommender.")
+        return None
+
+    index = song_index.update_index(index, model, added_df[COLUMNS])
+    song_index.save_index(index, path=index_path)
+
+    ann = ann_index.load_ann_index(path=ann_path)
+    if ann is not None:
+        added_ids = [song_id for song_id in added_df["song_id"] if song_id in index["song_row"]]
+        ann.add(index["features"][[index["song_row"][song_id] for song_id in added_ids]], added_ids)
+        ann.save(ann_path)
+
+    return index
+
+
+def main(songs_path="spotify_songs.csv", snapshot_path="top_songs_snapshot.csv", train_path=None):
+    #With --train, the refresh also updates the pickled model with the added songs (this needs scikit-learn)
+    if train_path is None and "--train" in sys.argv[1:]:
+        train_path = "music_model.pkl"
+
+    #With a snapshot of the previous charts, only the new entries are added to the songs dataset
+    if os.path.exists(snapshot_path) and os.path.exists(songs_path):
+        refresh_top_songs(snapshot_path=snapshot_path, songs_path=songs_path, train_path=train_path)
+        return 0
+
     initial_df = scraper.import_top_songs()
 
     try:
         middle_df = pd.read_csv("spotify_df.csv", index_col=0)
-    except:
+    except FileNotFoundError:
         print("Creating spotify dataset")
         middle_df = spotify_df(initial_df)
 
     print("Extending dataset...")
-    final_df = extend_df(middle_df)
+    final_df = extend_df(middle_df, save_path=songs_path)
+
+    #The charts used by the full build are the snapshot of the next refresh
+    initial_df.to_csv(snapshot_path)
 
     return 0
 
@@ -0,0 +1,96 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+#The modules of the project are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ID_COLUMNS = ["song_name", "song_id", "artist_name", "artist_id"]
+
+#Words used to create the names of the synthetic songs
+WORDS = ["love", "night", "baby", "heart", "fire", "dance", "dream", "sky", "road", "money", "girl", "boy",
+         "time", "light", "rain", "summer", "blue", "wild", "gold", "star", "city", "river", "ghost", "sugar",
+         "midnight", "paradise", "stranger", "electric", "forever", "tonight", "home", "lonely", "crazy",
+         "young", "free", "world", "moon", "ocean", "angel", "thunder"]
+
+
+@pytest.fixture
+def synthetic_catalog():
+    """
+    Fixture that creates random songs dataframes with the same columns as spotify_songs.csv (like
+    benchmarks.synthetic_catalog, without importing the benchmarks and the scrapers).
+    """
+    def create(n_songs, seed=0):
+        rng = np.random.default_rng(seed)
+        n_artists = max(1, n_songs // 10)
+        words = np.array(WORDS)
+
+        n_words = rng.integers(1, 5, n_songs)
+        word_choices = rng.integers(0, len(words), (n_songs, 4))
+        numbers = rng.integers(0, 1000, n_songs)
+        artists = rng.integers(0, n_artists, n_songs)
+        return pd.DataFrame(data={"song_name": [" ".join(words[word_choices[row, :n_words[row]]])
+                                                + (f" {numbers[row]}" if numbers[row] < 300 else "")
+                                                for row in range(n_songs)],
+                                  "song_id": [f"synth{row:016d}" for row in range(n_songs)],
+                                  "artist_name": [f"artist {artist}" for artist in artists],
+                                  "artist_id": [f"synthartist{artist:011d}" for artist in artists],
+                                  "danceability": rng.random(n_songs), "energy": rng.random(n_songs),
+                                  "key": rng.integers(0, 12, n_songs), "loudness": rng.normal(-8, 3, n_songs),
+                                  "mode": rng.integers(0, 2, n_songs), "speechiness": rng.random(n_songs) * 0.3,
+                                  "acousticness": rng.random(n_songs), "instrumentalness": rng.random(n_songs) * 0.5,
+                                  "liveness": rng.random(n_songs) * 0.5, "valence": rng.random(n_songs),
+                                  "tempo": rng.normal(120, 25, n_songs)})
+
+    return create
+
+
+@pytest.fixture
+def modeling():
+    """
+    Fixture that drops the id columns of a songs dataframe, leaving the features the model is trained with.
+    """
+    return lambda df: df.drop(columns=ID_COLUMNS)
+
+
+@pytest.fixture
+def recording_spotify():
+    """
+    Fixture that creates FakeSpotify clients that also record the ids whose features are requested,
+    and add a compilation song (shared by all the artists) to every top songs answer.
+    Each client has its own cache scope, so no answers cached by other tests are used.
+    """
+    from fake_spotify import FakeSpotify
+
+    class RecordingSpotify(FakeSpotify):
+
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.cache_scope = f"recording-{id(self)}-{os.urandom(4).hex()}"
+            self.feature_ids = []
+
+        def artist_top_tracks(self, artist_id, country="US"):
+            answer = super().artist_top_tracks(artist_id, country)
+            answer["tracks"].append(self._track(self.n_artists - 1, 0))
+            return answer
+
+        def audio_features(self, tracks=[]):
+            self.feature_ids.extend([tracks] if isinstance(tracks, str) else tracks)
+            return super().audio_features(tracks)
+
+    return RecordingSpotify
+
+
+@pytest.fixture
+def seed_df():
+    """
+    Fixture with the songs dataset that the crawls start from: one song of the first fake artist.
+    """
+    from fake_spotify import FakeSpotify
+    import spotify_helper_functions
+
+    return pd.DataFrame(data=[dict({"song_name": "seed", "song_id": "seed", "artist_name": "Artist 0",
+                                    "artist_id": FakeSpotify.artist_id(0)},
+                                   **{column: 0.0 for column in spotify_helper_functions.SELECTED_FEATURES})])
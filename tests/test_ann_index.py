@@ -0,0 +1,26 @@
+import numpy as np
+import ann_index
+
+
+def test_songs_inserted_one_by_one_are_found_like_in_a_batch(tmp_path):
+    rng = np.random.default_rng(0)
+    centroids = rng.normal(size=(8, 11))
+    scaled = rng.normal(size=(3000, 11))
+    song_ids = [f"song{row}" for row in range(3000)]
+
+    one_by_one = ann_index.IVFPQIndex.train(centroids, scaled[:2000], song_ids[:2000], n_codes=64, n_iter=5)
+    batch = ann_index.IVFPQIndex.train(centroids, scaled[:2000], song_ids[:2000], n_codes=64, n_iter=5)
+    for row in range(2000, 3000):
+        one_by_one.add(scaled[row:row + 1], song_ids[row:row + 1])
+    batch.add(scaled[2000:], song_ids[2000:])
+
+    #The buffers grow by doubling, so they are never more than twice the used rows
+    assert one_by_one.list_sizes.sum() == len(one_by_one) == 3000
+    assert all(len(one_by_one.list_ids[number]) <= 2 * size for number, size in enumerate(one_by_one.list_sizes))
+
+    one_by_one.save(tmp_path / "music_ann.npz")
+    loaded = ann_index.load_ann_index(path=tmp_path / "music_ann.npz")
+    for query in rng.normal(size=(20, 11)):
+        expected = batch.search(query, k=10, nprobe=3, rerank=50)
+        assert one_by_one.search(query, k=10, nprobe=3, rerank=50) == expected
+        assert loaded.search(query, k=10, nprobe=3, rerank=50) == expected
@@ -0,0 +1,88 @@
+import pytest
+import checkpoint
+import spotify_scraper
+
+
+@pytest.fixture
+def crawl(tmp_path, monkeypatch, seed_df):
+    """
+    Fixture that runs extend_df crawls with the same checkpoint store, in batches of 4 artists.
+    """
+    monkeypatch.setattr(spotify_scraper, "ARTISTS_PER_BATCH", 2)
+
+    def run(sp, max_artists=20):
+        return spotify_scraper.extend_df(seed_df, save_path=tmp_path / "final_df.csv", max_depth=2,
+                                         max_artists=max_artists, workers=2, requests_per_second=10000, sp=sp,
+                                         checkpoint_path=tmp_path / "crawl_checkpoint.db",
+                                         registry_path=tmp_path / "spotify_registry.db")
+
+    return run
+
+
+@pytest.fixture
+def top_tracks_spotify(recording_spotify):
+    """
+    Fixture that creates fake clients that record the artists whose top songs are requested, and
+    lose the connection after fail_after of those requests.
+    """
+    class TopTracksSpotify(recording_spotify):
+
+        def __init__(self, fail_after=None, **kwargs):
+            super().__init__(n_artists=200, **kwargs)
+            self.fail_after = fail_after
+            self.top_artists = []
+
+        def artist_top_tracks(self, artist_id, country="US"):
+            if self.fail_after is not None and len(self.top_artists) >= self.fail_after:
+                raise ConnectionError("Connection lost")
+            self.top_artists.append(artist_id)
+            return super().artist_top_tracks(artist_id, country)
+
+    return TopTracksSpotify
+
+
+def test_interrupted_crawl_resumes_after_the_saved_batches(tmp_path, crawl, top_tracks_spotify):
+    interrupted = top_tracks_spotify(fail_after=9)
+    with pytest.raises(ConnectionError):
+        crawl(interrupted)
+
+    store = checkpoint.CheckpointStore(tmp_path / "crawl_checkpoint.db")
+    saved_artists = store.crawled_artists()
+    store.close()
+    assert len(saved_artists) == 8
+
+    resumed = top_tracks_spotify()
+    df = crawl(resumed)
+
+    assert resumed.calls["artist_related_artists"] == 0
+    assert len(resumed.top_artists) == 12
+    assert not saved_artists & set(resumed.top_artists)
+    assert len(df) == 1 + 20 * 10 + 1 and df["song_id"].is_unique
+
+
+def test_crawl_with_other_parameters_starts_again(crawl, top_tracks_spotify):
+    with pytest.raises(ConnectionError):
+        crawl(top_tracks_spotify(fail_after=9))
+
+    restarted = top_tracks_spotify()
+    crawl(restarted, max_artists=10)
+
+    assert restarted.calls["artist_related_artists"] > 0
+    assert len(restarted.top_artists) == 10
+
+
+def test_finished_crawl_is_cleared_and_not_resumed(tmp_path, crawl, top_tracks_spotify):
+    crawl(top_tracks_spotify())
+
+    store = checkpoint.CheckpointStore(tmp_path / "crawl_checkpoint.db")
+    assert store.connection.execute("SELECT finished FROM crawl").fetchall() == [(1,)]
+    assert not store.has_artists()
+    assert len(store.load_songs()) == 0
+    store.close()
+
+    #The same crawl runs again from the start
+    again = top_tracks_spotify()
+    crawl(again)
+
+    assert again.calls["artist_related_artists"] > 0
+    assert len(again.top_artists) == 20
@@ -0,0 +1,49 @@
+import numpy as np
+import clustering_music
+import light_model
+import song_index
+import spotify_scraper
+
+
+def test_small_update_keeps_the_model(synthetic_catalog, modeling):
+    df = synthetic_catalog(20000, seed=0)
+    model, _, _ = clustering_music.create_model(modeling(df), n_clusters=10, n_init=1)
+    old_inertia = -model.score(modeling(df))
+
+    #1% of new songs, shifted away from the catalog
+    new_df = synthetic_catalog(200, seed=1)
+    new_df[["danceability", "energy", "valence"]] += 1
+    updated = clustering_music.update_model(model, new_df)
+
+    movement = np.linalg.norm(updated[-1].cluster_centers_ - model[-1].cluster_centers_, axis=1)
+    assert movement.max() < 0.5
+    assert -updated.score(modeling(df)) < old_inertia * 1.02
+
+
+def test_update_returns_a_new_model(synthetic_catalog, modeling):
+    model, _, _ = clustering_music.create_model(modeling(synthetic_catalog(5000, seed=0)), n_clusters=10, n_init=1)
+    minibatch = clustering_music.update_model(model, synthetic_catalog(100, seed=1))
+    centroids = minibatch[-1].cluster_centers_.copy()
+
+    updated = clustering_music.update_model(minibatch, synthetic_catalog(100, seed=2))
+
+    assert updated[-1] is not minibatch[-1]
+    assert np.array_equal(minibatch[-1].cluster_centers_, centroids)
+
+
+def test_refresh_updates_the_stored_model(tmp_path, monkeypatch, synthetic_catalog, modeling):
+    monkeypatch.chdir(tmp_path)
+    df = synthetic_catalog(5000, seed=0)
+    model, _, _ = clustering_music.create_model(modeling(df), n_clusters=10, n_init=1)
+    clustering_music.save_model(model, path="music_model.pkl", df=df, export_path="music_model.npz")
+    index = song_index.load_index(path="music_index.pkl")
+
+    added_df = synthetic_catalog(100, seed=1)
+    updated = spotify_scraper.update_serving_model(added_df, index, train_path="music_model.pkl",
+                                                   export_path="music_model.npz")
+
+    stored = clustering_music.load_model(path="music_model.pkl")
+    assert np.array_equal(stored[-1].cluster_centers_, updated[-1].cluster_centers_)
+    assert not np.array_equal(stored[-1].cluster_centers_, model[-1].cluster_centers_)
+    assert np.array_equal(light_model.load_model(path="music_model.npz").predict(modeling(added_df)),
+                          updated.predict(modeling(added_df)))
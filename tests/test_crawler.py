@@ -0,0 +1,66 @@
+import threading
+import time
+import crawler
+import spotify_scraper
+from fake_spotify import FakeSpotify
+
+
+def test_token_bucket_sets_the_rate_of_all_the_threads():
+    limiter = crawler.TokenBucket(rate=100, capacity=1)
+
+    def take(n):
+        for _ in range(n):
+            limiter.acquire()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=take, args=(15,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    #60 tokens, the first one already in the bucket
+    assert 0.55 <= elapsed < 0.9
+
+
+def test_rate_limited_client_waits_the_retry_after_of_a_429(recording_spotify):
+    sp = recording_spotify(rate_limit=5, retry_after=1)
+    client = crawler.RateLimitedClient(sp, crawler.TokenBucket(rate=1000))
+
+    start = time.monotonic()
+    answers = [client.artist_top_tracks(FakeSpotify.artist_id(number)) for number in range(6)]
+    elapsed = time.monotonic() - start
+
+    assert len(answers) == 6
+    assert sp.calls["429"] == 1
+    assert elapsed >= 1
+
+
+def test_crawl_stops_at_max_artists_new_artists(recording_spotify):
+    sp = recording_spotify(n_artists=1000)
+    seeds = {FakeSpotify.artist_id(number): f"Artist {number}" for number in range(3)}
+    seen = {FakeSpotify.artist_id(number) for number in range(3, 500)}
+
+    artists = crawler.crawl_related_artists(seeds, sp, max_depth=5, max_artists=50, workers=4, seen=seen)
+
+    assert len(artists) == 53
+    assert set(seeds) <= set(artists)
+    assert not seen & set(artists)
+
+
+def test_extend_df_requests_each_artist_and_track_once(tmp_path, monkeypatch, recording_spotify, seed_df):
+    #Batches of 2 * workers artists, so the compilation song is found in every batch
+    monkeypatch.setattr(spotify_scraper, "ARTISTS_PER_BATCH", 2)
+    sp = recording_spotify(n_artists=200)
+
+    df = spotify_scraper.extend_df(seed_df, save_path=tmp_path / "final_df.csv", max_depth=2, max_artists=30,
+                                   workers=2, requests_per_second=10000, sp=sp,
+                                   checkpoint_path=tmp_path / "crawl_checkpoint.db",
+                                   registry_path=tmp_path / "spotify_registry.db")
+
+    assert sp.calls["artist_top_tracks"] == 30
+    assert len(sp.feature_ids) == len(set(sp.feature_ids))
+    assert FakeSpotify.song_id(199, 0) in sp.feature_ids
+    assert df["song_id"].is_unique
+    assert len(df) == 1 + 30 * 10 + 1
@@ -0,0 +1,27 @@
+import os
+import clustering_music
+import light_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mismatches(model, light, df):
+    #The whole dataset at once and the first rows one by one, like the recommender predicts them
+    expected = model.predict(df)
+    rows = sum(light.predict(df.iloc[position].to_numpy())[0] != expected[position] for position in range(100))
+    return int((light.predict(df) != expected).sum()) + rows
+
+
+def test_exported_model_gives_the_same_clusters(tmp_path, synthetic_catalog, modeling):
+    df = modeling(synthetic_catalog(5000, seed=0))
+    model, _, _ = clustering_music.create_model(df, n_clusters=20, n_init=1)
+    light_model.export_model(model, path=tmp_path / "music_model.npz")
+
+    assert mismatches(model, light_model.load_model(path=tmp_path / "music_model.npz"), df) == 0
+
+
+def test_stored_models_give_the_same_clusters(synthetic_catalog, modeling):
+    model = clustering_music.load_model(path=os.path.join(ROOT, "music_model.pkl"))
+    light = light_model.load_model(path=os.path.join(ROOT, "music_model.npz"))
+
+    assert mismatches(model, light, modeling(synthetic_catalog(5000, seed=1))) == 0
@@ -0,0 +1,61 @@
+import os
+import pytest
+import scraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures", "charts")
+
+
+class Response:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class ChartSession:
+    """
+    Stand-in for the requests session, which answers the chart urls with the fixtures. It sends an
+    ETag with each page, and answers 304 when the request brings it back.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        name = next(name for name, source in scraper.CHART_SOURCES.items() if source["url"] == url)
+        self.requests.append((name, dict(headers or {})))
+        if (headers or {}).get("If-None-Match") == f'"{name}-1"':
+            return Response(304)
+        with open(os.path.join(FIXTURES, name + ".html"), "rb") as f:
+            return Response(200, f.read(), {"ETag": f'"{name}-1"'})
+
+
+@pytest.mark.parametrize("name, first_row", [("billboard", ("Way 2 Sexy", "Drake Featuring Future & Young Thug")),
+                                             ("popvortex", ("Shivers", "Ed Sheeran"))])
+def test_parsers(name, first_row):
+    rows = scraper.parse_saved_page(name, os.path.join(FIXTURES, name + ".html"))
+
+    assert len(rows) == 5
+    assert rows[0] == first_row
+
+
+def test_create_songs_dataframe(tmp_path, monkeypatch):
+    monkeypatch.setattr(scraper, "make_session", lambda pool_size=10, retries=2: ChartSession())
+
+    df = scraper.create_songs_dataframe(path=tmp_path / "top_songs.csv", cache_dir=tmp_path / "cache")
+
+    assert list(df.columns) == ["songs", "artists"]
+    assert len(df) == 10
+    assert tuple(df.iloc[0]) == ("Way 2 Sexy", "Drake Featuring Future & Young Thug")
+
+
+def test_not_modified_chart_uses_the_cached_rows(tmp_path):
+    session = ChartSession()
+
+    rows = scraper.fetch_chart("popvortex", session, cache_dir=tmp_path)
+    cached_rows = scraper.fetch_chart("popvortex", session, cache_dir=tmp_path)
+
+    assert session.requests[0][1] == {}
+    assert session.requests[1][1] == {"If-None-Match": '"popvortex-1"'}
+    assert cached_rows == rows
+    assert len(cached_rows) == 5
@@ -0,0 +1,25 @@
+import numpy as np
+import recommender
+import song_index
+
+
+def test_inserted_songs_are_found_like_in_a_rebuilt_index():
+    rng = np.random.default_rng(0)
+    n_songs = 2000
+    index = song_index.assemble_index([f"song{row}" for row in range(n_songs)], [f"song {row}" for row in range(n_songs)],
+                                      ["artist"] * n_songs, rng.integers(0, 5, n_songs), rng.normal(size=(n_songs, 11)))
+
+    clusters = rng.integers(0, 5, 300)
+    scaled = rng.normal(size=(300, 11))
+    for position in range(300):
+        song_index.insert_songs(index, [f"new{position}"], [f"New Song {position}"], ["New Artist"],
+                                clusters[position:position + 1], scaled[position:position + 1])
+
+    assert len(index["song_ids"]) == len(index["features"]) == n_songs + 300
+    assert index["song_info"]["new7"] == ("New Song 7", "New Artist")
+
+    compacted = song_index.compact_index(index)
+    query = rng.normal(size=11)
+    for cluster in range(5):
+        assert recommender.nearest_songs(query, index, [cluster], n=20) == \
+            recommender.nearest_songs(query, compacted, [cluster], n=20)
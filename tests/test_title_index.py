@@ -0,0 +1,36 @@
+import random
+from difflib import get_close_matches
+from title_index import TitleIndex
+
+
+def typo_queries(names, n_queries=500, seed=0):
+    #Names with up to 3 characters changed, deleted or inserted, so some are close matches and some are not
+    rng = random.Random(seed)
+    queries = []
+    for name in rng.choices(names, k=n_queries):
+        query = list(name)
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(query))
+            operation = rng.choice(["change", "delete", "insert"])
+            if operation == "insert" or position == len(query):
+                query.insert(position, rng.choice("abcdefghijklmnopqrstuvwxyz "))
+            elif operation == "delete":
+                del query[position]
+            else:
+                query[position] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+        queries.append("".join(query))
+    return queries
+
+
+def test_same_matches_as_get_close_matches(synthetic_catalog):
+    names = list(dict.fromkeys(synthetic_catalog(5000, seed=0)["song_name"]))
+    index = TitleIndex(names)
+
+    mismatches = []
+    for query in typo_queries(names):
+        expected = get_close_matches(query, names, n=3, cutoff=0.90)
+        found = index.search(query, n=3, cutoff=0.90)
+        if found != expected:
+            mismatches.append((query, expected, found))
+
+    assert mismatches == []
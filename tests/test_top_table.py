@@ -0,0 +1,20 @@
+import pytest
+from top_table import main_artist
+
+
+@pytest.mark.parametrize("artists, expected", [
+    ("Drake Featuring Future & Young Thug", "Drake"),
+    ("Lil Nas X feat. Jack Harlow", "Lil Nas X"),
+    ("Doja Cat Feat SZA", "Doja Cat"),
+    ("Justin Bieber ft. Daniel Caesar & Giveon", "Justin Bieber"),
+    ("Silk Sonic ft Bruno Mars", "Silk Sonic"),
+    ("Ed Sheeran With Elton John", "Ed Sheeran"),
+    ("Kanye West x Lil Pump", "Kanye West"),
+    ("Megan Thee Stallion & Dua Lipa", "Megan Thee Stallion"),
+    ("Tyler, The Creator", "Tyler, The Creator"),
+    ("Tyler, The Creator Featuring Lil Wayne", "Tyler, The Creator"),
+    ("Lil Nas X", "Lil Nas X"),
+    ("Olivia Rodrigo", "Olivia Rodrigo"),
+])
+def test_main_artist(artists, expected):
+    assert main_artist(artists) == expected
@@ -0,0 +1,134 @@
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from heapq import nlargest
+from math import ceil
+
+
+def trigrams(name):
+    """
+    Function that returns the character trigrams of a name, with their counts.
+    """
+    return Counter(name[i:i+3] for i in range(len(name) - 2))
+
+
+def min_matches(len_a, len_b, cutoff):
+    """
+    Function that returns the minimum number of matching characters two strings of the given
+    lengths need for SequenceMatcher.ratio() to reach the cutoff, or None if it can't be reached.
+    """
+    total = len_a + len_b
+    if total == 0:
+        return 0
+
+    matches = ceil(cutoff * total / 2)
+    #We correct the rounding so the comparison is the same one difflib does
+    while matches > 0 and 2.0 * (matches - 1) / total >= cutoff:
+        matches -= 1
+    while 2.0 * matches / total < cutoff:
+        matches += 1
+
+    if matches > min(len_a, len_b):
+        return None
+    return matches
+
+
+class TitleIndex:
+    """
+    Index of song names for fuzzy matching, built once with the catalog.
+    Names are stored in trigram inverted lists grouped by name length. A query only reads the
+    lists of the lengths that can reach the cutoff, keeps the names that share enough trigrams
+    and rescores those with the same SequenceMatcher ratio that difflib.get_close_matches uses.
+    The trigram threshold is a lower bound of the trigrams shared by any pair with that ratio,
+    so the results are the same as get_close_matches over the distinct names.
+    """
+
+    def __init__(self, names=(), ids=None):
+        self.names = []
+        self.name_ids = {}
+        self._positions = {}
+        self._postings = defaultdict(list)
+        self._by_length = defaultdict(list)
+
+        if ids is None:
+            for name in names:
+                self.add(name)
+        else:
+            for name, song_id in zip(names, ids):
+                self.add(name, song_id)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, song_id=None):
+        """
+        Method that adds a name (and optionally the id of a song with that name) to the index.
+        """
+        if name not in self._positions:
+            position = len(self.names)
+            self._positions[name] = position
+            self.names.append(name)
+            self.name_ids[name] = []
+            self._by_length[len(name)].append(position)
+            for gram, count in trigrams(name).items():
+                self._postings[(len(name), gram)].append((position, count))
+
+        if song_id is not None and song_id not in self.name_ids[name]:
+            self.name_ids[name].append(song_id)
+
+    def _candidates(self, query, cutoff):
+        query_length = len(query)
+        query_grams = trigrams(query)
+        candidates = []
+
+        for length in list(self._by_length):
+            matches = min_matches(query_length, length, cutoff)
+            if matches is None:
+                continue
+
+            #Unmatched characters of each string. Every unmatched character breaks at most 3
+            #trigrams of its string and every jump between matching blocks at most 2
+            unmatched_query = query_length - matches
+            unmatched_name = length - matches
+            threshold = max(query_length - 2 - 3 * unmatched_query - 2 * unmatched_name,
+                            length - 2 - 3 * unmatched_name - 2 * unmatched_query)
+
+            if threshold <= 0:
+                #Short names: the trigrams can't discard anything, so we check all of them
+                candidates.extend(self._by_length[length])
+                continue
+
+            shared = defaultdict(int)
+            for gram, query_count in query_grams.items():
+                for position, count in self._postings.get((length, gram), ()):
+                    shared[position] += min(query_count, count)
+
+            candidates.extend(position for position, count in shared.items() if count >= threshold)
+
+        return candidates
+
+    def search(self, query, n=3, cutoff=0.90):
+        """
+        Method that returns the names closest to the query, like difflib.get_close_matches.
+        Input: the name we are looking for, the maximum number of results and the cutoff.
+        Output: a list with up to n names, best matches first; empty list if there are none.
+        """
+        matcher = SequenceMatcher()
+        matcher.set_seq2(query)
+        results = []
+
+        for position in self._candidates(query, cutoff):
+            name = self.names[position]
+            matcher.set_seq1(name)
+            if matcher.real_quick_ratio() >= cutoff and \
+               matcher.quick_ratio() >= cutoff and \
+               matcher.ratio() >= cutoff:
+                results.append((matcher.ratio(), name))
+
+        return [name for score, name in nlargest(n, results)]
+
+    def lookup(self, query, n=3, cutoff=0.90):
+        """
+        Method that returns the closest names to the query together with the ids of their songs.
+        Output: a list of tuples (name, [song_ids]), best matches first.
+        """
+        return [(name, list(self.name_ids[name])) for name in self.search(query, n=n, cutoff=cutoff)]
@@ -0,0 +1,197 @@
+import pickle
+import re
+import numpy as np
+import pandas as pd
+import spotify_helper_functions
+import registry
+
+TOP_TABLE_VERSION = 1
+
+#Catalog rows compared with the chart at once, to bound the memory of the distances matrix
+CATALOG_BLOCK = 100000
+
+
+def main_artist(artists):
+    """
+    Function that returns the first artist of a chart entry ("Drake Featuring Future & Young Thug" -> "Drake").
+    The featured artists are cut first, at "featuring", "feat", "feat.", "ft", "ft." or "with" between
+    spaces (ignoring case). Then the joint artists are cut at "&" or "x" between spaces.
+    A name with one of those between spaces is cut too, like "Simon & Garfunkel" or "Lil Nas X & ..."
+    (but not "Lil Nas X" alone or with featured artists). Commas are kept, since they are part of
+    names like "Tyler, The Creator".
+    """
+    artist = re.split(r"\s+(?:featuring|feat\.?|ft\.?|with)\s+", artists, flags=re.IGNORECASE)[0]
+    return re.split(r"\s+(?:x|&)\s+", artist, flags=re.IGNORECASE)[0].strip()
+
+
+def resolve_top_songs(top_df, sp, known=None):
+    """
+    Function that finds the Spotify id and the features of each chart entry. The track is searched
+    by name and main artist, and the result with the same (normalized) name is preferred.
+    Input: the top songs dataframe (songs and artists columns), the spotify connection and optionally
+    a dataframe of already resolved entries (like the chart of a previous table), which are not searched again.
+    Output: a dataframe with songs, artists, song_id and the features. Entries not found are left out.
+    """
+    def key(songs, artists):
+        return registry.normalize(songs) + "\t" + registry.normalize(artists)
+
+    resolved = {}
+    if known is not None:
+        resolved = {key(row["songs"], row["artists"]): row for row in known.to_dict("records")}
+
+    rows = []
+    pending = []
+    for songs, artists in zip(top_df["songs"], top_df["artists"]):
+        if key(songs, artists) in resolved:
+            rows.append(dict(resolved[key(songs, artists)], songs=songs, artists=artists))
+            continue
+
+        tracks = spotify_helper_functions.find_possible_songs(f"{songs} {main_artist(artists)}", sp)
+        if not tracks:
+            continue
+        same_name = [song_id for song_name, song_id in tracks.items()
+                     if registry.normalize(song_name) == registry.normalize(songs)]
+        song_id = same_name[0] if same_name else next(iter(tracks.values()))
+        pending.append(len(rows))
+        rows.append({"songs": songs, "artists": artists, "song_id": song_id})
+
+    #The features of the new entries are requested together
+    attributes = spotify_helper_functions.get_songs_attributes_batch([rows[position]["song_id"] for position in pending], sp)
+    for position in pending:
+        rows[position].update(attributes.get(rows[position]["song_id"], {}))
+
+    columns = ["songs", "artists", "song_id"] + spotify_helper_functions.SELECTED_FEATURES
+    df = pd.DataFrame(data=rows, columns=columns).dropna()
+
+    return df.drop_duplicates(subset="songs").reset_index(drop=True)
+
+
+def squared_distances(queries, features, features_norms=None):
+    """
+    Function that computes the squared euclidean distances between each query and each row of features.
+    """
+    if features_norms is None:
+        features_norms = np.einsum("ij,ij->i", features, features)
+    queries_norms = np.einsum("ij,ij->i", queries, queries)
+    return queries_norms[:, None] + features_norms[None, :] - 2 * queries @ features.T
+
+
+def k_smallest(distances, k):
+    """
+    Function that returns the columns of the k smallest distances of each row, sorted by distance.
+    """
+    k = min(k, distances.shape[1])
+    if k == 0:
+        return np.empty((len(distances), 0), dtype=np.int64)
+    columns = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, columns, axis=1).argsort(axis=1)
+    return np.take_along_axis(columns, order, axis=1)
+
+
+def build_top_table(chart_df, model, index, k=5):
+    """
+    Function that precomputes the k most similar chart songs and catalog songs of each chart song.
+    The chart features are scaled with the model, and the distances to the other chart songs and to
+    the scaled features of the recommendation index are computed in vectorized passes (the catalog
+    in blocks of CATALOG_BLOCK rows).
+    Input: the resolved chart (see resolve_top_songs), the model, the recommendation index and k.
+    Output: the table, a dictionary with the version, the chart and the lowercase song name ->
+    {"top_songs": [(song_name, artist_name)], "song_ids": [catalog song ids]} lookup.
+    """
+    chart_df = chart_df.reset_index(drop=True)
+    table = {"version": TOP_TABLE_VERSION, "k": k, "chart": chart_df, "songs": {}}
+    if len(chart_df) == 0:
+        return table
+
+    scaled = model[:-1].transform(chart_df[spotify_helper_functions.SELECTED_FEATURES]).astype(np.float32)
+
+    #Similar chart songs, without the song itself
+    chart_distances = squared_distances(scaled, scaled)
+    np.fill_diagonal(chart_distances, np.inf)
+    top_neighbours = k_smallest(chart_distances, min(k, len(chart_df) - 1))
+
+    #Similar catalog songs, keeping the k best of each block. The chart songs themselves are skipped
+    features = index["features"]
+    song_ids = np.asarray(index["song_ids"], dtype=object)
+    chart_ids = set(chart_df["song_id"])
+    best_distances = np.full((len(chart_df), 0), np.inf, dtype=np.float32)
+    best_rows = np.empty((len(chart_df), 0), dtype=np.int64)
+    for start in range(0, len(features), CATALOG_BLOCK):
+        block = np.asarray(features[start:start + CATALOG_BLOCK], dtype=np.float32)
+        distances = squared_distances(scaled, block)
+        in_chart = np.fromiter((song_id in chart_ids for song_id in song_ids[start:start + len(block)]),
+                               dtype=bool, count=len(block))
+        distances[:, in_chart] = np.inf
+
+        columns = k_smallest(distances, k)
+        candidates = np.concatenate([best_distances, np.take_along_axis(distances, columns, axis=1)], axis=1)
+        rows = np.concatenate([best_rows, columns + start], axis=1)
+        best = k_smallest(candidates, k)
+        best_distances = np.take_along_axis(candidates, best, axis=1)
+        best_rows = np.take_along_axis(rows, best, axis=1)
+
+    songs = chart_df["songs"].str.lower().tolist()
+    artists = chart_df["artists"].str.lower().tolist()
+    for position, song_name in enumerate(songs):
+        table["songs"][song_name] = {
+            "top_songs": [(songs[other], artists[other]) for other in top_neighbours[position]],
+            "song_ids": [song_ids[row] for row, distance in zip(best_rows[position], best_distances[position])
+                         if np.isfinite(distance)]}
+
+    return table
+
+
+def refresh_top_table(top_df, model, index, sp, previous=None, k=5):
+    """
+    Function that rebuilds the table after a chart refresh. Only the entries that are not in the chart
+    of the previous table are searched in Spotify; the distances are always computed again.
+    """
+    known = previous["chart"] if previous is not None else None
+    chart_df = resolve_top_songs(top_df, sp, known=known)
+
+    return build_top_table(chart_df, model, index, k=k)
+
+
+def save_top_table(table, path="top_table.pkl"):
+    with open(path, "wb") as f:
+        pickle.dump(table, f)
+
+    return 0
+
+
+def load_top_table(path="top_table.pkl"):
+    """
+    Function that loads a table saved with save_top_table.
+    Output: the table, or None if the file doesn't exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            table = pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+    if table["version"] != TOP_TABLE_VERSION:
+        raise ValueError(f"Top songs table version {table['version']} not supported (expected {TOP_TABLE_VERSION}).")
+
+    return table
+
+
+def main():
+    import clustering_music
+
+    top_df = pd.read_csv("top_songs.csv", index_col=0)
+    model = clustering_music.load_model(path="music_model.pkl")
+    index = clustering_music.load_index(path="music_index.pkl")
+    if index is None:
+        index = clustering_music.create_index(model, clustering_music.import_df(path="spotify_songs.csv"))
+    sp = spotify_helper_functions.get_client()
+
+    table = refresh_top_table(top_df, model, index, sp, previous=load_top_table(path="top_table.pkl"))
+    save_top_table(table, path="top_table.pkl")
+    print(f"Top songs table with {len(table['songs'])} songs saved in top_table.pkl")
+
+    return 0
+
+
+if __name__=="__main__":
+    main()